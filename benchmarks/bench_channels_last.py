@@ -0,0 +1,71 @@
+"""
+Latency of SSD-Lite with MobileNetV2 in the NCHW and in the channels last (NHWC) memory format.
+
+    python -m benchmarks.bench_channels_last --batch-size 8
+"""
+import argparse
+import copy
+import time
+
+import torch
+
+from hubconf import ssd_lite_mobilenet_v2
+from models.fuse import fuse_for_inference
+from util.misc import nested_tensor_from_tensor_list
+
+
+def benchmark(model, samples, iters):
+    with torch.no_grad():
+        for _ in range(5):
+            model(samples)
+        if samples.tensors.is_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(iters):
+            model(samples)
+        if samples.tensors.is_cuda:
+            torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Benchmark of the channels last memory format', add_help=False)
+    parser.add_argument('--device', default='cpu',
+                        help='device')
+    parser.add_argument('--image-size', default=320, type=int,
+                        help='input size of models')
+    parser.add_argument('--batch-size', default=8, type=int,
+                        help='images per batch')
+    parser.add_argument('--iters', default=20, type=int,
+                        help='number of timed iterations')
+    parser.add_argument('--fuse', action='store_true',
+                        help='fold the BatchNorm layers into the convolutions first')
+    return parser
+
+
+def main(args):
+    device = torch.device(args.device)
+    model = ssd_lite_mobilenet_v2(image_size=args.image_size)
+    model.eval()
+    if args.fuse:
+        fuse_for_inference(model)
+    model.to(device)
+    images = [torch.rand(3, args.image_size, args.image_size, device=device) for _ in range(args.batch_size)]
+
+    results = []
+    for name, channels_last in [('NCHW', False), ('NHWC', True)]:
+        m = copy.deepcopy(model)
+        m.channels_last = channels_last
+        if channels_last:
+            m.to(memory_format=torch.channels_last)
+        samples = nested_tensor_from_tensor_list(images, channels_last=channels_last)
+        results.append((name, benchmark(m, samples, args.iters)))
+
+    for name, latency in results:
+        print(f"{name:>6}: {latency:.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('Channels last benchmark', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,104 @@
+"""
+Throughput of the training DataLoader for several numbers of workers.
+
+For every --num-workers value, the loader is iterated for two epochs. The startup is the
+time to the first batch of each epoch, it is only paid once with --persistent-workers.
+
+    python -m benchmarks.bench_data_loader --data-path path/to/data-path/ --num-workers 0 2 4 8
+"""
+import argparse
+import time
+
+import torch
+from torch.utils.data import DataLoader
+
+from datasets import build_dataset
+from util.misc import collate_fn
+
+
+def benchmark(data_loader, num_batches):
+    startup = 0.
+    num_images = 0
+    start = time.perf_counter()
+    for epoch in range(2):
+        epoch_start = time.perf_counter()
+        for i, (samples, targets) in enumerate(data_loader):
+            if i == 0:
+                startup += time.perf_counter() - epoch_start
+            num_images += len(targets)
+            if i + 1 >= num_batches:
+                break
+    return startup / 2, num_images / (time.perf_counter() - start)
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Benchmark of the data loading', add_help=False)
+    parser.add_argument('--data-path', default='./data-bin',
+                        help='dataset')
+    parser.add_argument('--dataset-file', default='voc',
+                        help='dataset')
+    parser.add_argument('--dataset-mode', default='instances',
+                        help='dataset mode')
+    parser.add_argument('--dataset-year', default=['2007'], nargs='+',
+                        help='dataset year')
+    parser.add_argument('--train-set', default='train',
+                        help='set of train')
+    parser.add_argument("--masks", action="store_true",
+                        help="semantic segmentation")
+    parser.add_argument('--annotation-index', default='',
+                        help='directory of the compiled VOC annotations, it is built on first use')
+    parser.add_argument('--image-cache', default='',
+                        help='directory of the cache of decoded and resized images, it is built on first use')
+    parser.add_argument('--augmentation', default='ssd', choices=['ssd', 'detr'],
+                        help='data augmentation of the training images, ssd or the random resize and crop of detr')
+    parser.add_argument('--batch-augment', action='store_true',
+                        help='only decode the images in the workers, as train.py --batch-augment')
+    parser.add_argument('--image-size', default=300, type=int,
+                        help='input size of models')
+    parser.add_argument('--batch-size', default=32, type=int,
+                        help='images per batch')
+    parser.add_argument('--num-workers', default=[0, 2, 4, 8], nargs='+', type=int,
+                        help='numbers of data loading workers to compare')
+    parser.add_argument('--num-batches', default=50, type=int,
+                        help='number of batches loaded per epoch')
+    parser.add_argument('--pin-memory', action='store_true',
+                        help='copy the batches to pinned memory in the DataLoader')
+    parser.add_argument('--persistent-workers', action='store_true',
+                        help='keep the data loading workers alive between epochs')
+    parser.add_argument('--prefetch-factor', default=2, type=int,
+                        help='number of batches loaded in advance by each worker')
+    return parser
+
+
+def main(args):
+    # the image cache is decoded with the largest number of workers
+    dataset_args = argparse.Namespace(**dict(vars(args), num_workers=max(args.num_workers)))
+    dataset = build_dataset(args.train_set, args.dataset_year, dataset_args)
+
+    results = []
+    for num_workers in args.num_workers:
+        kwargs = {}
+        if num_workers > 0:
+            kwargs = {'persistent_workers': args.persistent_workers, 'prefetch_factor': args.prefetch_factor}
+        data_loader = DataLoader(
+            dataset,
+            args.batch_size,
+            sampler=torch.utils.data.RandomSampler(dataset),
+            drop_last=True,
+            collate_fn=collate_fn,
+            num_workers=num_workers,
+            pin_memory=args.pin_memory,
+            **kwargs,
+        )
+        results.append((num_workers, *benchmark(data_loader, args.num_batches)))
+        del data_loader
+
+    print(f"{'workers':>8} {'startup (s)':>12} {'img/s':>8}")
+    for num_workers, startup, throughput in results:
+        print(f"{num_workers:>8} {startup:>12.2f} {throughput:>8.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('Data loading benchmark', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,78 @@
+"""
+Latency of SSD-Lite with MobileNetV2 before and after fuse_for_inference, and of its
+multibox head alone on CPU, with and without FusedMultiBoxLiteHead.
+
+    python -m benchmarks.bench_fuse --batch-size 1
+"""
+import argparse
+import copy
+import time
+
+import torch
+
+from hubconf import ssd_lite_mobilenet_v2
+from models.fuse import fuse_for_inference
+from util.misc import nested_tensor_from_tensor_list
+
+
+def benchmark(model, samples, iters):
+    with torch.no_grad():
+        for _ in range(5):
+            model(samples)
+        if isinstance(samples, torch.Tensor) and samples.is_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(iters):
+            model(samples)
+        if isinstance(samples, torch.Tensor) and samples.is_cuda:
+            torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Benchmark of the inference fusion', add_help=False)
+    parser.add_argument('--device', default='cpu',
+                        help='device')
+    parser.add_argument('--image-size', default=320, type=int,
+                        help='input size of models')
+    parser.add_argument('--batch-size', default=1, type=int,
+                        help='images per batch')
+    parser.add_argument('--iters', default=20, type=int,
+                        help='number of timed iterations')
+    return parser
+
+
+def main(args):
+    device = torch.device(args.device)
+    model = ssd_lite_mobilenet_v2(image_size=args.image_size)
+    model.eval()
+    model.to(device)
+    samples = torch.rand(args.batch_size, 3, args.image_size, args.image_size, device=device)
+
+    results = [('baseline', benchmark(model, samples, args.iters))]
+    fused_model = fuse_for_inference(copy.deepcopy(model))
+    results.append(('conv-bn folded', benchmark(fused_model, samples, args.iters)))
+    fused_model = fuse_for_inference(copy.deepcopy(model), fuse_head=True)
+    results.append(('conv-bn folded, fused head', benchmark(fused_model, samples, args.iters)))
+
+    for name, latency in results:
+        print(f"{name:>28}: {latency:.2f} ms")
+
+    # the head alone, on the features of the backbone
+    model.cpu()
+    with torch.no_grad():
+        features = model.backbone(nested_tensor_from_tensor_list(list(samples.cpu())))
+    results = []
+    for name, fuse_head in [('conv-bn folded', False), ('conv-bn folded, fused head', True)]:
+        head = fuse_for_inference(copy.deepcopy(model), fuse_head=fuse_head).multibox_head
+        results.append((name, benchmark(head, features, args.iters)))
+
+    print("multibox head on cpu")
+    for name, latency in results:
+        print(f"{name:>28}: {latency:.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('Inference fusion benchmark', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
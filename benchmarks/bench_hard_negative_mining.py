@@ -0,0 +1,81 @@
+"""
+Micro-benchmark of the hard negative mining of SetCriterion.
+
+Compares BalancedPositiveNegativeSampler with the previous double sort ranking,
+on random losses with the number of priors of SSD-Lite at 320x320.
+
+    python -m benchmarks.bench_hard_negative_mining --device cuda
+"""
+import argparse
+import math
+import time
+
+import torch
+
+from models._utils import BalancedPositiveNegativeSampler
+
+
+def double_sort_sampler(loss, targets, negative_positive_ratio):
+    pos_mask = targets > 0
+    num_pos = pos_mask.long().sum(dim=1, keepdim=True)
+    num_neg = num_pos * negative_positive_ratio
+
+    loss[pos_mask] = - math.inf
+    _, indexes = loss.sort(dim=1, descending=True)
+    _, orders = indexes.sort(dim=1)
+    neg_mask = orders < num_neg
+    return pos_mask | neg_mask
+
+
+def benchmark(fn, loss, targets, device, iters):
+    for _ in range(5):
+        fn(loss.clone(), targets)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = 0.
+    for _ in range(iters):
+        loss_clone = loss.clone()
+        start = time.perf_counter()
+        fn(loss_clone, targets)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        elapsed += time.perf_counter() - start
+    return elapsed / iters * 1000
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Benchmark of the hard negative mining', add_help=False)
+    parser.add_argument('--device', default='cpu',
+                        help='device')
+    parser.add_argument('--batch-sizes', default=[32, 64, 128, 256], nargs='+', type=int,
+                        help='batch sizes to benchmark')
+    parser.add_argument('--num-priors', default=3000, type=int,
+                        help='number of priors per image')
+    parser.add_argument('--positive-fraction', default=0.01, type=float,
+                        help='fraction of the priors matched with a target')
+    parser.add_argument('--iters', default=20, type=int,
+                        help='number of timed iterations')
+    return parser
+
+
+def main(args):
+    device = torch.device(args.device)
+    negative_positive_ratio = 3
+    sampler = BalancedPositiveNegativeSampler(negative_positive_ratio)
+
+    print(f"{'batch size':>10} {'double sort (ms)':>18} {'topk (ms)':>10} {'speedup':>8}")
+    for batch_size in args.batch_sizes:
+        loss = torch.rand(batch_size, args.num_priors, device=device)
+        targets = torch.randint(1, 21, (batch_size, args.num_priors), device=device)
+        targets *= torch.rand(batch_size, args.num_priors, device=device) < args.positive_fraction
+
+        reference = benchmark(
+            lambda x, y: double_sort_sampler(x, y, negative_positive_ratio), loss, targets, device, args.iters)
+        current = benchmark(sampler, loss, targets, device, args.iters)
+        print(f"{batch_size:>10} {reference:>18.3f} {current:>10.3f} {reference / current:>7.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('Hard negative mining benchmark', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,116 @@
+"""
+Per sample cost of the training transforms, in the data loading workers and batched on device.
+
+The images are random 500x375 images with three boxes, as the PASCAL VOC images. The script
+fails if the per sample cost of the --augmentation pipeline in the workers exceeds --budget-ms.
+
+    python -m benchmarks.bench_transforms --budget-ms 10
+"""
+import argparse
+import sys
+import time
+
+import torch
+from PIL import Image
+
+from datasets import transforms as T
+from datasets.batch_transforms import make_batch_transforms
+from datasets.voc import make_voc_transforms
+from util.misc import collate_fn
+
+
+def make_samples(num_images):
+    samples = []
+    for _ in range(num_images):
+        image = Image.fromarray(torch.randint(0, 256, (375, 500, 3), dtype=torch.uint8).numpy())
+        boxes = torch.tensor([[10., 20., 200., 190.], [50., 60., 150., 260.], [250., 100., 480., 370.]])
+        target = {
+            'boxes': boxes,
+            'labels': torch.tensor([1, 2, 3]),
+            'area': (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]),
+            'ishard': torch.tensor([0, 0, 1]),
+            'image_id': torch.tensor([0]),
+            'orig_size': torch.tensor([375, 500]),
+            'size': torch.tensor([375, 500]),
+        }
+        samples.append((image, target))
+    return samples
+
+
+def benchmark_per_sample(transforms, samples, iters):
+    start = time.perf_counter()
+    for _ in range(iters):
+        for image, target in samples:
+            transforms(image, target)
+    return (time.perf_counter() - start) / (iters * len(samples)) * 1000
+
+
+def benchmark_batched(batch_transforms, batch, iters):
+    samples, targets = batch
+    for _ in range(2):
+        batch_transforms(samples, targets)
+    if samples.tensors.is_cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        batch_transforms(samples, targets)
+    if samples.tensors.is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / (iters * len(targets)) * 1000
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Benchmark of the training transforms', add_help=False)
+    parser.add_argument('--device', default='cpu',
+                        help='device of the batched transforms')
+    parser.add_argument('--image-size', default=300, type=int,
+                        help='input size of models')
+    parser.add_argument('--batch-size', default=32, type=int,
+                        help='images per batch')
+    parser.add_argument('--iters', default=5, type=int,
+                        help='number of timed iterations')
+    parser.add_argument('--augmentation', default='ssd', choices=['ssd', 'detr'],
+                        help='data augmentation checked against the budget')
+    parser.add_argument('--budget-ms', default=10., type=float,
+                        help='maximum per sample cost of the augmentation in the workers')
+    return parser
+
+
+def main(args):
+    torch.manual_seed(0)
+    samples = make_samples(args.batch_size)
+    # the photometric distortion runs on the resized float images
+    tensor_samples = [T.ToTensor()(*T.Resize(args.image_size)(image, target)) for image, target in samples]
+
+    results = []
+    for name, transforms, inputs in [
+        ('RandomExpand', T.RandomExpand(p=1.), samples),
+        ('MinIoURandomCrop', T.MinIoURandomCrop(), samples),
+        ('PhotometricDistort', T.PhotometricDistort(), tensor_samples),
+        ('detr', make_voc_transforms('train', args.image_size, augmentation='detr'), samples),
+        ('ssd', make_voc_transforms('train', args.image_size, augmentation='ssd'), samples),
+    ]:
+        results.append((name, 'workers', benchmark_per_sample(transforms, inputs, args.iters)))
+
+    device = torch.device(args.device)
+    batch = collate_fn([T.PILToTensor()(image, target) for image, target in samples], with_mask=False)
+    batch = (batch[0].to(device), [{k: v.to(device) for k, v in t.items()} for t in batch[1]])
+    for augmentation in ['detr', 'ssd']:
+        batch_transforms = make_batch_transforms('train', args.image_size, augmentation=augmentation)
+        results.append((augmentation, args.device, benchmark_batched(batch_transforms, batch, args.iters)))
+
+    print(f"{'transforms':>20} {'on':>8} {'ms/sample':>10}")
+    for name, on, latency in results:
+        print(f"{name:>20} {on:>8} {latency:>10.2f}")
+
+    latency = next(latency for name, on, latency in results if name == args.augmentation and on == 'workers')
+    if latency > args.budget_ms:
+        print(f"The {args.augmentation} augmentation takes {latency:.2f} ms per sample, "
+              f"over the budget of {args.budget_ms:.2f} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('Transforms benchmark', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
@@ -16,14 +16,14 @@ def get_coco_api_from_dataset(dataset):
         return dataset.coco
 
 
-def build_dataset(image_set, dataset_year, args):
+def build_dataset(image_set, dataset_year, args, eval_transforms=False):
 
     datasets = []
     for year in dataset_year:
         if args.dataset_file == 'coco':
-            dataset = build_coco(image_set, year, args)
+            dataset = build_coco(image_set, year, args, eval_transforms=eval_transforms)
         elif args.dataset_file == 'voc':
-            dataset = build_voc(image_set, year, args)
+            dataset = build_voc(image_set, year, args, eval_transforms=eval_transforms)
         else:
             raise ValueError(f'dataset {args.dataset_file} not supported')
         datasets.append(dataset)
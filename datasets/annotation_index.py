@@ -0,0 +1,112 @@
+# Copyright (c) 2020, Zhiqiang Wang. All Rights Reserved.
+"""
+Compiled PASCAL VOC annotations, so that the XML files are parsed only once.
+"""
+import os
+
+import numpy as np
+
+import torch
+import torch.distributed as dist
+
+from util.misc import is_dist_avail_and_initialized, is_main_process
+
+
+class VOCAnnotationIndex(object):
+    """
+    Read only index of the targets of ConvertVOCtoCOCO, stored as flat arrays in the
+    {path}.{name}.npy files:
+
+        boxes (float32) [num_objects, 4], labels (uint8) [num_objects] and difficult
+        (uint8) [num_objects] of all the images one after another, offsets (int64)
+        [num_images + 1] of the objects of every image, sizes (int32) [num_images, 2]
+        as (height, width) and filenames (bytes) [num_images].
+
+    The arrays are memory mapped, so the DataLoader workers share their pages.
+
+    Arguments:
+        path (str): path of the index files, without extension.
+    """
+    _names = ('boxes', 'labels', 'difficult', 'offsets', 'sizes', 'filenames')
+
+    def __init__(self, path):
+        self.path = path
+        # opened lazily, so that every DataLoader worker maps the files itself
+        self._arrays = None
+        self._num_images = len(np.load(path + '.offsets.npy', mmap_mode='r')) - 1
+
+    def __len__(self):
+        return self._num_images
+
+    def __getitem__(self, index):
+        if self._arrays is None:
+            self._arrays = {name: np.load(f'{self.path}.{name}.npy', mmap_mode='r') for name in self._names}
+        arrays = self._arrays
+        start, end = arrays['offsets'][index], arrays['offsets'][index + 1]
+        height, width = arrays['sizes'][index].tolist()
+
+        target = {}
+        target['boxes'] = torch.from_numpy(np.array(arrays['boxes'][start:end]))
+        target['labels'] = torch.from_numpy(arrays['labels'][start:end].astype(np.int64))
+        target['ishard'] = torch.from_numpy(arrays['difficult'][start:end].astype(np.int64))
+
+        target['image_id'] = torch.tensor([index])
+        target["orig_size"] = torch.as_tensor([height, width])
+        target["size"] = torch.as_tensor([height, width])
+        target['filename'] = torch.from_numpy(np.frombuffer(arrays['filenames'][index], dtype=np.int8).copy())
+
+        return target
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(path + '.offsets.npy')
+
+    @staticmethod
+    def build(path, load_target, num_images):
+        """
+        Compiles the num_images targets of load_target(index), as returned by ConvertVOCtoCOCO,
+        into the index files of path.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        boxes, labels, difficult, filenames = [], [], [], []
+        offsets = np.zeros(num_images + 1, dtype=np.int64)
+        sizes = np.zeros((num_images, 2), dtype=np.int32)
+        for i in range(num_images):
+            target = load_target(i)
+            boxes.append(target['boxes'].numpy().astype(np.float32))
+            labels.append(target['labels'].numpy().astype(np.uint8))
+            difficult.append(target['ishard'].numpy().astype(np.uint8))
+            filenames.append(target['filename'].numpy().tobytes())
+            offsets[i + 1] = offsets[i] + len(target['boxes'])
+            sizes[i] = target['orig_size'].numpy()
+
+        arrays = {
+            'boxes': np.concatenate(boxes).reshape(-1, 4),
+            'labels': np.concatenate(labels),
+            'difficult': np.concatenate(difficult),
+            'sizes': sizes,
+            'filenames': np.array(filenames, dtype=bytes),
+            # the offsets are written last, their presence means that the index is complete
+            'offsets': offsets,
+        }
+        for name, array in arrays.items():
+            np.save(f'{path}.{name}.tmp.npy', array)
+            os.replace(f'{path}.{name}.tmp.npy', f'{path}.{name}.npy')
+
+
+def build_annotation_index(dataset, path):
+    """
+    Returns the VOCAnnotationIndex of dataset at path, it is compiled from dataset.load_target
+    on first use. In distributed mode, the main process compiles it while the others wait.
+    """
+    if not VOCAnnotationIndex.exists(path) and is_main_process():
+        print(f"Compiling the {len(dataset)} annotations of {path}")
+        VOCAnnotationIndex.build(path, dataset.load_target, len(dataset))
+    if is_dist_avail_and_initialized():
+        dist.barrier()
+    return VOCAnnotationIndex(path)
@@ -0,0 +1,466 @@
+# Copyright (c) 2020, Zhiqiang Wang. All Rights Reserved.
+"""
+Batched transforms and data augmentation for both image + bbox, on uint8 CHW tensors.
+
+They follow the transforms of datasets/transforms.py, but run on the whole batch on the
+device of the model, with per sample random parameters. The images are only decoded
+by the DataLoader workers, see transforms.PILToTensor.
+
+The geometric transforms don't touch the pixels, they compose a per sample affine map
+from the output image to the source image and update the boxes. BatchToTensor then
+resamples every image once with this map, bilinearly and without antialiasing.
+"""
+import torch
+import torch.nn.functional as F
+
+from util.misc import NestedTensor
+
+from .transforms import BOX_FIELDS, color_transform, photometric_distort_params, sample_min_iou_crops
+
+
+def _randint(low, high):
+    """
+    Random integers in [low, high], the bounds are tensors of the same shape.
+    """
+    return low + (torch.rand(low.shape, device=low.device, dtype=torch.float64) * (high - low + 1)).long()
+
+
+class AugmentationBatch(object):
+    """
+    A batch of images being augmented.
+
+    Arguments:
+        images (Tensor): [B, C, H, W] uint8 images, padded at the bottom right.
+        targets (list[dict[Tensor]]): the 'size' (height, width) of every target is the
+            size of its image in images.
+
+    Attributes:
+        sizes (Tensor): [B, 2] (width, height) of the augmented images.
+        scale, offset (Tensor): [B, 2] the pixel (x, y) of the augmented image is at
+            scale * (x, y) + offset in the source image.
+        boxes (dict[Tensor]): the box fields of all the targets, concatenated.
+        batch_index (Tensor): image of every box.
+        active (Tensor): [B] images the transforms apply to, see BatchRandomSelect.
+        fill (tuple): color of the pixels out of the source images, see BatchRandomExpand.
+    """
+    def __init__(self, images, targets):
+        device = images.device
+        self.images = images
+        self.source_sizes = torch.stack([t['size'] for t in targets]).to(device).flip(-1)
+        self.sizes = self.source_sizes.clone()
+        self.scale = torch.ones(len(targets), 2, dtype=torch.float64, device=device)
+        self.offset = torch.zeros(len(targets), 2, dtype=torch.float64, device=device)
+        self.active = torch.ones(len(targets), dtype=torch.bool, device=device)
+        self.fill = None
+
+        num_boxes = torch.as_tensor([len(t['boxes']) for t in targets], device=device)
+        self.batch_index = torch.repeat_interleave(torch.arange(len(targets), device=device), num_boxes)
+        self.boxes = {k: torch.cat([t[k] for t in targets]).to(device) for k in BOX_FIELDS if k in targets[0]}
+        self.targets = [{k: v for k, v in t.items() if k not in BOX_FIELDS} for t in targets]
+        if 'masks' in targets[0]:
+            raise ValueError('masks are not supported by the batched transforms')
+
+    def __len__(self):
+        return len(self.targets)
+
+    def filter_boxes(self, keep):
+        for k, v in self.boxes.items():
+            self.boxes[k] = v[keep]
+        self.batch_index = self.batch_index[keep]
+
+    def split_targets(self):
+        num_boxes = torch.bincount(self.batch_index, minlength=len(self)).tolist()
+        fields = {k: v.split(num_boxes) for k, v in self.boxes.items()}
+        targets = []
+        for i, target in enumerate(self.targets):
+            target = target.copy()
+            for k, v in fields.items():
+                target[k] = v[i]
+            w, h = self.sizes[i].tolist()
+            target['size'] = torch.tensor([h, w])
+            targets.append(target)
+        return targets
+
+
+def batch_hflip(batch, flip):
+    """
+    Flips horizontally the images of batch where flip is True.
+    """
+    width = batch.sizes[:, 0].double()
+    batch.offset[:, 0] = torch.where(flip, batch.scale[:, 0] * width + batch.offset[:, 0], batch.offset[:, 0])
+    batch.scale[:, 0] = torch.where(flip, -batch.scale[:, 0], batch.scale[:, 0])
+
+    if 'boxes' in batch.boxes:
+        boxes = batch.boxes['boxes']
+        box_width = width.float()[batch.batch_index, None]
+        flipped_boxes = boxes[:, [2, 1, 0, 3]] * torch.as_tensor([-1, 1, -1, 1], device=boxes.device)
+        flipped_boxes = flipped_boxes + torch.cat([box_width, torch.zeros_like(box_width)] * 2, dim=1)
+        batch.boxes['boxes'] = torch.where(flip[batch.batch_index, None], flipped_boxes, boxes)
+
+
+def batch_resize(batch, sizes, resize):
+    """
+    Resizes the images of batch where resize is True to sizes, [B, 2] (width, height).
+    """
+    sizes = torch.where(resize[:, None], sizes, batch.sizes)
+    ratios = sizes.double() / batch.sizes.double()
+    batch.scale = batch.scale / ratios
+    batch.sizes = sizes
+
+    ratios = ratios.float()[batch.batch_index]
+    if 'boxes' in batch.boxes:
+        batch.boxes['boxes'] = batch.boxes['boxes'] * ratios.repeat(1, 2)
+    if 'area' in batch.boxes:
+        batch.boxes['area'] = batch.boxes['area'] * ratios.prod(dim=1)
+
+
+def _crop_boxes(boxes, batch_index, regions):
+    # regions are [B, 4] (x, y, width, height)
+    region = regions[batch_index].float()
+    cropped_boxes = boxes - region[:, :2].repeat(1, 2)
+    cropped_boxes = torch.min(cropped_boxes.reshape(-1, 2, 2), region[:, None, 2:])
+    cropped_boxes = cropped_boxes.clamp(min=0)
+    return cropped_boxes
+
+
+def batch_crop(batch, regions, crop):
+    """
+    Crops the images of batch where crop is True to regions, [B, 4] (x, y, width, height).
+    The boxes outside of their crop are removed.
+    """
+    regions = torch.where(crop[:, None], regions, torch.cat([torch.zeros_like(batch.sizes), batch.sizes], dim=1))
+    batch.offset = batch.offset + batch.scale * regions[:, :2].double()
+    batch.sizes = regions[:, 2:].clone()
+
+    if 'boxes' in batch.boxes:
+        cropped_boxes = _crop_boxes(batch.boxes['boxes'], batch.batch_index, regions)
+        area = (cropped_boxes[:, 1, :] - cropped_boxes[:, 0, :]).prod(dim=1)
+        batch.boxes['boxes'] = cropped_boxes.reshape(-1, 4)
+        if 'area' in batch.boxes:
+            batch.boxes['area'] = torch.where(crop[batch.batch_index], area, batch.boxes['area'])
+        keep = torch.all(cropped_boxes[:, 1, :] > cropped_boxes[:, 0, :], dim=1)
+        batch.filter_boxes(keep | ~crop[batch.batch_index])
+
+
+class BatchRandomHorizontalFlip(object):
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, batch):
+        flip = torch.rand(len(batch), device=batch.sizes.device) < self.p
+        batch_hflip(batch, flip & batch.active)
+        return batch
+
+
+class BatchResize(object):
+    def __init__(self, size):
+        if isinstance(size, tuple):
+            sizes = size
+            assert len(sizes) == 2, "The length of sizes must be 2"
+        else:
+            sizes = (size, size)
+
+        self.sizes = sizes
+
+    def __call__(self, batch):
+        # (height, width) to (width, height)
+        sizes = torch.as_tensor(self.sizes[::-1], device=batch.sizes.device).expand_as(batch.sizes)
+        batch_resize(batch, sizes, batch.active)
+        return batch
+
+
+class BatchRandomResize(object):
+    """
+    Resizes every image so that its shorter side is a random element of sizes,
+    the longer side is limited to max_size.
+    """
+    def __init__(self, sizes, max_size=None):
+        assert isinstance(sizes, (list, tuple))
+        self.sizes = sizes
+        self.max_size = max_size
+
+    def __call__(self, batch):
+        device = batch.sizes.device
+        choices = torch.as_tensor(self.sizes, dtype=torch.float64, device=device)
+        size = choices[torch.randint(len(self.sizes), (len(batch),), device=device)]
+
+        w, h = batch.sizes.double().unbind(1)
+        min_original_size = torch.min(w, h)
+        max_original_size = torch.max(w, h)
+        if self.max_size is not None:
+            too_large = max_original_size / min_original_size * size > self.max_size
+            size = torch.where(too_large, torch.round(self.max_size * min_original_size / max_original_size), size)
+
+        ow = torch.where(w < h, size, torch.floor(size * w / h))
+        oh = torch.where(w < h, torch.floor(size * h / w), size)
+        unchanged = min_original_size == size
+        sizes = torch.stack([torch.where(unchanged, w, ow), torch.where(unchanged, h, oh)], dim=1).long()
+        batch_resize(batch, sizes, batch.active)
+        return batch
+
+
+class BatchRandomSizeCrop(object):
+    """
+    Crops every image to a random region of width and height in [min_size, max_size] which
+    keeps at least one box. The crops are sampled again for at most max_trials times, the
+    images without any valid crop are left as they are.
+    """
+    def __init__(self, min_size: int, max_size: int, max_trials: int = 50):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_trials = max_trials
+
+    def __call__(self, batch):
+        sizes = batch.sizes
+        min_size = torch.full_like(sizes, self.min_size).min(sizes)
+        max_size = sizes.clamp(max=self.max_size).max(min_size)
+        regions = torch.zeros(len(batch), 4, dtype=torch.long, device=sizes.device)
+        pending = batch.active.clone()
+        found = torch.zeros_like(pending)
+        for _ in range(self.max_trials):
+            crop_sizes = _randint(min_size, max_size)
+            crop_origins = _randint(torch.zeros_like(sizes), sizes - crop_sizes)
+            regions = torch.where(pending[:, None], torch.cat([crop_origins, crop_sizes], dim=1), regions)
+
+            cropped_boxes = _crop_boxes(batch.boxes['boxes'], batch.batch_index, regions)
+            valid = torch.all(cropped_boxes[:, 1, :] > cropped_boxes[:, 0, :], dim=1)
+            num_valid = torch.zeros(len(batch), dtype=torch.long, device=sizes.device)
+            num_valid.index_add_(0, batch.batch_index, valid.long())
+            found = found | (pending & (num_valid > 0))
+            pending = pending & ~found
+            if not pending.any():
+                break
+
+        batch_crop(batch, regions, found)
+        return batch
+
+
+class BatchRandomExpand(object):
+    """
+    Zoom out of SSD, see transforms.RandomExpand. The canvas is only filled by BatchToTensor.
+    """
+    def __init__(self, max_ratio=4., fill=(124, 116, 104), p=0.5):
+        self.max_ratio = max_ratio
+        self.fill = fill
+        self.p = p
+
+    def __call__(self, batch):
+        sizes = batch.sizes
+        expand = batch.active & (torch.rand(len(batch), device=sizes.device) < self.p)
+        ratios = 1 + (self.max_ratio - 1) * torch.rand(len(batch), 1, dtype=torch.float64, device=sizes.device)
+        expanded_sizes = (sizes * ratios).long()
+        origins = _randint(torch.zeros_like(sizes), expanded_sizes - sizes)
+        origins = torch.where(expand[:, None], origins, torch.zeros_like(origins))
+
+        batch.offset = batch.offset - batch.scale * origins.double()
+        batch.sizes = torch.where(expand[:, None], expanded_sizes, sizes)
+        batch.fill = self.fill
+        if 'boxes' in batch.boxes:
+            batch.boxes['boxes'] = batch.boxes['boxes'] + origins.float()[batch.batch_index].repeat(1, 2)
+        return batch
+
+
+class BatchMinIoURandomCrop(object):
+    """
+    Crop of SSD, see transforms.MinIoURandomCrop. The crops of all the images are sampled at once.
+    """
+    def __init__(self, min_ious=(0.1, 0.3, 0.5, 0.7, 0.9), min_scale=0.3, num_candidates=50):
+        self.modes = (float('nan'), 0.) + tuple(min_ious)
+        self.min_scale = min_scale
+        self.num_candidates = num_candidates
+
+    def __call__(self, batch):
+        device = batch.sizes.device
+        modes = torch.as_tensor(self.modes, device=device)
+        min_ious = modes[torch.randint(len(self.modes), (len(batch),), device=device)]
+        boxes = batch.boxes['boxes']
+        regions, found = sample_min_iou_crops(
+            boxes, batch.batch_index, batch.sizes, min_ious,
+            min_scale=self.min_scale, num_candidates=self.num_candidates,
+        )
+        # nan is no crop
+        crop = batch.active & found & ~min_ious.isnan()
+
+        region = regions[batch.batch_index]
+        centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+        inside = ((centers > region[:, :2]) & (centers < region[:, :2] + region[:, 2:])).all(dim=1)
+        batch.filter_boxes(inside | ~crop[batch.batch_index])
+        batch_crop(batch, regions, crop)
+        return batch
+
+
+class BatchRandomSelect(object):
+    """
+    Randomly selects between transforms1 and transforms2 for every image,
+    with probability p for transforms1 and (1 - p) for transforms2
+    """
+    def __init__(self, transforms1, transforms2, p=0.5):
+        self.transforms1 = transforms1
+        self.transforms2 = transforms2
+        self.p = p
+
+    def __call__(self, batch):
+        active = batch.active
+        select = torch.rand(len(batch), device=active.device) < self.p
+        batch.active = active & select
+        batch = self.transforms1(batch)
+        batch.active = active & ~select
+        batch = self.transforms2(batch)
+        batch.active = active
+        return batch
+
+
+class BatchToTensor(object):
+    """
+    Resamples the images with their affine maps, they must all have the same size, and
+    converts them to float in [0, 1]. The pixels out of an image repeat its border, the
+    pixels at the border of a crop interpolate the source pixels around the crop.
+    """
+    def __call__(self, batch):
+        images = batch.images
+        out_width, out_height = batch.sizes[0].tolist()
+        source_sizes = batch.source_sizes.double()
+        assert (batch.sizes == batch.sizes[0]).all(), 'the images of a batch must have the same size'
+
+        # theta maps the normalized coordinates of the output to the ones of the padded images
+        padded_size = torch.as_tensor([images.shape[-1], images.shape[-2]], dtype=torch.float64, device=images.device)
+        out_size = batch.sizes[0].double()
+        theta = torch.zeros(len(batch), 2, 3, dtype=torch.float64, device=images.device)
+        theta[:, 0, 0] = batch.scale[:, 0] * out_size[0] / padded_size[0]
+        theta[:, 1, 1] = batch.scale[:, 1] * out_size[1] / padded_size[1]
+        theta[:, :, 2] = (batch.scale * out_size + 2 * batch.offset) / padded_size - 1
+
+        grid = F.affine_grid(theta.float(), [len(batch), images.shape[1], out_height, out_width], align_corners=False)
+        outside = None
+        if batch.fill is not None:
+            high = 2 * source_sizes / padded_size - 1
+            outside = ((grid < -1) | (grid > high.float()[:, None, None])).any(dim=-1)
+        # clamp to the centers of the border pixels of every image
+        low = 1 / padded_size - 1
+        high = 2 * (source_sizes - 0.5) / padded_size - 1
+        grid = torch.max(torch.min(grid, high.float()[:, None, None]), low.float())
+
+        images = F.grid_sample(images.float(), grid, mode='bilinear', padding_mode='border', align_corners=False)
+        if outside is not None:
+            fill = torch.as_tensor(batch.fill, dtype=images.dtype, device=images.device)
+            images = torch.where(outside[:, None], fill[:, None, None], images)
+        batch.images = images / 255
+        return batch
+
+
+class BatchPhotometricDistort(object):
+    """
+    Photometric distortion of SSD on the float images of BatchToTensor, see
+    transforms.photometric_distort_params for the arguments.
+    """
+    def __init__(self, brightness=32. / 255, contrast=(0.5, 1.5), saturation=(0.5, 1.5), hue=18., p=0.5):
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+        self.p = p
+
+    def __call__(self, batch):
+        device = batch.images.device
+        matrix, bias = photometric_distort_params(
+            len(batch), self.brightness, self.contrast, self.saturation, self.hue, self.p, device=device)
+        matrix = torch.where(batch.active[:, None, None], matrix, torch.eye(3, device=device))
+        bias = torch.where(batch.active[:, None], bias, torch.zeros_like(bias))
+        batch.images = color_transform(batch.images, matrix, bias)
+        return batch
+
+
+class BatchNormalize(object):
+    def __init__(self, mean, std):
+        self.mean = mean
+        self.std = std
+
+    def __call__(self, batch):
+        images = batch.images
+        mean = torch.as_tensor(self.mean, dtype=images.dtype, device=images.device)
+        std = torch.as_tensor(self.std, dtype=images.dtype, device=images.device)
+        batch.images = (images - mean[:, None, None]) / std[:, None, None]
+        if 'boxes' in batch.boxes:
+            # converted to XYXY_REL BoxMode
+            sizes = batch.sizes.float()[batch.batch_index]
+            batch.boxes['boxes'] = batch.boxes['boxes'] / sizes.repeat(1, 2)
+        return batch
+
+
+class BatchCompose(object):
+    """
+    Applies the batched transforms to a batch of the DataLoader, of uint8 images.
+
+    Returns:
+        samples (NestedTensor): the float images, without mask.
+        targets (list[dict[Tensor]]): the updated targets.
+    """
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, samples, targets):
+        images = samples.tensors if isinstance(samples, NestedTensor) else samples
+        with torch.no_grad():
+            batch = AugmentationBatch(images, targets)
+            for t in self.transforms:
+                batch = t(batch)
+        return NestedTensor(batch.images, None), batch.split_targets()
+
+    def __repr__(self):
+        format_string = self.__class__.__name__ + "("
+        for t in self.transforms:
+            format_string += "\n"
+            format_string += "    {0}".format(t)
+        format_string += "\n)"
+        return format_string
+
+
+class _BatchCompose(object):
+    # nested compositions, inside a BatchRandomSelect
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, batch):
+        for t in self.transforms:
+            batch = t(batch)
+        return batch
+
+
+def make_batch_transforms(image_set='train', image_size=300, augmentation='ssd'):
+    """
+    Batched counterpart of make_voc_transforms and make_coco_transforms.
+    """
+    normalize = BatchNormalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+
+    if (image_set == 'train' or image_set == 'trainval') and augmentation == 'ssd':
+        return BatchCompose([
+            BatchRandomExpand(),
+            BatchMinIoURandomCrop(),
+            BatchRandomHorizontalFlip(),
+            BatchResize(image_size),
+            BatchToTensor(),
+            BatchPhotometricDistort(),
+            normalize,
+        ])
+    elif image_set == 'train' or image_set == 'trainval':
+        return BatchCompose([
+            BatchRandomHorizontalFlip(),
+            BatchRandomSelect(
+                BatchResize(image_size),
+                _BatchCompose([
+                    BatchRandomResize([400, 500, 600]),
+                    BatchRandomSizeCrop(384, 600),
+                    BatchResize(image_size),
+                ])
+            ),
+            BatchToTensor(),
+            normalize,
+        ])
+    elif image_set == 'val' or image_set == 'test':
+        return BatchCompose([
+            BatchResize(image_size),
+            BatchToTensor(),
+            normalize,
+        ])
+    else:
+        raise ValueError(f'unknown {image_set}')
@@ -12,14 +12,16 @@ import torchvision
 from pycocotools import mask as coco_mask
 
 from . import transforms as T
+from .image_cache import build_image_cache, cache_image_size
 
 
 class ConvertCocoPolysToMask(object):
     def __init__(self, return_masks=False):
         self.return_masks = return_masks
 
-    def __call__(self, image, target):
-        w, h = image.size
+    def __call__(self, image, target, image_size=None):
+        # image_size is the (width, height) of the original image when image is a resized copy
+        w, h = image.size if image_size is None else image_size
 
         image_id = target["image_id"]
         image_id = torch.tensor([image_id])
@@ -85,12 +87,25 @@ class CocoDetection(torchvision.datasets.CocoDetection):
         super().__init__(img_folder, ann_file)
         self._transforms = transforms
         self.prepare = ConvertCocoPolysToMask(return_masks)
+        # ImageCache of the decoded images, see build_image_cache
+        self.image_cache = None
+
+    def load_image(self, idx):
+        return self._load_image(self.ids[idx])
 
     def __getitem__(self, idx):
-        img, target = super().__getitem__(idx)
         image_id = self.ids[idx]
-        target = {'image_id': image_id, 'annotations': target}
-        img, target = self.prepare(img, target)
+        if self.image_cache is None:
+            img, target = super().__getitem__(idx)
+            target = {'image_id': image_id, 'annotations': target}
+            img, target = self.prepare(img, target)
+        else:
+            img = self.image_cache[idx]
+            target = {'image_id': image_id, 'annotations': self._load_target(image_id)}
+            # the annotations are in the pixels of the original image
+            image_size = (self.coco.imgs[image_id]['width'], self.coco.imgs[image_id]['height'])
+            img, target = self.prepare(img, target, image_size=image_size)
+            target = T.resize_target(target, image_size, img.size)
         if self._transforms is not None:
             img, target = self._transforms(img, target)
         return img, target
@@ -153,14 +168,33 @@ def _coco_remove_images_without_annotations(dataset, cat_list=None):
     return dataset
 
 
-def make_coco_transforms(image_set, image_size=300):
+def make_coco_transforms(image_set, image_size=300, batch_augment=False, augmentation='ssd'):
+    """
+    The training images are augmented by the photometric distortion, zoom out and crop of SSD
+    with augmentation='ssd', or by the random resize and crop of DETR with augmentation='detr'.
+
+    With batch_augment, the images are only converted to uint8 tensors, the transforms
+    run on the batches, see datasets.batch_transforms.make_batch_transforms.
+    """
+    if batch_augment:
+        return T.Compose([T.PILToTensor()])
 
     normalize = T.Compose([
         T.ToTensor(),
         T.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
     ])
 
-    if image_set == 'train' or image_set == 'trainval':
+    if (image_set == 'train' or image_set == 'trainval') and augmentation == 'ssd':
+        return T.Compose([
+            T.RandomExpand(),
+            T.MinIoURandomCrop(),
+            T.RandomHorizontalFlip(),
+            T.Resize(image_size),
+            T.ToTensor(),
+            T.PhotometricDistort(),
+            T.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+        ])
+    elif image_set == 'train' or image_set == 'trainval':
         return T.Compose([
             T.RandomHorizontalFlip(),
             T.RandomSelect(
@@ -182,7 +216,10 @@ def make_coco_transforms(image_set, image_size=300):
         raise ValueError(f'unknown {image_set}')
 
 
-def build(image_set, year, args):
+def build(image_set, year, args, eval_transforms=False):
+    """
+    With eval_transforms, the images of image_set get the transforms of the evaluation.
+    """
     root = Path(args.data_path)
     assert root.exists(), f'provided COCO path {root} does not exist'
     mode = args.dataset_mode
@@ -194,10 +231,20 @@ def build(image_set, year, args):
     dataset = CocoDetection(
         img_folder,
         ann_file,
-        transforms=make_coco_transforms(image_set, image_size=args.image_size),
+        transforms=make_coco_transforms(
+            'val' if eval_transforms else image_set,
+            image_size=args.image_size,
+            batch_augment=args.batch_augment,
+            augmentation=args.augmentation,
+        ),
         return_masks=args.masks,
     )
 
+    if args.image_cache:
+        size = cache_image_size(image_set, args.image_size)
+        path = os.path.join(args.image_cache, f'coco_{mode}_{image_set}{year}_{args.image_size}')
+        dataset.image_cache = build_image_cache(dataset, path, size, num_workers=args.num_workers)
+
     if image_set == 'train':
         dataset = _coco_remove_images_without_annotations(dataset)
 
@@ -0,0 +1,126 @@
+# Copyright (c) 2020, Zhiqiang Wang. All Rights Reserved.
+"""
+On-disk cache of decoded and resized images, so that the JPEG files are decoded only once.
+"""
+import os
+
+import numpy as np
+from PIL import Image
+
+import torch
+import torch.distributed as dist
+import torchvision.transforms.functional as F
+
+from util.misc import is_dist_avail_and_initialized, is_main_process
+
+
+def cache_image_size(image_set, image_size):
+    """
+    Size of the cached images of a split. The evaluation transforms resize the images to
+    image_size x image_size, so they are cached at this size and the transforms see the
+    same pixels as without cache. The training images are only shrunk to a shorter side
+    of 600, the largest size of the RandomResize augmentation.
+    """
+    if image_set in ('val', 'test'):
+        return (image_size, image_size)
+    return max(600, image_size)
+
+
+def _resize(image, size):
+    if isinstance(size, (list, tuple)):
+        return F.resize(image, list(size))
+    if min(image.size) <= size:
+        return image
+    return F.resize(image, size)
+
+
+class _DecodeDataset(torch.utils.data.Dataset):
+    def __init__(self, load_image, num_images, size):
+        self.load_image = load_image
+        self.num_images = num_images
+        self.size = size
+
+    def __len__(self):
+        return self.num_images
+
+    def __getitem__(self, index):
+        return np.array(_resize(self.load_image(index), self.size), dtype=np.uint8)
+
+
+class ImageCache(object):
+    """
+    Read only cache of RGB images, stored as uint8 HWC arrays one after another in the
+    single file {path}.bin. The file is memory mapped and {path}.idx.npy holds the offset,
+    the height and the width of every image.
+
+    Arguments:
+        path (str): path of the cache files, without extension.
+    """
+    def __init__(self, path):
+        self.data_file = path + '.bin'
+        self.index = np.load(path + '.idx.npy')
+        # opened lazily, so that every DataLoader worker maps the file itself
+        self._data = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, index):
+        if self._data is None:
+            self._data = np.memmap(self.data_file, dtype=np.uint8, mode='r')
+        offset, height, width = self.index[index]
+        image = self._data[offset:offset + height * width * 3].reshape(height, width, 3)
+        return Image.fromarray(image)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(path + '.idx.npy')
+
+    @staticmethod
+    def build(path, load_image, num_images, size, num_workers=0):
+        """
+        Decodes the num_images images of load_image(index), resizes them and writes them
+        to the cache files of path.
+
+        Arguments:
+            load_image (callable): returns the PIL image of an index.
+            size (int or tuple): (height, width) of the cached images, or the largest
+                shorter side of the cached images, whose aspect ratio is kept.
+            num_workers (int): number of processes decoding the images.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        data_loader = torch.utils.data.DataLoader(
+            _DecodeDataset(load_image, num_images, size),
+            batch_size=None,
+            num_workers=num_workers,
+        )
+        index = np.zeros((num_images, 3), dtype=np.int64)
+        offset = 0
+        with open(path + '.bin.tmp', 'wb') as f:
+            for i, image in enumerate(data_loader):
+                image = image.numpy()
+                f.write(image.tobytes())
+                index[i] = offset, image.shape[0], image.shape[1]
+                offset += image.size
+        np.save(path + '.idx.tmp.npy', index)
+        # the index is written last, its presence means that the cache is complete
+        os.replace(path + '.bin.tmp', path + '.bin')
+        os.replace(path + '.idx.tmp.npy', path + '.idx.npy')
+
+
+def build_image_cache(dataset, path, size, num_workers=0):
+    """
+    Returns the ImageCache of dataset at path, it is built from dataset.load_image on first use.
+    In distributed mode, the main process builds it while the others wait.
+    """
+    if not ImageCache.exists(path) and is_main_process():
+        print(f"Caching the {len(dataset)} images of {path}")
+        ImageCache.build(path, dataset.load_image, len(dataset), size, num_workers=num_workers)
+    if is_dist_avail_and_initialized():
+        dist.barrier()
+    return ImageCache(path)
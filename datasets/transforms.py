@@ -4,13 +4,19 @@ Transforms and data augmentation for both image + bbox.
 """
 import random
 
+import math
+
 import PIL
 import torch
 import torchvision.transforms as T
 import torchvision.transforms.functional as F
 
+from util.box_ops import box_iou
 from util.misc import interpolate
 
+# fields of the targets with one element per box
+BOX_FIELDS = ('boxes', 'labels', 'area', 'iscrowd', 'ishard')
+
 
 def crop(image, target, region):
     cropped_image = F.crop(image, *region)
@@ -107,7 +113,15 @@ def resize(image, target, size, max_size=None):
     if target is None:
         return rescaled_image, None
 
-    ratios = tuple(float(s) / float(s_orig) for s, s_orig in zip(rescaled_image.size, image.size))
+    return rescaled_image, resize_target(target, image.size, rescaled_image.size)
+
+
+def resize_target(target, image_size, rescaled_size):
+    """
+    Rescales the boxes, areas and masks of target from an image of image_size to an image
+    of rescaled_size, both sizes are (width, height).
+    """
+    ratios = tuple(float(s) / float(s_orig) for s, s_orig in zip(rescaled_size, image_size))
     ratio_width, ratio_height = ratios
 
     target = target.copy()
@@ -121,14 +135,14 @@ def resize(image, target, size, max_size=None):
         scaled_area = area * (ratio_width * ratio_height)
         target["area"] = scaled_area
 
-    h, w = size
+    w, h = rescaled_size
     target["size"] = torch.tensor([h, w])
 
     if "masks" in target:
         target['masks'] = interpolate(
-            target['masks'][:, None].float(), size, mode="nearest")[:, 0] > 0.5
+            target['masks'][:, None].float(), (h, w), mode="nearest")[:, 0] > 0.5
 
-    return rescaled_image, target
+    return target
 
 
 def pad(image, target, padding):
@@ -144,6 +158,133 @@ def pad(image, target, padding):
     return padded_image, target
 
 
+def expand(image, target, region, fill):
+    """
+    Places image at (left, top) of a canvas of (width, height) filled with fill,
+    region is (left, top, width, height).
+    """
+    left, top, width, height = region
+    expanded_image = PIL.Image.new(image.mode, (width, height), fill)
+    expanded_image.paste(image, (left, top))
+
+    target = target.copy()
+    target["size"] = torch.tensor([height, width])
+    if "boxes" in target:
+        target["boxes"] = target["boxes"] + torch.as_tensor([left, top, left, top], dtype=torch.float32)
+    if "masks" in target:
+        w, h = image.size
+        target['masks'] = torch.nn.functional.pad(target['masks'], (left, width - w - left, top, height - h - top))
+    return expanded_image, target
+
+
+def sample_min_iou_crops(boxes, batch_index, sizes, min_ious, min_scale=0.3, num_candidates=50):
+    """
+    Samples num_candidates random crops for every image of a batch at once, and returns the
+    first one whose IoU with each box of the image is at least its min_iou and which contains
+    the center of at least one box.
+
+    The sides of the crops are in [min_scale, 1] times the sides of the image, with an aspect
+    ratio in [0.5, 2].
+
+    Arguments:
+        boxes (Tensor): [M, 4] boxes of all the images.
+        batch_index (Tensor): [M] image of every box.
+        sizes (Tensor): [B, 2] (width, height) of the images.
+        min_ious (Tensor): [B] minimum IoU of every image.
+
+    Returns:
+        regions (Tensor): [B, 4] (x, y, width, height) of the crops.
+        found (Tensor): [B] whether a valid crop was found for every image.
+    """
+    device = sizes.device
+    num_images = len(sizes)
+    scales = min_scale + (1 - min_scale) * torch.rand(num_images, num_candidates, 2, dtype=torch.float64, device=device)
+    crop_sizes = (scales * sizes[:, None].double()).long().clamp(min=1)
+    origins = (torch.rand(crop_sizes.shape, dtype=torch.float64, device=device)
+               * (sizes[:, None] - crop_sizes + 1)).long()
+    candidates = torch.cat([origins, origins + crop_sizes], dim=-1).float()
+    aspect_ratios = crop_sizes[..., 1].double() / crop_sizes[..., 0].double()
+    valid = (aspect_ratios >= 0.5) & (aspect_ratios <= 2)
+
+    # [B, M] boxes of every image
+    own_boxes = batch_index == torch.arange(num_images, device=device)[:, None]
+    iou, _ = box_iou(candidates.reshape(-1, 4), boxes)
+    iou = iou.reshape(num_images, num_candidates, -1)
+    valid &= ((iou >= min_ious[:, None, None]) | ~own_boxes[:, None]).all(dim=-1)
+
+    centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+    inside = (centers > candidates[..., None, :2]) & (centers < candidates[..., None, 2:])
+    valid &= (inside.all(dim=-1) & own_boxes[:, None]).any(dim=-1)
+
+    found = valid.any(dim=1)
+    first = valid.byte().argmax(dim=1)
+    regions = torch.cat([origins, crop_sizes], dim=-1)[torch.arange(num_images, device=device), first]
+    return regions, found
+
+
+def photometric_distort_params(num_images, brightness=32. / 255, contrast=(0.5, 1.5), saturation=(0.5, 1.5),
+                               hue=18., p=0.5, device=None):
+    """
+    Samples the SSD photometric distortion of num_images images as color transforms
+    x * matrix^T + bias of the RGB pixels in [0, 1]:
+
+        a random brightness delta, contrast factor, saturation factor, hue rotation in
+        degrees and channel permutation, each one applied with probability p.
+
+    The saturation is a blend with the luma and the hue a rotation in the YIQ space, so
+    that the whole distortion is linear and is applied at once, without intermediate
+    clamping.
+
+    Returns:
+        matrix (Tensor): [num_images, 3, 3]
+        bias (Tensor): [num_images, 3]
+    """
+    def uniform(low, high):
+        return low + (high - low) * torch.rand(num_images, device=device)
+
+    def apply(values, identity):
+        return torch.where(torch.rand(num_images, device=device) < p, values, torch.full_like(values, identity))
+
+    eye = torch.eye(3, device=device)
+    delta = apply(uniform(-brightness, brightness), 0.)
+    alpha = apply(uniform(*contrast), 1.)
+    sat = apply(uniform(*saturation), 1.)
+    theta = apply(uniform(-hue, hue), 0.) * math.pi / 180
+
+    luma = torch.as_tensor([0.299, 0.587, 0.114], device=device)
+    saturation_matrix = sat[:, None, None] * eye + (1 - sat)[:, None, None] * luma.expand(3, 3)
+
+    rgb_to_yiq = torch.as_tensor([[0.299, 0.587, 0.114],
+                                  [0.596, -0.274, -0.322],
+                                  [0.211, -0.523, 0.312]], device=device)
+    cos, sin = theta.cos(), theta.sin()
+    rotation = eye.repeat(num_images, 1, 1)
+    rotation[:, 1, 1], rotation[:, 1, 2] = cos, -sin
+    rotation[:, 2, 1], rotation[:, 2, 2] = sin, cos
+    hue_matrix = torch.linalg.inv(rgb_to_yiq) @ rotation @ rgb_to_yiq
+
+    permutations = torch.where(
+        (torch.rand(num_images, device=device) < p)[:, None],
+        torch.rand(num_images, 3, device=device).argsort(dim=1),
+        torch.arange(3, device=device),
+    )
+    permutation_matrix = eye[permutations]
+
+    matrix = alpha[:, None, None] * permutation_matrix @ hue_matrix @ saturation_matrix
+    bias = matrix.sum(dim=2) * delta[:, None]
+    return matrix, bias
+
+
+def color_transform(images, matrix, bias):
+    """
+    Applies the color transforms of photometric_distort_params to the [N, 3, H, W] float
+    images in [0, 1].
+    """
+    images = torch.einsum('nij,njhw->nihw', matrix.to(images.dtype), images)
+    images = images + bias.to(images.dtype)[:, :, None, None]
+    return images.clamp_(0, 1)
+
+
 class RandomCrop(object):
     def __init__(self, size):
         self.size = size
@@ -226,6 +367,65 @@ class RandomPad(object):
         return pad(img, target, (pad_x, pad_y))
 
 
+class RandomExpand(object):
+    """
+    Zoom out of SSD, places the image at a random position of a canvas filled with fill,
+    whose sides are up to max_ratio times larger.
+    """
+    def __init__(self, max_ratio=4., fill=(124, 116, 104), p=0.5):
+        self.max_ratio = max_ratio
+        self.fill = fill
+        self.p = p
+
+    def __call__(self, img, target):
+        if random.random() >= self.p:
+            return img, target
+        ratio = random.uniform(1, self.max_ratio)
+        width, height = int(img.width * ratio), int(img.height * ratio)
+        left = random.randint(0, width - img.width)
+        top = random.randint(0, height - img.height)
+        return expand(img, target, (left, top, width, height), self.fill)
+
+
+class MinIoURandomCrop(object):
+    """
+    Crop of SSD, picks at random either no crop or a minimal IoU in min_ious or 0 with all the
+    boxes, then crops the image to one of num_candidates random crops satisfying it, see
+    sample_min_iou_crops. The boxes whose center is out of the crop are removed. The image is
+    left as it is if none of the candidates is valid.
+    """
+    def __init__(self, min_ious=(0.1, 0.3, 0.5, 0.7, 0.9), min_scale=0.3, num_candidates=50):
+        self.modes = (None, 0.) + tuple(min_ious)
+        self.min_scale = min_scale
+        self.num_candidates = num_candidates
+
+    def __call__(self, img, target):
+        min_iou = random.choice(self.modes)
+        boxes = target['boxes']
+        if min_iou is None or len(boxes) == 0:
+            return img, target
+
+        regions, found = sample_min_iou_crops(
+            boxes,
+            torch.zeros(len(boxes), dtype=torch.int64),
+            torch.as_tensor([img.size]),
+            torch.as_tensor([min_iou]),
+            min_scale=self.min_scale,
+            num_candidates=self.num_candidates,
+        )
+        if not found[0]:
+            return img, target
+
+        x, y, w, h = regions[0].tolist()
+        centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+        keep = ((centers > torch.as_tensor([x, y])) & (centers < torch.as_tensor([x + w, y + h]))).all(dim=1)
+        target = target.copy()
+        for field in BOX_FIELDS + ('masks',):
+            if field in target:
+                target[field] = target[field][keep]
+        return crop(img, target, (y, x, h, w))
+
+
 class RandomSelect(object):
     """
     Randomly selects between transforms1 and transforms2,
@@ -247,6 +447,33 @@ class ToTensor(object):
         return F.to_tensor(img), target
 
 
+class PILToTensor(object):
+    """
+    Converts the image to an uint8 CHW tensor, for the batched transforms of
+    datasets/batch_transforms.py.
+    """
+    def __call__(self, img, target):
+        return F.pil_to_tensor(img), target
+
+
+class PhotometricDistort(object):
+    """
+    Photometric distortion of SSD on the float image of ToTensor, see
+    photometric_distort_params for the arguments.
+    """
+    def __init__(self, brightness=32. / 255, contrast=(0.5, 1.5), saturation=(0.5, 1.5), hue=18., p=0.5):
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+        self.p = p
+
+    def __call__(self, img, target):
+        matrix, bias = photometric_distort_params(
+            1, self.brightness, self.contrast, self.saturation, self.hue, self.p)
+        return color_transform(img[None], matrix, bias)[0], target
+
+
 class RandomErasing(object):
 
     def __init__(self, *args, **kwargs):
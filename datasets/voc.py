@@ -1,7 +1,14 @@
+import os
+from xml.etree.ElementTree import parse as ET_parse
+
+from PIL import Image
+
 import torch
 import torchvision
 
 from . import transforms as T
+from .annotation_index import build_annotation_index
+from .image_cache import build_image_cache, cache_image_size
 
 
 class ConvertVOCtoCOCO(object):
@@ -59,28 +66,71 @@ class VOCDetection(torchvision.datasets.VOCDetection):
         super().__init__(img_folder, year=year, image_set=image_set)
         self._transforms = transforms
         self.prepare = ConvertVOCtoCOCO()
+        # ImageCache of the decoded images, see build_image_cache
+        self.image_cache = None
+        # VOCAnnotationIndex of the parsed annotations, see build_annotation_index
+        self.annotation_index = None
 
-    def __getitem__(self, index):
-        img, target = super().__getitem__(index)
+    def load_image(self, index):
+        return Image.open(self.images[index]).convert('RGB')
+
+    def load_target(self, index):
+        target = self.parse_voc_xml(ET_parse(self.annotations[index]).getroot())
         target = {
             'image_id': index,
             'annotations': target['annotation'],
         }
-        img, target = self.prepare(img, target)
+        _, target = self.prepare(None, target)
+        return target
+
+    def __getitem__(self, index):
+        if self.image_cache is None:
+            img = self.load_image(index)
+        else:
+            img = self.image_cache[index]
+
+        if self.annotation_index is None:
+            target = self.load_target(index)
+        else:
+            target = self.annotation_index[index]
+
+        if self.image_cache is not None:
+            # the annotations are in the pixels of the original image
+            height, width = target['orig_size'].tolist()
+            target = T.resize_target(target, (width, height), img.size)
         if self._transforms is not None:
             img, target = self._transforms(img, target)
 
         return img, target
 
 
-def make_voc_transforms(image_set='train', image_size=300):
+def make_voc_transforms(image_set='train', image_size=300, batch_augment=False, augmentation='ssd'):
+    """
+    The training images are augmented by the photometric distortion, zoom out and crop of SSD
+    with augmentation='ssd', or by the random resize and crop of DETR with augmentation='detr'.
+
+    With batch_augment, the images are only converted to uint8 tensors, the transforms
+    run on the batches, see datasets.batch_transforms.make_batch_transforms.
+    """
+    if batch_augment:
+        return T.Compose([T.PILToTensor()])
 
     normalize = T.Compose([
         T.ToTensor(),
         T.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
     ])
 
-    if image_set == 'train' or image_set == 'trainval':
+    if (image_set == 'train' or image_set == 'trainval') and augmentation == 'ssd':
+        return T.Compose([
+            T.RandomExpand(),
+            T.MinIoURandomCrop(),
+            T.RandomHorizontalFlip(),
+            T.Resize(image_size),
+            T.ToTensor(),
+            T.PhotometricDistort(),
+            T.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+        ])
+    elif image_set == 'train' or image_set == 'trainval':
         return T.Compose([
             T.RandomHorizontalFlip(),
             T.RandomSelect(
@@ -102,16 +152,29 @@ def make_voc_transforms(image_set='train', image_size=300):
         raise ValueError(f'unknown {image_set}')
 
 
-def build(image_set, year, args):
-
+def build(image_set, year, args, eval_transforms=False):
+    """
+    With eval_transforms, the images of image_set get the transforms of the evaluation.
+    """
     dataset = VOCDetection(
         img_folder=args.data_path,
         year=year,
         image_set=image_set,
         transforms=make_voc_transforms(
-            image_set=image_set,
+            image_set='val' if eval_transforms else image_set,
             image_size=args.image_size,
+            batch_augment=args.batch_augment,
+            augmentation=args.augmentation,
         ),
     )
 
+    if args.annotation_index:
+        path = os.path.join(args.annotation_index, f'voc{year}_{image_set}')
+        dataset.annotation_index = build_annotation_index(dataset, path)
+
+    if args.image_cache:
+        size = cache_image_size(image_set, args.image_size)
+        path = os.path.join(args.image_cache, f'voc{year}_{image_set}_{args.image_size}')
+        dataset.image_cache = build_image_cache(dataset, path, size, num_workers=args.num_workers)
+
     return dataset
@@ -1,6 +1,7 @@
 import xml.etree.ElementTree as ET
 import os
 import shutil
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 
@@ -92,8 +93,8 @@ def voc_eval(detpath, annopath, imagesetfile, classname, ovthresh=0.5, use_07_me
     for imagename in imagenames:
         R = [obj for obj in recs[imagename] if obj["name"] == classname]
         bbox = np.array([x["bbox"] for x in R])
-        difficult = np.array([x["difficult"] for x in R]).astype(np.bool)
-        # difficult = np.array([False for x in R]).astype(np.bool)  # treat all "difficult" as GT
+        difficult = np.array([x["difficult"] for x in R]).astype(bool)
+        # difficult = np.array([False for x in R]).astype(bool)  # treat all "difficult" as GT
         det = [False] * len(R)
         npos = npos + sum(~difficult)
         class_recs[imagename] = {"bbox": bbox, "difficult": difficult, "det": det}
@@ -166,6 +167,210 @@ def voc_eval(detpath, annopath, imagesetfile, classname, ovthresh=0.5, use_07_me
     return rec, prec, ap
 
 
+def _round_as_results_file(values, decimals):
+    """
+    Rounds values as the text format of the results files read by voc_eval, to the nearest
+    float of the decimal rounding. rint is exact except close to the halfway cases, which
+    are formatted as text.
+    """
+    scale = 10. ** decimals
+    scaled = values * scale
+    rounded = np.rint(scaled) / scale
+    halfway = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    rounded[halfway] = np.char.mod(f'%.{decimals}f', values[halfway]).astype(np.float64)
+    return rounded
+
+
+def voc_eval_class(gt_image_ids, gt_boxes, gt_difficult, det_image_ids, det_scores, det_boxes,
+                   ovthresh=0.5, use_07_metric=False):
+    """
+    Vectorized voc_eval of one class, on arrays instead of files.
+
+    Arguments:
+        gt_image_ids (ndarray): [G] image index of every ground truth box, in the order
+            of the annotations.
+        gt_boxes (ndarray): [G, 4] ground truth boxes, in the 1-based pixels of the
+            annotations.
+        gt_difficult (ndarray): [G] whether every ground truth box is difficult.
+        det_image_ids (ndarray): [D] image index of every detection, in the order of the
+            results file.
+        det_scores (ndarray): [D] confidence of the detections.
+        det_boxes (ndarray): [D, 4] detected boxes, in the 1-based pixels.
+
+    Returns the same rec, prec and ap as voc_eval.
+    """
+    npos = np.sum(~gt_difficult)
+
+    # the ground truth boxes of every image, padded to the largest number per image
+    num_images = max(gt_image_ids.max(initial=-1), det_image_ids.max(initial=-1)) + 1
+    order = np.argsort(gt_image_ids, kind='stable')
+    gt_image_ids, gt_boxes, gt_difficult = gt_image_ids[order], gt_boxes[order], gt_difficult[order]
+    counts = np.bincount(gt_image_ids, minlength=num_images)
+    ranks = np.arange(len(gt_image_ids)) - (np.cumsum(counts) - counts)[gt_image_ids]
+    max_count = max(counts.max(initial=0), 1)
+    padded_boxes = np.zeros((num_images, max_count, 4))
+    padded_boxes[gt_image_ids, ranks] = gt_boxes
+    padded_difficult = np.zeros((num_images, max_count), dtype=bool)
+    padded_difficult[gt_image_ids, ranks] = gt_difficult
+    valid = np.zeros((num_images, max_count), dtype=bool)
+    valid[gt_image_ids, ranks] = True
+
+    # sort by confidence
+    sorted_ind = np.argsort(-det_scores)
+    BB = det_boxes[sorted_ind, :]
+    image_ids = det_image_ids[sorted_ind]
+
+    # overlaps of every detection with the ground truth boxes of its image, as in voc_eval
+    BBGT = padded_boxes[image_ids]
+    bb = BB[:, None, :]
+    ixmin = np.maximum(BBGT[..., 0], bb[..., 0])
+    iymin = np.maximum(BBGT[..., 1], bb[..., 1])
+    ixmax = np.minimum(BBGT[..., 2], bb[..., 2])
+    iymax = np.minimum(BBGT[..., 3], bb[..., 3])
+    iw = np.maximum(ixmax - ixmin + 1.0, 0.0)
+    ih = np.maximum(iymax - iymin + 1.0, 0.0)
+    inters = iw * ih
+    area_bb = (bb[..., 2] - bb[..., 0] + 1.0) * (bb[..., 3] - bb[..., 1] + 1.0)
+    area_BBGT = (BBGT[..., 2] - BBGT[..., 0] + 1.0) * (BBGT[..., 3] - BBGT[..., 1] + 1.0)
+    unions = area_bb + area_BBGT - inters
+    overlaps = np.where(valid[image_ids], inters / unions, -np.inf)
+    ovmax = overlaps.max(axis=1, initial=-np.inf)
+    jmax = overlaps.argmax(axis=1)
+
+    # greedy matching, the first detection of a ground truth box is a true positive,
+    # the next ones are false positives and the detections of difficult boxes are ignored
+    matched = ovmax > ovthresh
+    candidates = np.flatnonzero(matched & ~padded_difficult[image_ids, jmax])
+    _, first = np.unique(image_ids[candidates] * max_count + jmax[candidates], return_index=True)
+    tp = np.zeros(len(image_ids))
+    tp[candidates[first]] = 1.0
+    fp = np.zeros(len(image_ids))
+    fp[candidates] = 1.0
+    fp[candidates[first]] = 0.0
+    fp[~matched] = 1.0
+
+    # compute precision recall
+    fp = np.cumsum(fp)
+    tp = np.cumsum(tp)
+    rec = tp / float(npos)
+    # avoid divide by zero in case the first detection matches a difficult
+    # ground truth
+    prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+    ap = voc_ap(rec, prec, use_07_metric)
+
+    return rec, prec, ap
+
+
+def _voc_eval_class(kwargs):
+    return voc_eval_class(**kwargs)
+
+
+class VOCEvaluator(object):
+    """
+    In memory PASCAL VOC evaluation, with the same APs as voc_eval on the results files.
+
+    The ground truth is read once, the detections are collected from the model outputs
+    by update and all the classes are evaluated by voc_eval_class.
+
+    Arguments:
+        imagenames (list[str]): names of the images of the set.
+        targets (list[dict[Tensor]]): targets of the images, as returned by
+            ConvertVOCtoCOCO, whose boxes are 0-based.
+        cls_names (list[str]): names of the classes, the first one is the background.
+    """
+    def __init__(self, imagenames, targets, cls_names, ovthresh=0.5, use_07_metric=True):
+        self.imagenames = imagenames
+        self.image_indices = {name: i for i, name in enumerate(imagenames)}
+        self.cls_names = cls_names
+        self.ovthresh = ovthresh
+        self.use_07_metric = use_07_metric
+
+        self.gt_image_ids = np.concatenate([np.full(len(t['labels']), i) for i, t in enumerate(targets)])
+        self.gt_boxes = np.concatenate([t['boxes'].numpy().astype(np.float64).reshape(-1, 4) + 1 for t in targets])
+        self.gt_labels = np.concatenate([t['labels'].numpy() for t in targets])
+        self.gt_difficult = np.concatenate([t['ishard'].numpy().astype(bool) for t in targets])
+        # detections of every image, as (boxes, scores, labels)
+        self.detections = {}
+
+    @classmethod
+    def from_dataset(cls, dataset, **kwargs):
+        """
+        Reads the ground truth of a VOCDetection, from its annotation index if it has one.
+        """
+        load_target = dataset.load_target
+        if dataset.annotation_index is not None:
+            load_target = dataset.annotation_index.__getitem__
+        targets = [load_target(i) for i in range(len(dataset))]
+        imagenames = [''.join(chr(c) for c in t['filename'].tolist()) for t in targets]
+        return cls(imagenames, targets, dataset.prepare.CLASSES, **kwargs)
+
+    def update(self, targets, results):
+        for target, result in zip(targets, results):
+            imagename = ''.join(chr(c) for c in target['filename'].tolist())
+            # the DistributedSampler may repeat images, only their first results are kept
+            if imagename not in self.detections:
+                self.detections[imagename] = tuple(
+                    result[k].detach().cpu().numpy() for k in ('boxes', 'scores', 'labels'))
+
+    def _class_arrays(self):
+        # the detections of every class in the order of the results files
+        imagenames = sorted(self.detections)
+        detections = [(np.zeros((0, 4)), np.zeros(0), np.zeros(0, dtype=np.int64))]
+        detections += [self.detections[name] for name in imagenames]
+        boxes, scores, labels = (np.concatenate([d[k] for d in detections]) for k in range(3))
+        image_ids = np.concatenate([np.zeros(0, dtype=np.int64)] + [
+            np.full(len(self.detections[name][1]), self.image_indices[name]) for name in imagenames])
+        for cls_ind, cls_name in enumerate(self.cls_names):
+            if cls_name == '__background__':
+                continue
+            keep = labels == cls_ind
+            gt_keep = self.gt_labels == cls_ind
+            yield cls_name, {
+                'gt_image_ids': self.gt_image_ids[gt_keep],
+                'gt_boxes': self.gt_boxes[gt_keep],
+                'gt_difficult': self.gt_difficult[gt_keep],
+                'det_image_ids': image_ids[keep],
+                'det_scores': _round_as_results_file(scores[keep].astype(np.float64), 3),
+                'det_boxes': _round_as_results_file(boxes[keep].astype(np.float64) + 1, 1).reshape(-1, 4),
+                'ovthresh': self.ovthresh,
+                'use_07_metric': self.use_07_metric,
+            }
+
+    def write_results_files(self, output_dir):
+        """
+        Writes the detections to the results files of the VOCdevkit, as _write_voc_results_file.
+        """
+        output_path = os.path.join(output_dir, 'results')
+        if os.path.exists(output_path):
+            shutil.rmtree(output_path)
+        os.makedirs(output_path)
+        for cls_name, arrays in self._class_arrays():
+            filename = os.path.join(output_path, 'det_test_{:s}.txt'.format(cls_name))
+            with open(filename, 'wt') as f:
+                for image_id, score, box in zip(arrays['det_image_ids'], arrays['det_scores'], arrays['det_boxes']):
+                    f.write('{:s} {:.3f} {:.1f} {:.1f} {:.1f} {:.1f}\n'.format(self.imagenames[image_id], score, *box))
+
+    def evaluate(self, num_workers=0):
+        """
+        Returns the mean AP over the classes, which are evaluated by num_workers processes.
+        """
+        cls_names, class_arrays = zip(*self._class_arrays())
+        print('VOC07 metric? ' + ('Yes' if self.use_07_metric else 'No'))
+        if num_workers > 0:
+            with ProcessPoolExecutor(num_workers) as executor:
+                results = list(executor.map(_voc_eval_class, class_arrays))
+        else:
+            results = [_voc_eval_class(kwargs) for kwargs in class_arrays]
+
+        aps = []
+        for cls_name, (rec, prec, ap) in zip(cls_names, results):
+            aps += [ap]
+            print('AP for {} = {:.4f}'.format(cls_name, ap))
+
+        print('Mean AP = {:.4f}'.format(np.mean(aps)))
+        return np.mean(aps)
+
+
 def _write_voc_results_file(all_boxes, image_index, cls_names, output_dir):
     output_path = os.path.join(output_dir, 'results')
     if os.path.exists(output_path):
@@ -209,29 +414,3 @@ def _write_voc_results_file(all_boxes, image_index, cls_names, output_dir):
                         dets[k][2] + 1,
                         dets[k][3] + 1,
                     ))
-
-
-def _do_python_eval(data_loader, output_dir, use_07=True):
-    voc_root = os.path.join(data_loader.dataset.root, 'VOCdevkit', 'VOC2007')
-    image_set = data_loader.dataset.image_set
-    imagesetfile = os.path.join(voc_root, 'ImageSets', 'Main', '{}.txt'.format(image_set))
-    annopath = os.path.join(voc_root, 'Annotations/{:s}.xml')
-
-    cls_names = data_loader.dataset.prepare.CLASSES
-    aps = []
-    # The PASCAL VOC metric changed in 2010
-    use_07_metric = use_07
-    print('VOC07 metric? ' + ('Yes' if use_07_metric else 'No'))
-
-    for cls_name in cls_names:
-        if cls_name == '__background__':
-            continue
-        detpath = os.path.join(output_dir, 'results', 'det_test_{:s}.txt')
-        rec, prec, ap = voc_eval(
-            detpath, annopath, imagesetfile, cls_name,
-            ovthresh=0.5, use_07_metric=use_07_metric,
-        )
-        aps += [ap]
-        print('AP for {} = {:.4f}'.format(cls_name, ap))
-
-    print('Mean AP = {:.4f}'.format(np.mean(aps)))
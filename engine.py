@@ -1,6 +1,7 @@
 import sys
 import time
 import math
+import contextlib
 
 import torch
 
@@ -11,45 +12,88 @@ from datasets.coco_eval import CocoEvaluator
 import util.misc as utils
 
 
-def train_one_epoch(model, criterion, optimizer, data_loader, device, epoch, print_freq):
+def train_one_epoch(model, criterion, optimizer, data_loader, device, epoch, print_freq, amp=False, scaler=None,
+                    accumulate_steps=1, lr_scheduler=None, batch_transforms=None):
+    """
+    With amp, the forward pass and the criterion run under autocast, in float16 on cuda
+    and in bfloat16 on cpu. The losses are scaled by the GradScaler scaler if it is given.
+
+    With accumulate_steps > 1, the gradients of accumulate_steps consecutive batches are
+    summed before each optimizer step, and DistributedDataParallel only synchronizes them
+    on the last one. The img/s throughput counts these effective batches.
+
+    The lr_scheduler, if given, is stepped after every optimizer step.
+
+    The batch_transforms, if given, augment the batches of uint8 images on device,
+    see datasets.batch_transforms.
+    """
     model.train()
     metric_logger = utils.MetricLogger(delimiter="  ")
     metric_logger.add_meter('lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Epoch: [{}]'.format(epoch)
 
-    lr_scheduler = None
-    if epoch == 0:
-        warmup_factor = 1. / 1000
-        warmup_iters = min(1000, len(data_loader) - 1)
+    num_batches = len(data_loader)
+
+    autocast_dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+    world_size = utils.get_world_size()
+
+    optimizer.zero_grad()
+    step_start = time.time()
+    step_images = 0
+    data_loader = utils.DataPrefetcher(data_loader, device)
+    for i, (samples, targets) in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+        if batch_transforms is not None:
+            samples, targets = batch_transforms(samples, targets)
+
+        # the last step of an epoch may accumulate fewer batches
+        step_size = min(accumulate_steps, num_batches - i // accumulate_steps * accumulate_steps)
+        is_step = (i + 1) % accumulate_steps == 0 or i + 1 == num_batches
+
+        sync_context = contextlib.nullcontext()
+        if not is_step and isinstance(model, torch.nn.parallel.DistributedDataParallel):
+            sync_context = model.no_sync()
+
+        with sync_context:
+            with torch.autocast(device.type, dtype=autocast_dtype, enabled=amp):
+                outputs = model(samples)
+                loss_dict = criterion(outputs, targets)
 
-        lr_scheduler = utils.warmup_lr_scheduler(optimizer, warmup_iters, warmup_factor)
+                losses = sum(loss for loss in loss_dict.values())
 
-    for samples, targets in metric_logger.log_every(data_loader, print_freq, header):
-        samples = samples.to(device)
-        targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+            # reduce losses over all GPUs for logging purposes
+            loss_dict_reduced = utils.reduce_dict(loss_dict)
+            losses_reduced = sum(loss for loss in loss_dict_reduced.values())
 
-        outputs = model(samples)
-        loss_dict = criterion(outputs, targets)
+            loss_value = losses_reduced.item()
 
-        losses = sum(loss for loss in loss_dict.values())
+            if not math.isfinite(loss_value):
+                print("Loss is {}, stopping training".format(loss_value))
+                print(loss_dict_reduced)
+                sys.exit(1)
 
-        # reduce losses over all GPUs for logging purposes
-        loss_dict_reduced = utils.reduce_dict(loss_dict)
-        losses_reduced = sum(loss for loss in loss_dict_reduced.values())
+            # the accumulated gradients are the mean over the batches of the step
+            losses = losses / step_size
+            if scaler is not None:
+                scaler.scale(losses).backward()
+            else:
+                losses.backward()
 
-        loss_value = losses_reduced.item()
+        step_images += len(targets) * world_size
 
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            print(loss_dict_reduced)
-            sys.exit(1)
+        if is_step:
+            if scaler is not None:
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                optimizer.step()
+            optimizer.zero_grad()
 
-        optimizer.zero_grad()
-        losses.backward()
-        optimizer.step()
+            if lr_scheduler is not None:
+                lr_scheduler.step()
 
-        if lr_scheduler is not None:
-            lr_scheduler.step()
+            metric_logger.update(img_s=step_images / (time.time() - step_start))
+            step_start = time.time()
+            step_images = 0
 
         metric_logger.update(loss=losses_reduced, **loss_dict_reduced)
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
@@ -70,7 +114,7 @@ def _get_iou_types(model):
 
 
 @torch.no_grad()
-def evaluate(model, criterion, data_loader, base_ds, device):
+def evaluate(model, criterion, data_loader, base_ds, device, batch_transforms=None):
     model.eval()
     metric_logger = utils.MetricLogger(delimiter="  ")
     header = 'Test:'
@@ -78,8 +122,10 @@ def evaluate(model, criterion, data_loader, base_ds, device):
     iou_types = _get_iou_types(model)
     coco_evaluator = CocoEvaluator(base_ds, iou_types)
 
+    data_loader = utils.DataPrefetcher(data_loader, device, targets_to_device=False)
     for samples, targets in metric_logger.log_every(data_loader, 20, header):
-        samples = samples.to(device)
+        if batch_transforms is not None:
+            samples, targets = batch_transforms(samples, targets)
 
         model_time = time.time()
         target_sizes = torch.stack([t['orig_size'] for t in targets], dim=0).to(device)
@@ -1,16 +1,18 @@
+import argparse
+import functools
 import time
 from pathlib import Path
 
-import numpy as np
-
 import torch
 from torch.utils.data import DataLoader
 
 from models import build_model
-from util.misc import MetricLogger, collate_fn
+from models.quantization import build_quantized_model
+from util.misc import DataPrefetcher, MetricLogger, collate_fn, data_loader_kwargs, load_checkpoint
 
 from datasets import build_dataset
-from datasets.voc_eval import _write_voc_results_file, _do_python_eval
+from datasets.batch_transforms import make_batch_transforms
+from datasets.voc_eval import VOCEvaluator
 
 
 def main(args):
@@ -30,36 +32,47 @@ def main(args):
         args.batch_size,
         sampler=sampler,
         drop_last=False,
-        collate_fn=collate_fn,
-        num_workers=args.num_workers,
+        collate_fn=functools.partial(collate_fn, channels_last=args.channels_last, with_mask=False),
+        **data_loader_kwargs(args),
     )
 
     print("Creating model")
     model = build_model(args)
+    if args.quantized:
+        # the int8 kernels only run on cpu
+        model = build_quantized_model(model, args.backend)
+        device = torch.device('cpu')
     model.to(device)
 
     # load model weights
-    checkpoint = torch.load(args.resume, map_location="cpu")
+    checkpoint = load_checkpoint(args.resume)
     model.load_state_dict(checkpoint)
 
     output_dir = Path(args.output_dir)
+    batch_transforms = None
+    if args.batch_augment:
+        batch_transforms = make_batch_transforms(args.val_set, args.image_size)
+
     # evaluation
-    evaluate(model, data_loader, device, output_dir)
+    evaluate(model, data_loader, device, output_dir, batch_transforms=batch_transforms, num_workers=args.num_workers)
 
 
 @torch.no_grad()
-def evaluate(model, data_loader, device, output_dir):
+def evaluate(model, data_loader, device, output_dir, batch_transforms=None, num_workers=0):
+    """
+    Returns the PASCAL VOC mAP of model, the classes are evaluated by num_workers processes.
+    """
     model.eval()
     metric_logger = MetricLogger(delimiter="  ")
     header = 'Test:'
 
-    cls_names = data_loader.dataset.prepare.CLASSES
-
-    all_boxes = [[] for i in range(len(cls_names))]
-    image_index = []
+    voc_evaluator = VOCEvaluator.from_dataset(data_loader.dataset, use_07_metric=True)
 
-    for samples, targets in metric_logger.log_every(data_loader, 20, header):
-        samples = samples.to(device)
+    # the targets are read on cpu
+    prefetcher = DataPrefetcher(data_loader, device, targets_to_device=False)
+    for samples, targets in metric_logger.log_every(prefetcher, 20, header):
+        if batch_transforms is not None:
+            samples, targets = batch_transforms(samples, targets)
 
         model_time = time.time()
         target_sizes = torch.stack([t['orig_size'] for t in targets], dim=0).to(device)
@@ -67,39 +80,21 @@ def evaluate(model, data_loader, device, output_dir):
 
         model_time = time.time() - model_time
 
-        for target, result in zip(targets, results):
-            image_index.append(''.join([chr(i) for i in target['filename'].tolist()]))
-
-            # Convert the result of models to numpy
-            boxes = result['boxes'].tolist()
-            labels = result['labels'].tolist()
-            scores = result['scores'].tolist()
-
-            image_boxes = [[] for i in range(len(cls_names))]
-            for i, box in enumerate(boxes):
-                cls_dets = np.hstack((box, scores[i]))
-                image_boxes[labels[i]].append(cls_dets)
-
-            for i in range(len(cls_names)):
-                if image_boxes[i] != []:
-                    all_boxes[i].append(image_boxes[i])
-                else:
-                    all_boxes[i].append([])
-
-        metric_logger.update(model_time=model_time)
+        evaluator_time = time.time()
+        voc_evaluator.update(targets, results)
+        evaluator_time = time.time() - evaluator_time
+        metric_logger.update(model_time=model_time, evaluator_time=evaluator_time)
 
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
 
-    _write_voc_results_file(all_boxes, image_index, cls_names, output_dir)
-    _do_python_eval(data_loader, output_dir, use_07=True)
-
+    voc_evaluator.write_results_files(output_dir)
+    return voc_evaluator.evaluate(num_workers=num_workers)
 
-if __name__ == "__main__":
-    import argparse
-    parser = argparse.ArgumentParser(description=__doc__)
 
+def get_args_parser():
+    parser = argparse.ArgumentParser('Evaluate single shot multiBox detector on PASCAL VOC', add_help=False)
     parser.add_argument('--arch', default='ssd_lite_mobilenet_v2',
                         help='model architecture')
     parser.add_argument('--return-criterion', action="store_true",
@@ -108,7 +103,7 @@ if __name__ == "__main__":
                         help='dataset')
     parser.add_argument('--dataset-file', default='voc',
                         help='dataset')
-    parser.add_argument('--dataset-year', default='2007', nargs='+',
+    parser.add_argument('--dataset-year', default=['2007'], nargs='+',
                         help='dataset year')
     parser.add_argument('--train-set', default='train',
                         help='set of train')
@@ -120,8 +115,28 @@ if __name__ == "__main__":
                         help='device')
     parser.add_argument('--score-thresh', default=0.01, type=float,
                         help='inference score threshold')
+    parser.add_argument('--batched-post-process', action='store_true',
+                        help='Run the score threshold and nms once for the whole batch')
+    parser.add_argument('--pre-nms-top-k', default=0, type=int,
+                        help='number of candidates per image kept before nms, 0 means no limit')
+    parser.add_argument('--pre-nms-top-k-per-class', default=0, type=int,
+                        help='number of candidates per class kept before nms, 0 means no limit')
+    parser.add_argument('--quantized', action='store_true',
+                        help='evaluate an int8 state dict saved by train.py --qat, on cpu')
+    parser.add_argument('--backend', default='fbgemm',
+                        help='quantized engine, fbgemm for x86 or qnnpack for arm')
     parser.add_argument("--onnx-export", action="store_true",
                         help="Whether to export the model to onnx")
+    parser.add_argument('--channels-last', action='store_true',
+                        help='run the model and batch the images in the channels last (NHWC) memory format')
+    parser.add_argument('--annotation-index', default='',
+                        help='directory of the compiled VOC annotations, it is built on first use')
+    parser.add_argument('--image-cache', default='',
+                        help='directory of the cache of decoded and resized images, it is built on first use')
+    parser.add_argument('--augmentation', default='ssd', choices=['ssd', 'detr'],
+                        help='data augmentation of the training images, ssd or the random resize and crop of detr')
+    parser.add_argument('--batch-augment', action='store_true',
+                        help='resize the batches of uint8 images on device instead of in the data loading workers')
     parser.add_argument('--image-size', default=300, type=int,
                         help='input size of models')
     parser.add_argument('--num-classes', default=21, type=int,
@@ -129,7 +144,13 @@ if __name__ == "__main__":
     parser.add_argument('--batch-size', default=1, type=int,
                         help='images per gpu, the total batch size is $NGPU x batch_size')
     parser.add_argument('--num-workers', default=4, type=int, metavar='N',
-                        help='number of data loading workers (default: 4)')
+                        help='number of data loading and of evaluation workers (default: 4)')
+    parser.add_argument('--pin-memory', action='store_true',
+                        help='copy the batches to pinned memory in the DataLoader, for the transfers to cuda')
+    parser.add_argument('--persistent-workers', action='store_true',
+                        help='keep the data loading workers and their dataset alive between epochs')
+    parser.add_argument('--prefetch-factor', default=2, type=int,
+                        help='number of batches loaded in advance by each worker')
     parser.add_argument('--lr-backbone', default=-1, type=float)
     parser.add_argument('--print-freq', default=20, type=int,
                         help='print frequency')
@@ -145,7 +166,11 @@ if __name__ == "__main__":
                         help='number of distributed processes')
     parser.add_argument('--dist-url', default='env://',
                         help='url used to set up distributed training')
+    return parser
 
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('DEMONET evaluation script', parents=[get_args_parser()])
     args = parser.parse_args()
 
     if args.output_dir:
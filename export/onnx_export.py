@@ -13,6 +13,7 @@ def main(args):
         pretrained=True,
         num_classes=args.num_classes,
         image_size=args.image_size,
+        fuse=args.fuse,
     )
     model.eval()
     model.to(device)
@@ -43,6 +44,8 @@ def parse_args():
                         help='number classes of datasets')
     parser.add_argument('--device', default='cpu',
                         help='device')
+    parser.add_argument('--fuse', action='store_true',
+                        help='fold the BatchNorm layers into the convolutions before exporting')
     parser.add_argument('--output-path', default='./checkpoints/model.onnx',
                         help='path where to save')
 
@@ -1,6 +1,7 @@
 import torch
 
 from models.backbone import MobileNetWithExtraBlocks
+from models.fuse import fuse_for_inference
 from models.ssd_mobilenet import SSDLiteWithMobileNetV2
 
 dependencies = ["torch", "torchvision"]
@@ -27,10 +28,15 @@ def ssd_lite_mobilenet_v2(
     image_size=320,
     score_thresh=0.5,
     num_classes=21,
+    fuse=False,
 ):
     """
     ssd lite with mobilenet v2 backbone.
     Achieves 68.39 AP50 on PASCAL VOC.
+
+    Arguments:
+        fuse (bool): fold the BatchNorm layers into the convolutions for inference,
+            the returned model is in eval mode and can't be trained anymore.
     """
     model = _make_mobilenet_v2(
         image_size=image_size,
@@ -40,5 +46,7 @@ def ssd_lite_mobilenet_v2(
     if pretrained:
         checkpoint = torch.load(model_urls['ssd_lite_mobilenet_v2'], map_location="cpu")
         model.load_state_dict(checkpoint)
+    if fuse:
+        fuse_for_inference(model)
 
     return model
@@ -30,17 +30,20 @@ class BalancedPositiveNegativeSampler(object):
             between the negative examples and positive examples is no more
             the given ratio for an image.
         Args:
-            loss (batch_size, num_priors): the loss for each example.
+            loss (batch_size, num_priors): the loss for each example, it is not modified.
             targets (batch_size, num_priors): the targets.
         """
         pos_mask = targets > 0
         num_pos = pos_mask.long().sum(dim=1, keepdim=True)
         num_neg = num_pos * self.negative_positive_ratio
 
-        loss[pos_mask] = - math.inf
-        _, indexes = loss.sort(dim=1, descending=True)
-        _, orders = indexes.sort(dim=1)
-        neg_mask = orders < num_neg
+        # only the largest num_neg losses of every image are needed, so rank the top k
+        # of the batch once instead of sorting all the priors twice
+        loss = loss.masked_fill(pos_mask, - math.inf)
+        num_neg_max = min(int(num_neg.max()), loss.shape[1])
+        _, indexes = loss.topk(num_neg_max, dim=1)
+        orders = torch.arange(num_neg_max, device=loss.device)
+        neg_mask = torch.zeros_like(pos_mask).scatter_(1, indexes, orders < num_neg)
         return pos_mask | neg_mask
 
 
@@ -134,3 +137,15 @@ class BoxCoder(object):
         boxes = locations_to_boxes(locations, priors, self.variances)
         boxes = box_cxcywh_to_xyxy(boxes)
         return boxes
+
+    def decode_subset(self, locations: Tensor, priors: Tensor, prior_idxs: Tensor) -> Tensor:
+        """Same as decode, but only for a subset of the priors, so that the candidates
+        filtered out by the score threshold are never decoded.
+        Args:
+            locations (tensor): [num_candidates, 4] location predictions of the candidates
+            priors (tensor): [num_priors, 4] prior boxes in XYWHA_REL BoxMode
+            prior_idxs (tensor): [num_candidates] index in priors of every candidate
+        Return:
+            decoded bounding box predictions of the candidates
+        """
+        return self.decode(locations, priors[prior_idxs])
@@ -1,12 +1,17 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
 # Modified by Zhiqiang Wang (zhiqwang@outlook.com)
 
+import copy
+
 import torch
 from torch import nn, Tensor
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
 
 import torchvision
-from torchvision.ops.boxes import box_iou, batched_nms, remove_small_boxes
+from torchvision.ops.boxes import batched_nms, remove_small_boxes
+
+from util import box_ops
 
 from . import _utils as det_utils
 
@@ -104,7 +109,51 @@ class MultiBoxLiteHead(nn.Module):
         return logits, bbox_reg
 
 
+class FusedMultiBoxLiteHead(nn.Module):
+    """
+    Inference-only version of a trained MultiBoxLiteHead, where the 1x1 convolutions of the
+    classification and regression branches of the last feature level are concatenated in a
+    single convolution, whose output channels are split back into class logits and box
+    regressions. The SeperableConv2d of the other levels are kept as two branches, the
+    depthwise convolution is cheap next to their pointwise convolutions, and merging the two
+    depthwise stages in a grouped convolution with two output channels per group has no fast
+    path on CPU.
+
+    Arguments:
+        head (MultiBoxLiteHead): the trained head to fuse, it is not modified.
+    """
+    def __init__(self, head: MultiBoxLiteHead):
+        super().__init__()
+
+        self.cls_logits = nn.ModuleList([copy.deepcopy(m) for m in head.cls_logits[:-1]])
+        self.bbox_pred = nn.ModuleList([copy.deepcopy(m) for m in head.bbox_pred[:-1]])
+
+        cls_conv, bbox_conv = head.cls_logits[-1], head.bbox_pred[-1]
+        self.num_cls_channels = cls_conv.out_channels
+        self.last_level = nn.Conv2d(cls_conv.in_channels, cls_conv.out_channels + bbox_conv.out_channels, 1)
+        with torch.no_grad():
+            self.last_level.weight.copy_(torch.cat([cls_conv.weight, bbox_conv.weight]))
+            self.last_level.bias.copy_(torch.cat([cls_conv.bias, bbox_conv.bias]))
+
+    def forward(self, features: List[Tensor]) -> Tuple[Tensor, Tensor]:
+        logits = []
+        bbox_reg = []
+
+        for i, (cls_logits, bbox_pred) in enumerate(zip(self.cls_logits, self.bbox_pred)):
+            logits.append(cls_logits(features[i]))
+            bbox_reg.append(bbox_pred(features[i]))
+
+        out = self.last_level(features[-1])
+        logits.append(out[:, :self.num_cls_channels])
+        bbox_reg.append(out[:, self.num_cls_channels:])
+
+        logits, bbox_reg = concat_box_prediction_layers(logits, bbox_reg)
+
+        return logits, bbox_reg
+
+
 def permute_and_flatten(layer: Tensor, N: int, A: int, C: int, H: int, W: int) -> Tensor:
+    # the reshape is a copy for NCHW layers, and only a view for channels last layers
     layer = layer.view(N, -1, C, H, W)
     layer = layer.permute(0, 3, 4, 1, 2)
     layer = layer.reshape(N, -1, C)
@@ -115,6 +164,46 @@ def concat_box_prediction_layers(
     box_cls: List[Tensor],
     box_regression: List[Tensor],
 ) -> Tuple[Tensor, Tensor]:
+    """
+    Flattens the outputs of every feature level to [N, H * W * A, C] and [N, H * W * A, 4],
+    and concatenates them in the order of the priors. The permuted outputs are copied once,
+    straight into their slices of the preallocated results, instead of being flattened
+    and then concatenated with torch.cat. This copy is contiguous for channels last outputs.
+    """
+    if torchvision._is_tracing():
+        # the writes into slices don't export well to ONNX
+        return _onnx_concat_box_prediction_layers(box_cls, box_regression)
+
+    N = box_cls[0].shape[0]
+    num_priors = 0
+    for box_cls_per_level, box_regression_per_level in zip(box_cls, box_regression):
+        num_priors += box_regression_per_level.shape[1] // 4 * box_cls_per_level.shape[2] * box_cls_per_level.shape[3]
+    C = box_cls[0].shape[1] // (box_regression[0].shape[1] // 4)
+
+    box_cls_flattened = torch.empty(
+        (N, num_priors, C), dtype=box_cls[0].dtype, device=box_cls[0].device)
+    box_regression_flattened = torch.empty(
+        (N, num_priors, 4), dtype=box_regression[0].dtype, device=box_regression[0].device)
+
+    start = 0
+    for box_cls_per_level, box_regression_per_level in zip(box_cls, box_regression):
+        _, _, H, W = box_cls_per_level.shape
+        A = box_regression_per_level.shape[1] // 4
+        end = start + H * W * A
+        box_cls_flattened[:, start:end].view(N, H, W, A, C).copy_(
+            box_cls_per_level.view(N, A, C, H, W).permute(0, 3, 4, 1, 2))
+        box_regression_flattened[:, start:end].view(N, H, W, A, 4).copy_(
+            box_regression_per_level.view(N, A, 4, H, W).permute(0, 3, 4, 1, 2))
+        start = end
+
+    return box_cls_flattened, box_regression_flattened
+
+
+@torch.jit.unused
+def _onnx_concat_box_prediction_layers(
+    box_cls: List[Tensor],
+    box_regression: List[Tensor],
+) -> Tuple[Tensor, Tensor]:
 
     box_cls_flattened = []
     box_regression_flattened = []
@@ -176,10 +265,19 @@ class SetCriterion(nn.Module):
                       The expected keys in each dict depends on the losses applied, see each loss' doc
         """
         losses = {}
-
-        regression_targets, labels = self.select_training_samples(outputs['priors'], targets)
-        loss_classifier, loss_box_reg = self.compute_loss(
-            outputs['pred_boxes'], outputs['pred_logits'], regression_targets, labels)
+        # with mixed precision the head outputs are half, the ranking of the negatives, the
+        # log of the box encoding and the losses are computed in float
+        pred_logits = outputs['pred_logits'].float()
+        pred_boxes = outputs['pred_boxes'].float()
+
+        if 'regression_targets' in targets[0]:
+            # the targets were already matched with the priors in the data loader workers,
+            # see util.misc.AssignTargetsCollator
+            regression_targets = torch.stack([t['regression_targets'] for t in targets])
+            labels = torch.stack([t['prior_labels'] for t in targets])
+        else:
+            regression_targets, labels = self.select_training_samples(outputs['priors'].float(), targets)
+        loss_classifier, loss_box_reg = self.compute_loss(pred_boxes, pred_logits, regression_targets, labels)
 
         losses = {
             'loss_box_reg': loss_box_reg,
@@ -193,45 +291,68 @@ class SetCriterion(nn.Module):
         gt_boxes: List[Tensor],
         gt_labels: List[Tensor],
         priors: Tensor,
-    ) -> Tuple[List[Tensor], List[Tensor]]:
-        """Assign ground truth boxes and targets to priors.
+    ) -> Tuple[Tensor, Tensor]:
+        """Assign ground truth boxes and targets to priors, for all the images at once.
+        The ground truth boxes are padded to the largest number of targets in the batch.
         Args:
             gt_boxes (List[Tensor]): with shape num_targets x 4, ground truth boxes
             gt_labels (List[Tensor]): with shape num_targets, labels of targets
             priors (Tensor): with shape num_priors x 4, XYXY_REL BoxMode
         Returns:
-            boxes (List[Tensor]): with shape num_priors x 4 real values for priors.
-            labels (List[Tensor]): with shape num_priros, labels for priors.
+            boxes (Tensor): with shape batch_size x num_priors x 4 real values for priors.
+            labels (Tensor): with shape batch_size x num_priors, labels for priors.
         """
-        boxes = []
-        labels = []
-        for gt_boxes_in_image, gt_labels_in_image in zip(gt_boxes, gt_labels):
-
-            match_quality_matrix = box_iou(gt_boxes_in_image, priors)  # num_targets x num_priors
-            if match_quality_matrix.numel() == 0:
-                # empty targets or proposals not supported during training
-                if match_quality_matrix.shape[0] == 0:
-                    raise ValueError(
-                        "No ground-truth boxes available for one of the images "
-                        "during training")
-                else:
-                    raise ValueError(
-                        "No default boxes available for one of the images "
-                        "during training")
-            matched_vals, matches = match_quality_matrix.max(0)  # num_priors
-            _, best_prior_per_target_index = match_quality_matrix.max(1)  # num_targets
-
-            for target_index, prior_index in enumerate(best_prior_per_target_index):
-                matches[prior_index] = target_index
-            # 2.0 is used to make sure every target has a prior assigned
-            matched_vals.index_fill_(0, best_prior_per_target_index, 2)
-
-            labels_in_image = gt_labels_in_image[matches]  # num_priors
-            labels_in_image[matched_vals < self.iou_thresh] = 0  # the backgound id
-            boxes_in_image = gt_boxes_in_image[matches]
-
-            boxes.append(boxes_in_image)
-            labels.append(labels_in_image)
+        # empty targets or proposals not supported during training
+        if min([len(boxes_in_image) for boxes_in_image in gt_boxes]) == 0:
+            raise ValueError(
+                "No ground-truth boxes available for one of the images "
+                "during training")
+        if priors.shape[0] == 0:
+            raise ValueError(
+                "No default boxes available for one of the images "
+                "during training")
+
+        device = priors.device
+        batch_size = len(gt_boxes)
+        num_priors = priors.shape[0]
+
+        num_targets = torch.as_tensor([len(boxes_in_image) for boxes_in_image in gt_boxes], device=device)
+        gt_boxes_padded = pad_sequence(gt_boxes, batch_first=True)  # batch_size x max_targets x 4
+        gt_labels_padded = pad_sequence(gt_labels, batch_first=True)  # batch_size x max_targets
+        max_targets = gt_boxes_padded.shape[1]
+        target_index = torch.arange(max_targets, device=device).expand(batch_size, -1)
+        is_valid_target = target_index < num_targets[:, None]
+
+        # batch_size x max_targets x num_priors, the padded targets never match
+        match_quality_matrix = box_ops.batched_box_iou(gt_boxes_padded, priors)
+        match_quality_matrix.masked_fill_(~is_valid_target[:, :, None], -1)
+
+        matched_vals, matches = match_quality_matrix.max(1)  # batch_size x num_priors
+        _, best_prior_per_target_index = match_quality_matrix.max(2)  # batch_size x max_targets
+
+        # make sure every target has a prior assigned. When several targets share the same
+        # best prior the last one wins, so order them by (prior, target) and only scatter the
+        # last target of every prior, which keeps the scatter deterministic.
+        best_prior_per_target_index = best_prior_per_target_index + num_priors * torch.arange(
+            batch_size, device=device)[:, None]
+        best_prior_per_target_index = best_prior_per_target_index[is_valid_target]
+        target_index = target_index[is_valid_target]
+        order = torch.argsort(best_prior_per_target_index * max_targets + target_index)
+        best_prior_per_target_index = best_prior_per_target_index[order]
+        target_index = target_index[order]
+        is_last = torch.ones_like(target_index, dtype=torch.bool)
+        is_last[:-1] = best_prior_per_target_index[1:] != best_prior_per_target_index[:-1]
+
+        matches = matches.view(-1).scatter(
+            0, best_prior_per_target_index[is_last], target_index[is_last]).view(batch_size, num_priors)
+        # 2.0 is used to make sure every target has a prior assigned
+        matched_vals = matched_vals.view(-1).index_fill(
+            0, best_prior_per_target_index, 2).view(batch_size, num_priors)
+
+        labels = gt_labels_padded.gather(1, matches)  # batch_size x num_priors
+        labels[matched_vals < self.iou_thresh] = 0  # the backgound id
+        boxes = gt_boxes_padded.gather(1, matches[:, :, None].expand(-1, -1, 4))
+
         return boxes, labels
 
     def select_training_samples(
@@ -249,13 +370,7 @@ class SetCriterion(nn.Module):
         # get boxes indices for each priors
         boxes, labels = self.assign_targets_to_priors(gt_boxes, gt_labels, priors_xyxy)
 
-        gt_locations = []
-        for img_id in range(len(targets)):
-            locations = self.box_coder.encode(boxes[img_id], priors)
-            gt_locations.append(locations)
-
-        regression_targets = torch.stack(gt_locations, 0)
-        labels = torch.stack(labels, 0)
+        regression_targets = self.box_coder.encode(boxes, priors)
 
         return regression_targets, labels
 
@@ -306,12 +421,19 @@ class PostProcess(nn.Module):
         score_thresh: float,
         nms_thresh: float,
         detections_per_img: int,
+        batched: bool = False,
+        pre_nms_top_k: int = 0,
+        pre_nms_top_k_per_class: int = 0,
     ):
         super().__init__()
         self.box_coder = det_utils.BoxCoder(variances)
         self.score_thresh = score_thresh
         self.nms_thresh = nms_thresh
         self.detections_per_img = detections_per_img
+        self.batched = batched
+        # number of candidates sent to nms, 0 means no limit
+        self.pre_nms_top_k = pre_nms_top_k
+        self.pre_nms_top_k_per_class = pre_nms_top_k_per_class
 
     def _get_num_priors(self, priors: Tensor) -> int:
         if torchvision._is_tracing():
@@ -320,6 +442,36 @@ class PostProcess(nn.Module):
             num_anchors = priors.shape[0]
         return num_anchors
 
+    def select_top_candidates(self, scores: Tensor) -> Tuple[Tensor, Tensor]:
+        """
+        Keep the pre_nms_top_k_per_class best priors of every class, and then the
+        pre_nms_top_k best (prior, class) pairs of every image.
+
+        Arguments:
+            scores (Tensor): [batch_size, num_priors, num_classes - 1] class probabilities,
+                without the background.
+        Returns:
+            scores (Tensor): [batch_size, num_candidates] scores of the kept candidates.
+            idxs (Tensor): [batch_size, num_candidates] indices of the kept candidates in
+                scores.reshape(batch_size, -1), i.e. prior_index * (num_classes - 1) + class_index.
+        """
+        batch_size, num_priors, num_labels = scores.shape
+        device = scores.device
+
+        if self.pre_nms_top_k_per_class > 0 and self.pre_nms_top_k_per_class < num_priors:
+            scores, prior_idxs = scores.topk(self.pre_nms_top_k_per_class, dim=1)
+            idxs = prior_idxs * num_labels + torch.arange(num_labels, device=device)
+            idxs = idxs.reshape(batch_size, -1)
+        else:
+            idxs = torch.arange(num_priors * num_labels, device=device).expand(batch_size, -1)
+        scores = scores.reshape(batch_size, -1)
+
+        if self.pre_nms_top_k > 0 and self.pre_nms_top_k < scores.shape[1]:
+            scores, top_idxs = scores.topk(self.pre_nms_top_k, dim=1)
+            idxs = idxs.gather(1, top_idxs)
+
+        return scores, idxs
+
     def forward(
         self,
         pred_logits: Tensor,
@@ -347,31 +499,28 @@ class PostProcess(nn.Module):
             batch_size = pred_logits.shape[0]
             target_sizes = torch.ones((batch_size, 2), device=device)
 
-        out_boxes = self.box_coder.decode(pred_boxes, priors)  # batch_size x num_priors x 4
         out_scores = F.softmax(pred_logits, -1)
 
-        results = torch.jit.annotate(List[Dict[str, Tensor]], [])
-        for boxes, scores, target_size in zip(out_boxes, out_scores, target_sizes):
-            # For each class, perform nms
-            boxes = boxes * target_size.flip(0).repeat(2)
-            boxes = torch.cat([boxes for _ in range(num_classes - 1)], dim=1)
-
-            # create labels for each prediction
-            labels = torch.arange(num_classes, device=device)
-            labels = labels.view(1, -1).expand_as(scores)
-
-            # remove predictions with the background label
-            scores = scores[:, 1:]
-            labels = labels[:, 1:]
+        if self.batched:
+            return self.batched_postprocess_detections(pred_boxes, out_scores, priors, target_sizes)
 
-            # batch everything, by making every class prediction be a separate instance
-            boxes = boxes.reshape(-1, 4)
-            scores = scores.reshape(-1)
-            labels = labels.reshape(-1)
+        results = torch.jit.annotate(List[Dict[str, Tensor]], [])
+        for locations, scores, target_size in zip(pred_boxes, out_scores, target_sizes):
+            # remove predictions with the background label, keep the top candidates only
+            scores, idxs = self.select_top_candidates(scores[None, :, 1:])
+            scores, idxs = scores[0], idxs[0]
 
             # remove low scoring boxes
             inds = torch.where(scores > self.score_thresh)[0]
-            boxes, scores, labels = boxes[inds], scores[inds], labels[inds]
+            scores, idxs = scores[inds], idxs[inds]
+
+            # every class prediction is a separate instance
+            prior_idxs = idxs // (num_classes - 1)
+            labels = idxs % (num_classes - 1) + 1
+
+            # decode the remaining candidates only
+            boxes = self.box_coder.decode_subset(locations[prior_idxs], priors, prior_idxs)
+            boxes = boxes * target_size.flip(0).repeat(2)
 
             # remove empty boxes
             keep = remove_small_boxes(boxes, min_size=1e-2)
@@ -386,3 +535,129 @@ class PostProcess(nn.Module):
             results.append({'scores': scores, 'labels': labels, 'boxes': boxes})
 
         return results
+
+    def batched_postprocess_detections(
+        self,
+        locations: Tensor,
+        scores: Tensor,
+        priors: Tensor,
+        target_sizes: Tensor,
+    ) -> List[Dict[str, Tensor]]:
+        """
+        Same as the per image loop in forward, but the score threshold, the gathering of
+        the candidates and the top-k selection are done once for the whole batch. On cuda
+        the non-maximum suppression is a single call too, every (image, class) pair being
+        offset into its own group so that boxes are never suppressed across images or classes.
+
+        Parameters:
+            locations : [batch_size, num_priors, 4] predicted locations.
+            scores : [batch_size, num_priors, num_classes] class probabilities.
+            priors : [num_priors, 4] real boxes corresponding all the priors.
+            target_sizes: [batch_size, 2] size of each images of the batch.
+        """
+        batch_size, num_priors, num_classes = scores.shape
+
+        # remove predictions with the background label, keep the top candidates
+        scores, idxs = self.select_top_candidates(scores[:, :, 1:])
+
+        # remove low scoring boxes
+        inds = torch.where(scores > self.score_thresh)
+        image_idxs = inds[0]
+        scores = scores[image_idxs, inds[1]]
+        idxs = idxs[image_idxs, inds[1]]
+        prior_idxs = idxs // (num_classes - 1)
+        labels = idxs % (num_classes - 1) + 1
+
+        # decode the remaining candidates only
+        boxes = self.box_coder.decode_subset(locations[image_idxs, prior_idxs], priors, prior_idxs)
+        boxes = boxes * target_sizes.flip(1).repeat(1, 2)[image_idxs]
+
+        # remove empty boxes
+        keep = remove_small_boxes(boxes, min_size=1e-2)
+        boxes, scores, labels, image_idxs = boxes[keep], scores[keep], labels[keep], image_idxs[keep]
+
+        # non-maximum suppression, independently done per image and per class,
+        # and keep only topk scoring predictions of every image
+        if boxes.is_cuda:
+            keep, num_per_image = self._batched_nms_single_call(
+                boxes, scores, labels, image_idxs, batch_size, num_classes)
+        else:
+            keep, num_per_image = self._batched_nms_per_image(
+                boxes, scores, labels, image_idxs, batch_size)
+
+        split_sizes = torch.jit.annotate(List[int], num_per_image.tolist())
+        boxes_per_image = boxes[keep].split(split_sizes)
+        scores_per_image = scores[keep].split(split_sizes)
+        labels_per_image = labels[keep].split(split_sizes)
+
+        results = torch.jit.annotate(List[Dict[str, Tensor]], [])
+        for i in range(batch_size):
+            results.append({
+                'scores': scores_per_image[i],
+                'labels': labels_per_image[i],
+                'boxes': boxes_per_image[i],
+            })
+
+        return results
+
+    def _batched_nms_single_call(
+        self,
+        boxes: Tensor,
+        scores: Tensor,
+        labels: Tensor,
+        image_idxs: Tensor,
+        batch_size: int,
+        num_classes: int,
+    ) -> Tuple[Tensor, Tensor]:
+        """
+        One nms call for the whole batch, every (image, class) pair being offset into
+        its own group. Returns the kept indices grouped by image and sorted by decreasing
+        score within every image, together with the number of kept boxes per image.
+        """
+        keep = batched_nms(boxes, scores, image_idxs * num_classes + labels, self.nms_thresh)
+
+        # keep is sorted by decreasing scores, regroup it by image without breaking that order
+        num_keep = keep.shape[0]
+        ranks = torch.arange(num_keep, device=keep.device)
+        _, order = torch.sort(image_idxs[keep] * num_keep + ranks)
+        keep = keep[order]
+        image_idxs = image_idxs[keep]
+
+        num_per_image = torch.bincount(image_idxs, minlength=batch_size)
+        first_per_image = num_per_image.cumsum(0) - num_per_image
+        keep = keep[(ranks - first_per_image[image_idxs]) < self.detections_per_img]
+        num_per_image = num_per_image.clamp(max=self.detections_per_img)
+
+        return keep, num_per_image
+
+    def _batched_nms_per_image(
+        self,
+        boxes: Tensor,
+        scores: Tensor,
+        labels: Tensor,
+        image_idxs: Tensor,
+        batch_size: int,
+    ) -> Tuple[Tensor, Tensor]:
+        """
+        The cpu kernel of nms is quadratic in the number of boxes, a single call over
+        the whole batch is much slower than one call per image there. The candidates
+        are already sorted by image, so every image is a contiguous slice of them.
+        """
+        num_per_image = torch.bincount(image_idxs, minlength=batch_size)
+        split_sizes = torch.jit.annotate(List[int], num_per_image.tolist())
+
+        keep = torch.jit.annotate(List[Tensor], [])
+        start = 0
+        for num in split_sizes:
+            keep_in_image = batched_nms(
+                boxes[start:start + num],
+                scores[start:start + num],
+                labels[start:start + num],
+                self.nms_thresh,
+            )
+            keep.append(keep_in_image[:self.detections_per_img] + start)
+            start += num
+
+        keep = torch.cat(keep)
+        num_per_image = num_per_image.clamp(max=self.detections_per_img)
+        return keep, num_per_image
@@ -0,0 +1,51 @@
+# Copyright (c) 2020, Zhiqiang Wang. All Rights Reserved.
+"""
+Inference-only transformations of trained models.
+"""
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from modules.peleenet import BasicConv2d
+
+from .box_head import MultiBoxLiteHead, FusedMultiBoxLiteHead
+
+
+def fuse_conv_bn(module: nn.Module) -> nn.Module:
+    """
+    Fold every BatchNorm2d into the Conv2d that precedes it, in place. It covers the
+    consecutive (Conv2d, BatchNorm2d) pairs of all the nn.Sequential, which includes the
+    SeperableConv2d of the head and the torchvision InvertedResidual blocks, and the
+    BasicConv2d of PeleeNet. The folded BatchNorm2d are replaced by nn.Identity, so the
+    names of the other layers are kept.
+    """
+    for child in module.children():
+        fuse_conv_bn(child)
+
+    if isinstance(module, nn.Sequential):
+        layers = list(module.children())
+        for i in range(len(layers) - 1):
+            if isinstance(layers[i], nn.Conv2d) and isinstance(layers[i + 1], nn.BatchNorm2d):
+                module[i] = fuse_conv_bn_eval(layers[i], layers[i + 1])
+                module[i + 1] = nn.Identity()
+    elif isinstance(module, BasicConv2d):
+        module.conv = fuse_conv_bn_eval(module.conv, module.norm)
+        module.norm = nn.Identity()
+
+    return module
+
+
+def fuse_for_inference(model: nn.Module, fuse_head: bool = False) -> nn.Module:
+    """
+    Prepare a trained GeneralizedSSD, Pelee or PeleeNet for deployment, in place.
+    The model is set to eval mode and its BatchNorm2d are folded into the convolutions.
+
+    Arguments:
+        model (nn.Module): the trained model.
+        fuse_head (bool): also replace the MultiBoxLiteHead by a FusedMultiBoxLiteHead,
+            which runs the two 1x1 convolutions of the last level as one.
+    """
+    if fuse_head and isinstance(getattr(model, 'multibox_head', None), MultiBoxLiteHead):
+        model.multibox_head = FusedMultiBoxLiteHead(model.multibox_head)
+    model.eval()
+    fuse_conv_bn(model)
+    return model
@@ -20,6 +20,8 @@ class GeneralizedSSD(nn.Module):
         backbone (nn.Module):
         multibox_heads (nn.Module): takes the features + the proposals from the multibox and computes
             detections from it.
+        channels_last (bool): keep the weights and the inputs in the channels last (NHWC) memory
+            format, which is faster for the depthwise convolutions with cuDNN and oneDNN.
     """
 
     def __init__(
@@ -28,15 +30,35 @@ class GeneralizedSSD(nn.Module):
         prior_generator: nn.Module,
         multibox_head: nn.Module,
         post_process: Optional[nn.Module],
+        channels_last: bool = False,
     ):
         super().__init__()
         self.backbone = backbone
         self.prior_generator = prior_generator
         self.multibox_head = multibox_head
         self.post_process = post_process
+        self.channels_last = channels_last
+        if channels_last:
+            # Module.to and load_state_dict keep the memory format of the parameters
+            self.to(memory_format=torch.channels_last)
         # used only on torchscript mode
         self._has_warned = False
 
+    def compute_priors(self, image_size: int) -> Tensor:
+        """
+        Priors of an image_size x image_size input. They only depend on the size of the
+        feature maps, so they are fixed for a given input size.
+        """
+        was_training = self.training
+        device = next(self.parameters()).device
+        self.eval()
+        with torch.no_grad():
+            samples = nested_tensor_from_tensor_list(
+                [torch.zeros(3, image_size, image_size, device=device)], with_mask=False)
+            priors = self.prior_generator(self.backbone(samples), [image_size, image_size])
+        self.train(was_training)
+        return priors
+
     @torch.jit.unused
     def eager_outputs(self, losses: Dict[str, Tensor], detections: List[Dict[str, Tensor]]):
         if self.training:
@@ -52,7 +74,8 @@ class GeneralizedSSD(nn.Module):
         """
         Arguments:
             samples (NestedTensor): Expects a NestedTensor, which consists of:
-               - samples.tensor: batched images, of shape [batch_size x 3 x H x W]
+               - samples.tensor: batched images, of shape [batch_size x 3 x H x W], the priors
+                 are computed for any input height and width
         Returns:
             result (list[BoxList] or dict[Tensor]): the output from the model.
                 During training, it returns a dict[Tensor] which contains the losses.
@@ -60,10 +83,15 @@ class GeneralizedSSD(nn.Module):
                 like `scores`, `labels` and `mask` (for Mask R-CNN models).
         """
         if isinstance(samples, (list, torch.Tensor)):
-            samples = nested_tensor_from_tensor_list(samples)
+            # the padding mask isn't used by the SSD models
+            samples = nested_tensor_from_tensor_list(samples, channels_last=self.channels_last, with_mask=False)
+        elif self.channels_last and not samples.tensors.is_contiguous(memory_format=torch.channels_last):
+            # batch the images with nested_tensor_from_tensor_list(..., channels_last=True) to avoid this copy
+            samples = NestedTensor(samples.tensors.contiguous(memory_format=torch.channels_last), samples.mask)
         features = self.backbone(samples)
 
-        priors = self.prior_generator(features)  # BoxMode: XYWHA_REL
+        image_size = list(samples.tensors.shape[-2:])
+        priors = self.prior_generator(features, image_size)  # BoxMode: XYWHA_REL
         logits, bbox_reg = self.multibox_head(features)
         out_ssd = {}
         detections = torch.jit.annotate(List[Dict[str, Tensor]], [])
@@ -80,3 +108,16 @@ class GeneralizedSSD(nn.Module):
             return (out_ssd, detections)
         else:
             return self.eager_outputs(out_ssd, detections)
+
+
+class WrappedDemonet(nn.Module):
+    """
+    Takes a list of images instead of a NestedTensor, for the scripted models of libtorch.
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, inputs: List[Tensor], target_sizes: Optional[Tensor] = None):
+        sample = nested_tensor_from_tensor_list(inputs)
+        return self.model(sample, target_sizes)
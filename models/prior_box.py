@@ -2,13 +2,16 @@
 # Modified by Zhiqiang Wang (zhiqwang@outlook.com)
 import torch
 from torch import nn, Tensor
+import torchvision
 from torch.jit.annotations import List, Optional, Dict, Tuple
 
 
 class AnchorGenerator(nn.Module):
     __annotations__ = {
         "cell_anchors": Optional[List[torch.Tensor]],
-        "_cache": Dict[str, List[torch.Tensor]]
+        "priors": torch.Tensor,
+        "_cache": Dict[str, torch.Tensor],
+        "_cache_keys": List[str],
     }
 
     """
@@ -19,6 +22,9 @@ class AnchorGenerator(nn.Module):
     per feature map. This module assumes aspect ratio = height / width for
     each anchor.
 
+    The priors are computed from the actual size of the input and of the feature maps,
+    and the priors of the last input sizes are kept in a small LRU cache.
+
     sizes (min_sizes, max_sizes) and aspect_ratios should have the same number of
     elements, and it should correspond to the number of feature maps.
 
@@ -27,7 +33,7 @@ class AnchorGenerator(nn.Module):
     per spatial location for feature map i.
 
     Arguments:
-        image_size (int): resized image size.
+        image_size (int): resized image size, used when the input size is not given to forward.
         aspect_ratios (List[List[int]]): optional aspect ratios of the boxes. can be multiple
         min_sizes (List[int]): minimum box size in pixels. can be multiple. required!.
         max_sizes (List[int]): maximum box size in pixels. can be ignored or same as the of min_size.
@@ -54,7 +60,14 @@ class AnchorGenerator(nn.Module):
 
         self.clip = clip
         self.cell_anchors = None
+        # priors of the last (grid sizes, image size, dtype), a plain attribute as cell_anchors, so
+        # they are neither saved in the state dict nor broadcast by DistributedDataParallel
+        self.priors = torch.empty(0)
+        self._priors_key = ''
+        # bounded cache of the priors of the other keys, the oldest key is evicted first
         self._cache = {}
+        self._cache_keys = []
+        self._max_cache_size = 8
 
     def compute_ratios(self, aspect_ratios):
         # type: (List(float)) -> Tuple(List(float), List(float))
@@ -148,29 +161,62 @@ class AnchorGenerator(nn.Module):
 
         return anchors
 
-    def cached_grid_anchors(self, grid_sizes, strides):
-        # type: (List[List[int]], List[List[Tensor]]) -> List[Tensor]
-        key = str(grid_sizes) + str(strides)
-        if key in self._cache:
-            return self._cache[key]
-        anchors = self.grid_anchors(grid_sizes, strides)
-        self._cache[key] = anchors
-        return anchors
-
-    def forward(self, feature_maps):
-        # type: (List[Tensor]) -> Tensor
-        grid_sizes = list([feature_map.shape[-2:] for feature_map in feature_maps])
-        dtype, device = feature_maps[0].dtype, feature_maps[0].device
-        strides = [[torch.tensor(self.image_size // g[0], dtype=torch.int64, device=device),
-                    torch.tensor(self.image_size // g[1], dtype=torch.int64, device=device)] for g in grid_sizes]
+    def cached_priors(self, grid_sizes, image_size, dtype, device):
+        # type: (List[List[int]], List[int], int, Device) -> Tensor  # noqa: F821
+        key = str(grid_sizes) + str(image_size) + str(dtype)
+        if key == self._priors_key:
+            priors = self.priors
+        elif key in self._cache:
+            priors = self._cache[key]
+            # least recently used first
+            self._cache_keys.remove(key)
+            self._cache_keys.append(key)
+        else:
+            priors = self.compute_priors(grid_sizes, image_size, dtype, device)
+            if len(self._cache_keys) >= self._max_cache_size:
+                del self._cache[self._cache_keys.pop(0)]
+            self._cache[key] = priors
+            self._cache_keys.append(key)
+        # the priors are not moved with the module
+        if priors.device != device:
+            priors = priors.to(device)
+            if key in self._cache:
+                self._cache[key] = priors
+        self.priors = priors
+        self._priors_key = key
+        return priors
+
+    def compute_priors(self, grid_sizes, image_size, dtype, device):
+        # type: (List[List[int]], List[int], int, Device) -> Tensor  # noqa: F821
+        image_height, image_width = image_size[0], image_size[1]
+        strides = [[torch.tensor(image_height // g[0], dtype=torch.int64, device=device),
+                    torch.tensor(image_width // g[1], dtype=torch.int64, device=device)] for g in grid_sizes]
         self.set_cell_anchors(dtype, device)
-        anchors_over_all_feature_maps = self.cached_grid_anchors(grid_sizes, strides)
+        anchors_over_all_feature_maps = self.grid_anchors(grid_sizes, strides)
         anchors_in_image = torch.jit.annotate(List[torch.Tensor], [])
         for anchors_per_feature_map in anchors_over_all_feature_maps:
             anchors_in_image.append(anchors_per_feature_map)
-        anchors = torch.cat(anchors_in_image) / self.image_size
+        anchors = torch.cat(anchors_in_image)
+        # the sizes of the priors stay in pixels, so they are not stretched on non-square inputs
+        scale = torch.tensor([image_width, image_height, image_width, image_height], dtype=anchors.dtype, device=device)
+        anchors = anchors / scale
         if self.clip:
             anchors.clamp_(min=0.0, max=1.0)
-        # Clear the cache in case that memory leaks.
-        self._cache.clear()
         return anchors
+
+    def forward(self, feature_maps, image_size=None):
+        # type: (List[Tensor], Optional[List[int]]) -> Tensor
+        """
+        Arguments:
+            feature_maps (List[Tensor]): feature maps of the backbone.
+            image_size (List[int], optional): [height, width] of the (batched) input, defaults to
+                the configured square image_size.
+        """
+        grid_sizes = list([feature_map.shape[-2:] for feature_map in feature_maps])
+        dtype, device = feature_maps[0].dtype, feature_maps[0].device
+        if image_size is None:
+            image_size = [self.image_size, self.image_size]
+        if torchvision._is_tracing():
+            # keep the priors traced from the feature map sizes
+            return self.compute_priors(grid_sizes, image_size, dtype, device)
+        return self.cached_priors(grid_sizes, image_size, dtype, device)
@@ -0,0 +1,174 @@
+# Copyright (c) 2020, Zhiqiang Wang. All Rights Reserved.
+"""
+Eager mode post training static quantization of the SSD-Lite backbone and head.
+"""
+import copy
+
+import torch
+from torch import nn, Tensor
+from torch.quantization import QuantStub, DeQuantStub, QuantWrapper
+try:
+    from torch.ao.quantization import fuse_modules_qat
+except ImportError:
+    # older releases fuse for quantization aware training when the modules are in training mode
+    from torch.quantization import fuse_modules as fuse_modules_qat
+
+from torchvision.models.mobilenet import InvertedResidual
+
+from modules.peleenet import BasicConv2d
+from util.misc import NestedTensor
+
+from .box_head import MultiBoxLiteHead
+from .fuse import fuse_for_inference
+
+from torch.jit.annotations import List
+
+
+class QuantizableInvertedResidual(nn.Module):
+    """
+    InvertedResidual whose skip connection goes through a FloatFunctional,
+    so that it can be quantized.
+    """
+    def __init__(self, block: InvertedResidual):
+        super().__init__()
+        self.conv = block.conv
+        self.use_res_connect = block.use_res_connect
+        self.skip_add = nn.quantized.FloatFunctional()
+
+    def forward(self, x: Tensor) -> Tensor:
+        if self.use_res_connect:
+            return self.skip_add.add(x, self.conv(x))
+        else:
+            return self.conv(x)
+
+
+def _replace_inverted_residual(module: nn.Module):
+    for name, child in module.named_children():
+        if isinstance(child, InvertedResidual):
+            setattr(module, name, QuantizableInvertedResidual(child))
+        else:
+            _replace_inverted_residual(child)
+
+
+class QuantizableBackbone(nn.Module):
+    """
+    Wraps a backbone between quant and dequant stubs, the returned features are in float.
+    """
+    def __init__(self, backbone: nn.Module):
+        super().__init__()
+        _replace_inverted_residual(backbone)
+        self.quant = QuantStub()
+        self.backbone = backbone
+        self.dequant = DeQuantStub()
+
+    def forward(self, tensor_list: NestedTensor) -> List[Tensor]:
+        tensor_list = NestedTensor(self.quant(tensor_list.tensors), tensor_list.mask)
+        features = self.backbone(tensor_list)
+        return [self.dequant(feature) for feature in features]
+
+
+def _fuse_conv_bn_qat(module: nn.Module):
+    """
+    Same as fuse_conv_bn, but the pairs are fused into ConvBn2d modules that keep
+    training their BatchNorm statistics with fake quantized weights.
+    """
+    for child in module.children():
+        _fuse_conv_bn_qat(child)
+
+    if isinstance(module, nn.Sequential):
+        layers = list(module.children())
+        for i in range(len(layers) - 1):
+            if isinstance(layers[i], nn.Conv2d) and isinstance(layers[i + 1], nn.BatchNorm2d):
+                fuse_modules_qat(module, [str(i), str(i + 1)], inplace=True)
+    elif isinstance(module, BasicConv2d):
+        fuse_modules_qat(module, ['conv', 'norm'], inplace=True)
+
+
+def _wrap_for_quantization(model: nn.Module, qconfig):
+    model.backbone = QuantizableBackbone(model.backbone)
+    model.backbone.qconfig = qconfig
+
+    head = model.multibox_head
+    assert isinstance(head, MultiBoxLiteHead), f'head {type(head).__name__} not supported'
+    for i in range(len(head.cls_logits)):
+        head.cls_logits[i] = QuantWrapper(head.cls_logits[i])
+        head.bbox_pred[i] = QuantWrapper(head.bbox_pred[i])
+    head.qconfig = qconfig
+
+
+def prepare_for_quantization(model: nn.Module, backend: str = 'fbgemm') -> nn.Module:
+    """
+    Returns a copy of a trained GeneralizedSSD ready to be calibrated. The BatchNorm layers
+    are folded, the backbone and every convolution of the MultiBoxLiteHead are wrapped
+    between quant and dequant stubs and get observers. The prior generator and the post
+    process stay in float.
+
+    Arguments:
+        model (GeneralizedSSD): the trained float model.
+        backend (str): quantized engine, 'fbgemm' for x86 and 'qnnpack' for ARM.
+    """
+    model = fuse_for_inference(copy.deepcopy(model).cpu())
+    _wrap_for_quantization(model, torch.quantization.get_default_qconfig(backend))
+
+    torch.backends.quantized.engine = backend
+    torch.quantization.prepare(model, inplace=True)
+    return model
+
+
+def prepare_for_qat(model: nn.Module, backend: str = 'fbgemm') -> nn.Module:
+    """
+    Prepares a GeneralizedSSD for quantization aware training, in place. The Conv2d and
+    BatchNorm2d pairs are fused and the backbone and head get fake quantization modules,
+    the model can then be fine-tuned as usual and converted with convert_to_quantized.
+    """
+    model.train()
+    _fuse_conv_bn_qat(model)
+    _wrap_for_quantization(model, torch.quantization.get_default_qat_qconfig(backend))
+
+    torch.backends.quantized.engine = backend
+    torch.quantization.prepare_qat(model, inplace=True)
+    return model
+
+
+def convert_to_quantized(model: nn.Module) -> nn.Module:
+    """
+    Returns the int8 copy of a model prepared with prepare_for_qat, for cpu inference.
+    """
+    model = copy.deepcopy(model).cpu()
+    model.eval()
+    torch.quantization.convert(model, inplace=True)
+    return model
+
+
+def build_quantized_model(model: nn.Module, backend: str = 'fbgemm') -> nn.Module:
+    """
+    Returns an int8 GeneralizedSSD with the same layout as the float model, the state dict
+    of a quantized model (post training or quantization aware) can be loaded into it.
+    """
+    model = prepare_for_quantization(model, backend)
+    torch.quantization.convert(model, inplace=True)
+    return model
+
+
+@torch.no_grad()
+def calibrate(model: nn.Module, data_loader, num_batches: int):
+    """
+    Collect the activation ranges of a prepared model on num_batches batches of data_loader.
+    """
+    model.eval()
+    for i, (samples, targets) in enumerate(data_loader):
+        if i >= num_batches:
+            break
+        target_sizes = torch.stack([t['orig_size'] for t in targets], dim=0)
+        model(samples, target_sizes=target_sizes)
+
+
+def quantize_model(model: nn.Module, data_loader, num_batches: int, backend: str = 'fbgemm') -> nn.Module:
+    """
+    Post training static quantization of a trained GeneralizedSSD, calibrated on the first
+    num_batches batches of data_loader. The original model is not modified.
+    """
+    model = prepare_for_quantization(model, backend)
+    calibrate(model, data_loader, num_batches)
+    torch.quantization.convert(model, inplace=True)
+    return model
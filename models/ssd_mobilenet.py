@@ -33,12 +33,24 @@ class SSDLiteWithMobileNetV2(GeneralizedSSD):
         score_thresh=0.5,
         nms_thresh=0.45,
         detections_per_img=100,
+        batched_post_process=False,
+        pre_nms_top_k=0,
+        pre_nms_top_k_per_class=0,
+        channels_last=False,
     ):
         prior_generator = AnchorGenerator(image_size, aspect_ratios, min_sizes, max_sizes, clip)
         multibox_head = MultiBoxLiteHead(hidden_dims, num_anchors, num_classes)
-        post_process = PostProcess(variances, score_thresh, nms_thresh, detections_per_img)
+        post_process = PostProcess(
+            variances,
+            score_thresh,
+            nms_thresh,
+            detections_per_img,
+            batched=batched_post_process,
+            pre_nms_top_k=pre_nms_top_k,
+            pre_nms_top_k_per_class=pre_nms_top_k_per_class,
+        )
 
-        super().__init__(backbone, prior_generator, multibox_head, post_process)
+        super().__init__(backbone, prior_generator, multibox_head, post_process, channels_last=channels_last)
 
 
 def build(args):
@@ -49,6 +61,10 @@ def build(args):
         image_size=args.image_size,
         num_classes=args.num_classes,
         score_thresh=args.score_thresh,
+        batched_post_process=args.batched_post_process,
+        pre_nms_top_k=args.pre_nms_top_k,
+        pre_nms_top_k_per_class=args.pre_nms_top_k_per_class,
+        channels_last=args.channels_last,
     )
 
     if args.return_criterion:
@@ -0,0 +1,120 @@
+"""
+Post training static quantization of SSD-Lite with MobileNetV2.
+
+Calibrates the int8 backbone and head on images of build_dataset, and reports
+the PASCAL VOC mAP and the CPU latency of the float and of the quantized model.
+"""
+import argparse
+import time
+from pathlib import Path
+
+import torch
+from torch.utils.data import DataLoader, Subset
+
+from models import build_model
+from models.quantization import quantize_model
+from util.misc import collate_fn, data_loader_kwargs, load_checkpoint
+
+from datasets import build_dataset
+from eval_voc import get_args_parser as get_eval_args_parser, evaluate
+
+
+@torch.no_grad()
+def measure_latency(model, image_size, batch_size, iters):
+    model.eval()
+    samples = torch.rand(batch_size, 3, image_size, image_size)
+    for _ in range(5):
+        model(samples)
+    start = time.perf_counter()
+    for _ in range(iters):
+        model(samples)
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def main(args):
+    print(args)
+
+    # the quantized kernels only run on cpu
+    device = torch.device('cpu')
+    torch.set_num_threads(args.num_threads)
+
+    if args.batch_augment:
+        raise ValueError('the calibration does not support --batch-augment')
+
+    # Data loading code
+    print("Loading data")
+    dataset_val = build_dataset(args.val_set, args.dataset_year, args)
+    # the activation ranges are observed on images preprocessed as in the evaluation
+    dataset_calibration = build_dataset(args.calibration_set, args.dataset_year, args, eval_transforms=True)
+    num_images = min(args.num_calibration_images, len(dataset_calibration))
+    generator = torch.Generator().manual_seed(args.seed)
+    indices = torch.randperm(len(dataset_calibration), generator=generator)[:num_images].tolist()
+    dataset_calibration = Subset(dataset_calibration, indices)
+
+    print("Creating data loaders")
+    data_loader_val = DataLoader(
+        dataset_val,
+        args.batch_size,
+        sampler=torch.utils.data.SequentialSampler(dataset_val),
+        drop_last=False,
+        collate_fn=collate_fn,
+        **data_loader_kwargs(args),
+    )
+    data_loader_calibration = DataLoader(
+        dataset_calibration,
+        args.batch_size,
+        drop_last=False,
+        collate_fn=collate_fn,
+        **data_loader_kwargs(args),
+    )
+
+    print("Creating model")
+    model = build_model(args)
+    checkpoint = load_checkpoint(args.resume)
+    model.load_state_dict(checkpoint)
+    model.eval()
+
+    print(f"Calibrating on {num_images} images")
+    quantized_model = quantize_model(model, data_loader_calibration, len(data_loader_calibration), args.backend)
+
+    output_dir = Path(args.output_dir)
+    results = []
+    for name, m in [('float', model), ('int8', quantized_model)]:
+        print(f"Evaluating the {name} model")
+        mean_ap = evaluate(m, data_loader_val, device, output_dir / name, num_workers=args.num_workers)
+        latency = measure_latency(m, args.image_size, args.latency_batch_size, args.latency_iters)
+        results.append((name, mean_ap, latency))
+
+    print(f"{'model':>8} {'mAP':>8} {'latency (ms)':>14}")
+    for name, mean_ap, latency in results:
+        print(f"{name:>8} {mean_ap:>8.4f} {latency:>14.2f}")
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Quantize single shot multiBox detector', add_help=False)
+    parser.add_argument('--calibration-set', default='train',
+                        help='set of the calibration images')
+    parser.add_argument('--seed', default=42, type=int,
+                        help='seed of the selection of the calibration images')
+    parser.add_argument('--num-calibration-images', default=256, type=int,
+                        help='number of images used to calibrate the activation ranges')
+    parser.add_argument('--num-threads', default=1, type=int,
+                        help='number of cpu threads used for the latency measure')
+    parser.add_argument('--latency-batch-size', default=1, type=int,
+                        help='batch size of the latency measure')
+    parser.add_argument('--latency-iters', default=50, type=int,
+                        help='number of timed iterations of the latency measure')
+    return parser
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        'DEMONET post training quantization script',
+        parents=[get_eval_args_parser(), get_args_parser()],
+    )
+    args = parser.parse_args()
+
+    if args.output_dir:
+        Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+
+    main(args)
@@ -0,0 +1,244 @@
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+from PIL import Image
+
+import torch
+
+from datasets import transforms as T
+from datasets import batch_transforms as BT
+from datasets.annotation_index import VOCAnnotationIndex
+from datasets.image_cache import ImageCache
+from datasets.voc import ConvertVOCtoCOCO
+from datasets.voc_eval import VOCEvaluator, _write_voc_results_file, voc_eval, voc_eval_class
+from util.box_ops import box_iou
+from util.misc import collate_fn
+
+
+class DatasetsTester(unittest.TestCase):
+
+    def test_image_cache(self):
+        rng = np.random.RandomState(42)
+        images = [Image.fromarray(rng.randint(0, 256, size=(h, w, 3), dtype=np.uint8))
+                  for h, w in [(375, 500), (500, 333), (700, 900)]]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'val')
+            self.assertFalse(ImageCache.exists(path))
+            ImageCache.build(path, images.__getitem__, len(images), (300, 300))
+            self.assertTrue(ImageCache.exists(path))
+            image_cache = ImageCache(path)
+            self.assertEqual(len(image_cache), 3)
+            for i, image in enumerate(images):
+                # the evaluation transforms see the same pixels
+                expected, _ = T.resize(image, None, (300, 300))
+                self.assertTrue(np.array_equal(np.asarray(image_cache[i]), np.asarray(expected)))
+
+            path = os.path.join(tmp_dir, 'train')
+            ImageCache.build(path, images.__getitem__, len(images), 600)
+            image_cache = ImageCache(path)
+            self.assertTrue(np.array_equal(np.asarray(image_cache[0]), np.asarray(images[0])))
+            self.assertTrue(np.array_equal(np.asarray(image_cache[1]), np.asarray(images[1])))
+            self.assertEqual(image_cache[2].size, (771, 600))
+
+    def test_voc_annotation_index(self):
+        targets = []
+        for i, num_objects in enumerate([3, 0, 1]):
+            targets.append({
+                'boxes': torch.randint(0, 300, (num_objects, 4)).float(),
+                'labels': torch.randint(1, 21, (num_objects,)),
+                'ishard': torch.randint(0, 2, (num_objects,)),
+                'image_id': torch.tensor([i]),
+                'orig_size': torch.tensor([375, 500 + i]),
+                'size': torch.tensor([375, 500 + i]),
+                'filename': torch.tensor([ord(c) for c in f'00000{i}'], dtype=torch.int8),
+            })
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'voc2007_val')
+            VOCAnnotationIndex.build(path, targets.__getitem__, len(targets))
+            self.assertTrue(VOCAnnotationIndex.exists(path))
+            annotation_index = VOCAnnotationIndex(path)
+            self.assertEqual(len(annotation_index), 3)
+            # as in a DataLoader worker
+            annotation_index = pickle.loads(pickle.dumps(annotation_index))
+            for i, expected in enumerate(targets):
+                target = annotation_index[i]
+                self.assertEqual(target.keys(), expected.keys())
+                for k in expected:
+                    self.assertEqual(target[k].dtype, expected[k].dtype)
+                    self.assertTrue(target[k].equal(expected[k]))
+
+    def test_resize_target(self):
+        target = {'boxes': torch.tensor([[10., 20., 110., 220.]]), 'area': torch.tensor([20000.])}
+        target = T.resize_target(target, (500, 400), (250, 100))
+        self.assertTrue(target['boxes'].equal(torch.tensor([[5., 5., 55., 55.]])))
+        self.assertAlmostEqual(target['area'].item(), 2500.)
+        self.assertEqual(target['size'].tolist(), [100, 250])
+
+    def test_batch_transforms(self):
+        rng = np.random.RandomState(42)
+        images, targets = [], []
+        for h, w in [(150, 200), (180, 120)]:
+            # smooth images, bilinear upsampling of random pixels
+            image = Image.fromarray(rng.randint(0, 256, size=(h // 10, w // 10, 3), dtype=np.uint8))
+            images.append(image.resize((w, h), Image.BILINEAR))
+            boxes = torch.tensor([[10., 20., 100., 90.], [5., 5., 50., 60.]])
+            targets.append({
+                'boxes': boxes,
+                'labels': torch.tensor([1, 2]),
+                'area': (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]),
+                'image_id': torch.tensor([len(targets)]),
+                'size': torch.tensor([h, w]),
+            })
+        batch = collate_fn([T.PILToTensor()(image, target) for image, target in zip(images, targets)], with_mask=False)
+
+        # crop of the first image only, then flip and resize
+        regions = torch.tensor([[30, 40, 120, 100], [0, 0, 0, 0]])
+        batch_transforms = BT.BatchCompose([
+            lambda b: BT.batch_crop(b, regions, torch.tensor([True, False])) or b,
+            BT.BatchRandomHorizontalFlip(p=1.),
+            BT.BatchResize(300),
+            BT.BatchToTensor(),
+        ])
+        samples, results = batch_transforms(*batch)
+        self.assertEqual(samples.tensors.shape, (2, 3, 300, 300))
+        for i, (image, target) in enumerate(zip(images, targets)):
+            if i == 0:
+                image, target = T.crop(image, target, (40, 30, 100, 120))
+            image, target = T.hflip(image, target)
+            image, target = T.resize(image, target, (300, 300))
+            image, target = T.ToTensor()(image, target)
+            # the pixels of PIL are rounded to uint8, and the borders of its crops only
+            # interpolate the pixels inside the crop
+            torch.testing.assert_close(samples.tensors[i, :, 2:-2, 2:-2], image[:, 2:-2, 2:-2], rtol=0, atol=1.01 / 255)
+            self.assertEqual(results[i].keys(), target.keys())
+            for k in target:
+                torch.testing.assert_close(results[i][k], target[k])
+
+        batch_transforms = BT.make_batch_transforms('train', 300)
+        for _ in range(10):
+            samples, results = batch_transforms(*batch)
+            self.assertEqual(samples.tensors.shape, (2, 3, 300, 300))
+            for result in results:
+                boxes = result['boxes']
+                self.assertGreater(len(boxes), 0)
+                self.assertTrue((boxes[:, 2:] > boxes[:, :2]).all())
+                self.assertTrue(((boxes >= 0) & (boxes <= 1)).all())
+                self.assertEqual(len(result['labels']), len(boxes))
+
+    def test_sample_min_iou_crops(self):
+        torch.manual_seed(42)
+        boxes = torch.tensor([[10., 20., 200., 190.], [50., 60., 150., 260.], [100., 100., 300., 290.]])
+        batch_index = torch.tensor([0, 0, 1])
+        sizes = torch.tensor([[500, 375], [333, 500]])
+        min_ious = torch.tensor([0.3, 0.1])
+        regions, found = T.sample_min_iou_crops(boxes, batch_index, sizes, min_ious, min_scale=0.3, num_candidates=500)
+        self.assertTrue(found.all())
+        for i, (x, y, w, h) in enumerate(regions.tolist()):
+            self.assertTrue(0 <= x and x + w <= sizes[i, 0] and 0 <= y and y + h <= sizes[i, 1])
+            self.assertTrue(0.5 <= h / w <= 2)
+            image_boxes = boxes[batch_index == i]
+            iou, _ = box_iou(torch.tensor([[x, y, x + w, y + h]], dtype=torch.float32), image_boxes)
+            self.assertTrue((iou >= min_ious[i]).all())
+            centers = (image_boxes[:, :2] + image_boxes[:, 2:]) / 2
+            inside = (centers > torch.tensor([x, y])) & (centers < torch.tensor([x + w, y + h]))
+            self.assertTrue(inside.all(dim=1).any())
+
+        # no crop can have an IoU of 0.9 with two distant boxes
+        regions, found = T.sample_min_iou_crops(
+            boxes[[0, 2]], torch.tensor([0, 0]), sizes[:1], torch.tensor([0.9]), num_candidates=500)
+        self.assertFalse(found.any())
+
+    def test_photometric_distort(self):
+        torch.manual_seed(42)
+        images = torch.rand(4, 3, 8, 8)
+        matrix, bias = T.photometric_distort_params(4, p=0.)
+        torch.testing.assert_close(T.color_transform(images.clone(), matrix, bias), images)
+
+        # the saturation, the hue and the channels permutation keep the grays
+        gray_images = torch.rand(4, 1, 8, 8).expand(4, 3, 8, 8)
+        matrix, bias = T.photometric_distort_params(4, brightness=0.1, p=1.)
+        outputs = T.color_transform(gray_images.clone(), matrix, bias)
+        torch.testing.assert_close(outputs, outputs[:, :1].expand_as(outputs))
+        alpha = matrix.sum(dim=2)[:, 0]
+        delta = bias[:, 0] / alpha
+        expected = (alpha[:, None, None, None] * (gray_images + delta[:, None, None, None])).clamp(0, 1)
+        torch.testing.assert_close(outputs, expected)
+
+    def test_voc_evaluator(self):
+        torch.manual_seed(42)
+        rng = np.random.RandomState(42)
+        cls_names = ConvertVOCtoCOCO.CLASSES
+        imagenames, targets, results, annotations = [], [], [], []
+        for i in range(50):
+            num_objects = rng.randint(0, 6)
+            xy = rng.randint(1, 300, size=(num_objects, 2))
+            boxes = np.concatenate([xy, xy + rng.randint(5, 100, size=(num_objects, 2))], axis=1)
+            labels = rng.randint(1, len(cls_names), size=num_objects)
+            difficult = rng.rand(num_objects) < 0.2
+            imagenames.append(f'{i:06d}')
+            annotations.append(''.join(
+                f'<object><name>{cls_names[label]}</name><difficult>{int(d)}</difficult><bndbox>'
+                f'<xmin>{b[0]}</xmin><ymin>{b[1]}</ymin><xmax>{b[2]}</xmax><ymax>{b[3]}</ymax></bndbox></object>'
+                for b, label, d in zip(boxes, labels, difficult)))
+            targets.append({
+                # the boxes of ConvertVOCtoCOCO are 0-based
+                'boxes': torch.as_tensor(boxes - 1, dtype=torch.float32).reshape(-1, 4),
+                'labels': torch.as_tensor(labels),
+                'ishard': torch.as_tensor(difficult, dtype=torch.int64),
+                'filename': torch.tensor([ord(c) for c in imagenames[-1]], dtype=torch.int8),
+            })
+            # detections around the ground truth boxes, of random classes for some of them
+            index = rng.randint(0, max(num_objects, 1), size=30)
+            det_boxes = torch.as_tensor(boxes[index] if num_objects else rng.rand(30, 4) * 300, dtype=torch.float32)
+            det_boxes = det_boxes - 1 + torch.randn(30, 4) * 5
+            det_labels = labels[index] if num_objects else rng.randint(1, len(cls_names), size=30)
+            det_labels = np.where(rng.rand(30) < 0.3, rng.randint(1, len(cls_names), size=30), det_labels)
+            results.append({
+                'boxes': torch.cat([det_boxes[:, :2].min(det_boxes[:, 2:]), det_boxes[:, :2].max(det_boxes[:, 2:])], 1),
+                'scores': torch.rand(30),
+                'labels': torch.as_tensor(det_labels),
+            })
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.makedirs(os.path.join(tmp_dir, 'Annotations'))
+            for name, annotation in zip(imagenames, annotations):
+                with open(os.path.join(tmp_dir, 'Annotations', f'{name}.xml'), 'w') as f:
+                    f.write(f'<annotation>{annotation}</annotation>')
+            imagesetfile = os.path.join(tmp_dir, 'test.txt')
+            with open(imagesetfile, 'w') as f:
+                f.write('\n'.join(imagenames))
+
+            # the detections of the results files, as eval_voc wrote them
+            all_boxes = [[] for _ in cls_names]
+            for result in results:
+                for cls_ind in range(len(cls_names)):
+                    keep = result['labels'] == cls_ind
+                    dets = torch.cat([result['boxes'][keep], result['scores'][keep, None]], dim=1).tolist()
+                    all_boxes[cls_ind].append([np.array(det) for det in dets])
+            _write_voc_results_file(all_boxes, imagenames, cls_names, tmp_dir)
+
+            for use_07_metric in [True, False]:
+                voc_evaluator = VOCEvaluator(imagenames, targets, cls_names, use_07_metric=use_07_metric)
+                voc_evaluator.update(targets, results)
+                # the repeated images of the DistributedSampler are ignored
+                voc_evaluator.update(targets[:1], results[1:2])
+                for cls_name, class_arrays in voc_evaluator._class_arrays():
+                    _, _, expected = voc_eval(
+                        os.path.join(tmp_dir, 'results', 'det_test_{:s}.txt'),
+                        os.path.join(tmp_dir, 'Annotations', '{:s}.xml'),
+                        imagesetfile, cls_name, ovthresh=0.5, use_07_metric=use_07_metric,
+                    )
+                    _, _, ap = voc_eval_class(**class_arrays)
+                    self.assertAlmostEqual(ap, expected, places=6)
+
+                mean_ap = voc_evaluator.evaluate(num_workers=2)
+                self.assertGreater(mean_ap, 0.1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,15 +1,29 @@
+import copy
+import math
 import unittest
 
 import torch
+from torchvision.ops.boxes import box_iou
 
 from models.backbone import MobileNetWithExtraBlocks
 from models.prior_box import AnchorGenerator
-from models.box_head import MultiBoxLiteHead, PostProcess, SetCriterion
-from models.generalized_ssd import GeneralizedSSD
+from models.box_head import (
+    FusedMultiBoxLiteHead,
+    MultiBoxLiteHead,
+    PostProcess,
+    SetCriterion,
+    _onnx_concat_box_prediction_layers,
+    concat_box_prediction_layers,
+)
+from models.generalized_ssd import GeneralizedSSD, WrappedDemonet
+from models._utils import BalancedPositiveNegativeSampler, BoxCoder
+from models.fuse import fuse_for_inference
+from models.quantization import build_quantized_model, convert_to_quantized, prepare_for_qat, quantize_model
+from modules.peleenet import BasicConv2d, peleenet_v1
 
-from util.misc import nested_tensor_from_tensor_list
-
-from .utils import WrappedDemonet
+from engine import train_one_epoch
+from util.lr_scheduler import WarmupLRScheduler
+from util.misc import AssignTargetsCollator, DataPrefetcher, collate_fn, nested_tensor_from_tensor_list
 
 
 class ModelTester(unittest.TestCase):
@@ -39,12 +53,19 @@ class ModelTester(unittest.TestCase):
         box_head = MultiBoxLiteHead(hidden_dims, num_anchors, num_classes)
         return box_head
 
-    def _init_test_postprocessors(self):
+    def _init_test_postprocessors(self, score_thresh=0.5, batched=False, pre_nms_top_k=0, pre_nms_top_k_per_class=0):
         variances = (0.1, 0.2)
-        score_thresh = 0.5
         nms_thresh = 0.45
         detections_per_img = 100
-        postprocessors = PostProcess(variances, score_thresh, nms_thresh, detections_per_img)
+        postprocessors = PostProcess(
+            variances,
+            score_thresh,
+            nms_thresh,
+            detections_per_img,
+            batched=batched,
+            pre_nms_top_k=pre_nms_top_k,
+            pre_nms_top_k_per_class=pre_nms_top_k_per_class,
+        )
         return postprocessors
 
     def _init_test_criterion(self):
@@ -58,18 +79,527 @@ class ModelTester(unittest.TestCase):
         model = self._init_test_prior_generator()
         scripted_model = torch.jit.script(model)  # noqa
 
+    def test_prior_generator_cache(self):
+        model = self._init_test_prior_generator()
+        feature_maps = [torch.rand(1, 1, s, s) for s in [20, 10, 5, 3, 2, 1]]
+        priors = model(feature_maps)
+        self.assertIs(model(feature_maps), priors)
+        self.assertNotIn('priors', model.state_dict())
+        self.assertNotIn('priors', dict(model.named_buffers()))
+
+        for i in range(model._max_cache_size + 2):
+            model([torch.rand(1, 1, s + i + 1, s) for s in [20, 10, 5, 3, 2, 1]])
+        self.assertEqual(len(model._cache), model._max_cache_size)
+        self.assertTrue(model(feature_maps).equal(priors))
+
+    def test_prior_generator_multi_resolution(self):
+        model = self._init_test_prior_generator()
+        feature_maps = [torch.rand(1, 1, s, s) for s in [20, 10, 5, 3, 2, 1]]
+        priors = model(feature_maps)
+        self.assertTrue(model(feature_maps, [320, 320]).equal(priors))
+
+        # the priors keep their size in pixels on a larger and non-square input
+        grid_sizes = [(20, 40), (10, 20), (5, 10), (3, 5), (2, 3), (1, 1)]
+        priors_wide = model([torch.rand(1, 1, h, w) for h, w in grid_sizes], [320, 640])
+        self.assertEqual(priors_wide.shape[0], 6 * sum(h * w for h, w in grid_sizes))
+        self.assertTrue(priors_wide[:6, 2].equal(priors[:6, 2] / 2))
+        self.assertTrue(priors_wide[:6, 3].equal(priors[:6, 3]))
+
+        # least recently used priors are evicted first
+        model._max_cache_size = 2
+        model([torch.rand(1, 1, s, s) for s in [20, 10, 5, 3, 2, 1]])
+        model([torch.rand(1, 1, s, s) for s in [40, 20, 10, 5, 3, 1]], [640, 640])
+        self.assertEqual(len(model._cache), 2)
+        self.assertNotIn(model._cache_keys[0], model._cache_keys[1:])
+        self.assertIn('[320, 320]', model._cache_keys[0])
+
+    def test_ssd_non_square_input(self):
+        backbone = self._init_test_backbone()
+        prior_generator = self._init_test_prior_generator()
+        multibox_head = self._init_test_multibox_head()
+        post_process = self._init_test_postprocessors()
+        model = GeneralizedSSD(backbone, prior_generator, multibox_head, post_process)
+        model.eval()
+
+        x = nested_tensor_from_tensor_list([torch.rand(3, 320, 480)])
+        out = model(x)
+        self.assertEqual(len(out), 1)
+        logits, _ = model.multibox_head(model.backbone(x))
+        self.assertEqual(model.prior_generator.priors.shape[0], logits.shape[1])
+
+    def test_ssd_channels_last(self):
+        torch.manual_seed(42)
+        backbone = self._init_test_backbone()
+        prior_generator = self._init_test_prior_generator()
+        multibox_head = self._init_test_multibox_head()
+        post_process = self._init_test_postprocessors()
+        model = GeneralizedSSD(backbone, prior_generator, multibox_head, post_process)
+        model.eval()
+        model_channels_last = copy.deepcopy(model)
+        model_channels_last.channels_last = True
+        model_channels_last.to(memory_format=torch.channels_last)
+
+        images = [torch.rand(3, 320, 320), torch.rand(3, 288, 320)]
+        x = nested_tensor_from_tensor_list(images)
+        x_channels_last = nested_tensor_from_tensor_list(images, channels_last=True)
+        self.assertTrue(x_channels_last.tensors.is_contiguous(memory_format=torch.channels_last))
+        self.assertTrue(x_channels_last.tensors.equal(x.tensors))
+        self.assertTrue(x_channels_last.mask.equal(x.mask))
+
+        features = model_channels_last.backbone(x_channels_last)
+        self.assertTrue(all(f.is_contiguous(memory_format=torch.channels_last) for f in features))
+        logits, bbox_reg = model.multibox_head(model.backbone(x))
+        logits_channels_last, bbox_reg_channels_last = model_channels_last.multibox_head(features)
+        self.assertTrue(torch.allclose(logits_channels_last, logits, atol=1e-4))
+        self.assertTrue(torch.allclose(bbox_reg_channels_last, bbox_reg, atol=1e-4))
+
+        # the NCHW batch is converted in the forward
+        scripted_model = torch.jit.script(model_channels_last)
+        out = model_channels_last(images)
+        out_script = scripted_model(x)[1]
+        self.assertTrue(out[0]["boxes"].equal(out_script[0]["boxes"]))
+
+    def test_concat_box_prediction_layers(self):
+        torch.manual_seed(42)
+        sizes = [(20, 20), (10, 10), (5, 5), (3, 3), (2, 2), (1, 1)]
+        box_cls = [torch.rand(2, 6 * 21, h, w, requires_grad=True) for h, w in sizes]
+        box_regression = [torch.rand(2, 6 * 4, h, w, requires_grad=True) for h, w in sizes]
+
+        expected_cls, expected_regression = _onnx_concat_box_prediction_layers(box_cls, box_regression)
+        expected_grads = torch.autograd.grad(
+            (expected_cls.sum(-1) * expected_regression.sum(-1)).sum(), box_cls + box_regression)
+        out_cls, out_regression = concat_box_prediction_layers(box_cls, box_regression)
+        self.assertTrue(out_cls.equal(expected_cls))
+        self.assertTrue(out_regression.equal(expected_regression))
+        grads = torch.autograd.grad((out_cls.sum(-1) * out_regression.sum(-1)).sum(), box_cls + box_regression)
+        self.assertTrue(all(g.allclose(e) for g, e in zip(grads, expected_grads)))
+
+        box_cls = [x.contiguous(memory_format=torch.channels_last) for x in box_cls]
+        box_regression = [x.contiguous(memory_format=torch.channels_last) for x in box_regression]
+        out_cls, out_regression = concat_box_prediction_layers(box_cls, box_regression)
+        self.assertTrue(out_cls.equal(expected_cls))
+        self.assertTrue(out_regression.equal(expected_regression))
+
+    def test_nested_tensor_from_tensor_list(self):
+        images = [torch.rand(3, 320, 320) for _ in range(3)]
+        x = nested_tensor_from_tensor_list(images)
+        self.assertTrue(x.tensors.equal(torch.stack(images)))
+        self.assertFalse(x.mask.any())
+        self.assertIsNone(nested_tensor_from_tensor_list(images, with_mask=False).mask)
+
+        images = [torch.rand(3, 320, 288), torch.rand(3, 300, 320)]
+        x = nested_tensor_from_tensor_list(images)
+        self.assertEqual(list(x.tensors.shape), [2, 3, 320, 320])
+        self.assertTrue(x.tensors[0, :, :, :288].equal(images[0]))
+        self.assertEqual(x.tensors[0, :, :, 288:].abs().sum().item(), 0)
+        self.assertTrue(x.tensors[1, :, :300].equal(images[1]))
+        self.assertEqual(x.tensors[1, :, 300:].abs().sum().item(), 0)
+        self.assertEqual(x.mask[0].sum().item(), 320 * 32)
+        self.assertEqual(x.mask[1].sum().item(), 20 * 320)
+        x_channels_last = nested_tensor_from_tensor_list(images, channels_last=True, with_mask=False)
+        self.assertTrue(x_channels_last.tensors.equal(x.tensors))
+        self.assertIsNone(x_channels_last.mask)
+
+    def test_data_prefetcher(self):
+        dataset = [(torch.rand(3, 64, 64), {'boxes': torch.rand(2, 4), 'labels': torch.tensor([1, 2])})
+                   for _ in range(5)]
+        data_loader = torch.utils.data.DataLoader(dataset, batch_size=2, collate_fn=collate_fn)
+        prefetcher = DataPrefetcher(data_loader, torch.device('cpu'))
+        self.assertEqual(len(prefetcher), 3)
+
+        batches = list(prefetcher)
+        self.assertEqual(len(batches), 3)
+        for (samples, targets), (expected_samples, expected_targets) in zip(batches, data_loader):
+            self.assertTrue(samples.tensors.equal(expected_samples.tensors))
+            self.assertTrue(targets[0]['boxes'].equal(expected_targets[0]['boxes']))
+        # the prefetcher can be iterated again, like the data loader
+        self.assertEqual(len(list(prefetcher)), 3)
+
     def test_multibox_head_script(self):
         model = self._init_test_multibox_head()
         scripted_model = torch.jit.script(model)  # noqa
 
+    def test_fused_multibox_head(self):
+        torch.manual_seed(42)
+        model = self._init_test_multibox_head()
+        for m in model.modules():
+            if isinstance(m, torch.nn.BatchNorm2d):
+                m.running_mean.uniform_(-0.5, 0.5)
+                m.running_var.uniform_(0.5, 1.5)
+                m.weight.data.uniform_(0.5, 1.5)
+                m.bias.data.uniform_(-0.5, 0.5)
+        model.eval()
+        fused_model = FusedMultiBoxLiteHead(model)
+        fused_model.eval()
+
+        features = [torch.rand(2, c, s, s) for c, s in zip([96, 1280, 512, 256, 256, 64], [20, 10, 5, 3, 2, 1])]
+        logits, bbox_reg = model(features)
+        logits_fused, bbox_reg_fused = fused_model(features)
+        self.assertTrue(logits.allclose(logits_fused, atol=1e-5))
+        self.assertTrue(bbox_reg.allclose(bbox_reg_fused, atol=1e-5))
+
+        scripted_model = torch.jit.script(fused_model)
+        logits_script, _ = scripted_model(features)
+        self.assertTrue(logits_fused.equal(logits_script))
+
+    def test_fuse_for_inference(self):
+        torch.manual_seed(42)
+        backbone = self._init_test_backbone()
+        prior_generator = self._init_test_prior_generator()
+        multibox_head = self._init_test_multibox_head()
+        post_process = self._init_test_postprocessors()
+        model = GeneralizedSSD(backbone, prior_generator, multibox_head, post_process)
+        for m in model.modules():
+            if isinstance(m, torch.nn.BatchNorm2d):
+                m.running_mean.uniform_(-0.1, 0.1)
+                m.running_var.uniform_(0.5, 1.5)
+        model.eval()
+
+        x = nested_tensor_from_tensor_list([torch.rand(3, 320, 320), torch.rand(3, 320, 320)])
+        features = model.backbone(x)
+        logits, bbox_reg = model.multibox_head(features)
+
+        for fuse_head in [False, True]:
+            fused_model = fuse_for_inference(copy.deepcopy(model), fuse_head=fuse_head)
+            self.assertFalse(any(isinstance(m, torch.nn.BatchNorm2d) for m in fused_model.modules()))
+
+            fused_features = fused_model.backbone(x)
+            for feature, fused_feature in zip(features, fused_features):
+                self.assertTrue(feature.allclose(fused_feature, rtol=1e-4, atol=1e-4))
+            fused_logits, fused_bbox_reg = fused_model.multibox_head(fused_features)
+            self.assertTrue(logits.allclose(fused_logits, rtol=1e-4, atol=1e-4))
+            self.assertTrue(bbox_reg.allclose(fused_bbox_reg, rtol=1e-4, atol=1e-4))
+
+        torch.jit.script(fused_model)
+
+    def _init_test_pelee_features(self):
+        # models.pelee needs models.multibox_head, the features and the BasicConv2d extras of
+        # Pelee are assembled as in models.pelee.build_extras(704, batch_norm=True)
+        extras = [
+            BasicConv2d(704, 128, kernel_size=1),
+            BasicConv2d(128, 256, kernel_size=3, padding=1, stride=2),
+            BasicConv2d(256, 128, kernel_size=1),
+            BasicConv2d(128, 256, kernel_size=3),
+        ]
+        return torch.nn.Sequential(peleenet_v1().features, *extras)
+
+    def test_fuse_for_inference_pelee(self):
+        torch.manual_seed(42)
+        for name, model in [('peleenet', peleenet_v1(num_classes=10)), ('pelee', self._init_test_pelee_features())]:
+            with self.subTest(model=name):
+                for m in model.modules():
+                    if isinstance(m, torch.nn.BatchNorm2d):
+                        m.weight.data.uniform_(0.5, 1.5)
+                        m.bias.data.uniform_(-0.1, 0.1)
+                        m.running_mean.uniform_(-0.1, 0.1)
+                        m.running_var.uniform_(0.5, 1.5)
+                model.eval()
+
+                x = torch.rand(2, 3, 304, 304)
+                with torch.no_grad():
+                    out = model(x)
+                    fused_model = fuse_for_inference(copy.deepcopy(model))
+                    self.assertFalse(any(isinstance(m, torch.nn.BatchNorm2d) for m in fused_model.modules()))
+                    self.assertTrue(any(isinstance(m, BasicConv2d) for m in fused_model.modules()))
+                    fused_out = fused_model(x)
+                torch.testing.assert_close(fused_out, out, rtol=1e-4, atol=1e-4)
+
+    def test_quantize_model(self):
+        torch.manual_seed(42)
+        backbone = self._init_test_backbone()
+        prior_generator = self._init_test_prior_generator()
+        multibox_head = self._init_test_multibox_head()
+        post_process = self._init_test_postprocessors(score_thresh=0.01)
+        model = GeneralizedSSD(backbone, prior_generator, multibox_head, post_process)
+        model.eval()
+
+        targets = [{'orig_size': torch.tensor([320, 320])}] * 2
+        data_loader = [(nested_tensor_from_tensor_list([torch.rand(3, 320, 320) for _ in range(2)]), targets)]
+        quantized_model = quantize_model(model, data_loader, 1)
+        self.assertTrue(any(isinstance(m, torch.nn.quantized.Conv2d) for m in quantized_model.modules()))
+        # the original model is kept in float
+        self.assertFalse(any(isinstance(m, torch.nn.quantized.Conv2d) for m in model.modules()))
+
+        out = quantized_model(torch.rand(2, 3, 320, 320))
+        self.assertEqual(len(out), 2)
+        self.assertEqual(out[0]['boxes'].dtype, torch.float32)
+
+    def test_quantization_aware_training(self):
+        torch.manual_seed(42)
+        backbone = self._init_test_backbone()
+        prior_generator = self._init_test_prior_generator()
+        multibox_head = self._init_test_multibox_head()
+        post_process = self._init_test_postprocessors(score_thresh=0.01)
+        model = GeneralizedSSD(backbone, prior_generator, multibox_head, post_process)
+        criterion = self._init_test_criterion()
+        float_model = copy.deepcopy(model)
+
+        prepare_for_qat(model)
+        boxes = torch.tensor([[0.1, 0.1, 0.5, 0.6]])
+        targets = [{'boxes': boxes, 'labels': torch.tensor([3])}] * 2
+        outputs = model(nested_tensor_from_tensor_list([torch.rand(3, 320, 320), torch.rand(3, 320, 320)]))
+        losses = criterion(outputs, targets)
+        sum(losses.values()).backward()
+
+        quantized_model = convert_to_quantized(model)
+        self.assertTrue(model.training)
+        x = torch.rand(2, 3, 320, 320)
+        out = quantized_model(x)
+
+        # the int8 state dict can be loaded back for evaluation
+        loaded_model = build_quantized_model(float_model)
+        loaded_model.load_state_dict(quantized_model.state_dict())
+        out_loaded = loaded_model(x)
+        self.assertTrue(out[0]['scores'].equal(out_loaded[0]['scores']))
+        self.assertTrue(out[0]['boxes'].equal(out_loaded[0]['boxes']))
+
+    def test_criterion_autocast_bfloat16(self):
+        torch.manual_seed(42)
+        backbone = self._init_test_backbone()
+        prior_generator = self._init_test_prior_generator()
+        multibox_head = self._init_test_multibox_head()
+        model = GeneralizedSSD(backbone, prior_generator, multibox_head, None)
+        criterion = self._init_test_criterion()
+
+        boxes = torch.tensor([[0.1, 0.1, 0.5, 0.6], [0.3, 0.2, 0.9, 0.8]])
+        targets = [{'boxes': boxes, 'labels': torch.tensor([3, 7])}] * 2
+        x = nested_tensor_from_tensor_list([torch.rand(3, 320, 320), torch.rand(3, 320, 320)])
+
+        losses = criterion(model(x), targets)
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            outputs = model(x)
+            losses_amp = criterion(outputs, targets)
+        self.assertEqual(outputs['pred_logits'].dtype, torch.bfloat16)
+
+        for k in losses:
+            self.assertEqual(losses_amp[k].dtype, torch.float32)
+            self.assertTrue(torch.isfinite(losses_amp[k]))
+            self.assertTrue(losses_amp[k].allclose(losses[k], rtol=0.05))
+        sum(losses_amp.values()).backward()
+
     def test_postprocessors_script(self):
         model = self._init_test_postprocessors()
         scripted_model = torch.jit.script(model)  # noqa
 
+    def test_batched_postprocessors_script(self):
+        model = self._init_test_postprocessors(batched=True)
+        scripted_model = torch.jit.script(model)  # noqa
+
+    def _init_test_head_outputs(self, batch_size=4, num_priors=3000, num_classes=21):
+        torch.manual_seed(42)
+        pred_logits = torch.randn(batch_size, num_priors, num_classes) * 3
+        pred_boxes = torch.randn(batch_size, num_priors, 4)
+        priors = torch.rand(num_priors, 4) * 0.5 + 0.25
+        target_sizes = torch.randint(200, 500, (batch_size, 2))
+        return pred_logits, pred_boxes, priors, target_sizes
+
+    def test_batched_postprocessors(self):
+        inputs = self._init_test_head_outputs()
+        model = self._init_test_postprocessors(score_thresh=0.3)
+        batched_model = self._init_test_postprocessors(score_thresh=0.3, batched=True)
+
+        out = model(*inputs)
+        out_batched = batched_model(*inputs)
+        self.assertEqual(len(out), len(out_batched))
+        for result, result_batched in zip(out, out_batched):
+            self.assertGreater(result["scores"].numel(), 0)
+            self.assertTrue(result["scores"].equal(result_batched["scores"]))
+            self.assertTrue(result["labels"].equal(result_batched["labels"]))
+            self.assertTrue(result["boxes"].allclose(result_batched["boxes"]))
+
+    def test_pre_nms_top_k(self):
+        pred_logits, pred_boxes, priors, target_sizes = self._init_test_head_outputs()
+        model = self._init_test_postprocessors(score_thresh=0.01, pre_nms_top_k=300, pre_nms_top_k_per_class=50)
+
+        scores, idxs = model.select_top_candidates(pred_logits.softmax(-1)[:, :, 1:])
+        self.assertEqual(scores.shape, (4, 300))
+        # every class keeps at most 50 priors
+        self.assertLessEqual(torch.bincount(idxs[0] % 20).max().item(), 50)
+
+        # the limit is applied before the per image top-k, identically in both modes
+        out = model(pred_logits, pred_boxes, priors, target_sizes)
+        batched_model = self._init_test_postprocessors(
+            score_thresh=0.01, batched=True, pre_nms_top_k=300, pre_nms_top_k_per_class=50)
+        out_batched = batched_model(pred_logits, pred_boxes, priors, target_sizes)
+        for result, result_batched in zip(out, out_batched):
+            self.assertEqual(result["scores"].numel(), 100)
+            self.assertTrue(result["scores"].equal(result_batched["scores"]))
+            self.assertTrue(result["labels"].equal(result_batched["labels"]))
+
+    def test_box_coder_decode_subset(self):
+        torch.manual_seed(42)
+        box_coder = BoxCoder((0.1, 0.2))
+        locations = torch.randn(3000, 4)
+        priors = torch.rand(3000, 4)
+        prior_idxs = torch.randint(0, 3000, (500,))
+
+        boxes = box_coder.decode(locations, priors)[prior_idxs]
+        boxes_subset = box_coder.decode_subset(locations[prior_idxs], priors, prior_idxs)
+        self.assertTrue(boxes.equal(boxes_subset))
+
+    def test_batched_nms_single_call(self):
+        # the single call path is used on cuda, check that it matches the per image one
+        torch.manual_seed(42)
+        batch_size, num_classes = 4, 21
+        boxes = torch.rand(1000, 4) * 300
+        boxes[:, 2:] += boxes[:, :2]
+        scores = torch.rand(1000)
+        labels = torch.randint(1, num_classes, (1000,))
+        image_idxs = torch.randint(0, batch_size, (1000,)).sort()[0]
+
+        model = self._init_test_postprocessors()
+        keep, num_per_image = model._batched_nms_per_image(boxes, scores, labels, image_idxs, batch_size)
+        keep_single, num_per_image_single = model._batched_nms_single_call(
+            boxes, scores, labels, image_idxs, batch_size, num_classes)
+        self.assertTrue(num_per_image.equal(num_per_image_single))
+        self.assertTrue(keep.equal(keep_single))
+
+    def test_assign_targets_to_priors(self):
+        torch.manual_seed(42)
+        criterion = self._init_test_criterion()
+        prior_generator = self._init_test_prior_generator()
+        priors = prior_generator([torch.rand(1, 1, s, s) for s in [20, 10, 5, 3, 2, 1]])
+        priors_xyxy = torch.cat([priors[:, :2] - priors[:, 2:] / 2, priors[:, :2] + priors[:, 2:] / 2], 1)
+
+        gt_boxes, gt_labels = [], []
+        for num_targets in [1, 7, 3, 20]:
+            boxes = torch.rand(num_targets, 4) * 0.5
+            boxes[:, 2:] += boxes[:, :2]
+            # duplicated targets share the same best prior
+            boxes[-1] = boxes[0]
+            gt_boxes.append(boxes)
+            gt_labels.append(torch.randint(1, 21, (num_targets,)))
+
+        boxes, labels = criterion.assign_targets_to_priors(gt_boxes, gt_labels, priors_xyxy)
+
+        # reference, the sequential assignment of the targets image per image
+        for img_id, (gt_boxes_in_image, gt_labels_in_image) in enumerate(zip(gt_boxes, gt_labels)):
+            match_quality_matrix = box_iou(gt_boxes_in_image, priors_xyxy)
+            matched_vals, matches = match_quality_matrix.max(0)
+            _, best_prior_per_target_index = match_quality_matrix.max(1)
+            for target_index, prior_index in enumerate(best_prior_per_target_index):
+                matches[prior_index] = target_index
+            matched_vals.index_fill_(0, best_prior_per_target_index, 2)
+            labels_in_image = gt_labels_in_image[matches]
+            labels_in_image[matched_vals < criterion.iou_thresh] = 0
+
+            self.assertTrue(boxes[img_id].equal(gt_boxes_in_image[matches]))
+            self.assertTrue(labels[img_id].equal(labels_in_image))
+
+    def test_assign_targets_collator(self):
+        torch.manual_seed(42)
+        backbone = self._init_test_backbone()
+        prior_generator = self._init_test_prior_generator()
+        multibox_head = self._init_test_multibox_head()
+        model = GeneralizedSSD(backbone, prior_generator, multibox_head, None)
+        criterion = self._init_test_criterion()
+
+        batch = []
+        for num_targets in [3, 5]:
+            boxes = torch.rand(num_targets, 4) * 0.5
+            boxes[:, 2:] += boxes[:, :2]
+            batch.append((torch.rand(3, 320, 320), {'boxes': boxes, 'labels': torch.randint(1, 21, (num_targets,))}))
+
+        collator = AssignTargetsCollator(criterion, model.compute_priors(320))
+        samples, targets = collator(batch)
+        self.assertTrue(model.training)
+
+        outputs = model(samples)
+        losses = criterion(outputs, targets)
+        losses_expected = criterion(outputs, [target for _, target in batch])
+        for k in losses_expected:
+            self.assertTrue(losses[k].equal(losses_expected[k]))
+
+    def test_hard_negative_mining(self):
+        torch.manual_seed(42)
+        sampler = BalancedPositiveNegativeSampler(3)
+        loss = torch.rand(8, 3000)
+        targets = torch.randint(1, 21, (8, 3000)) * (torch.rand(8, 3000) < 0.01)
+        # more negatives asked than available
+        targets[0, :2500] = 1
+        loss_clone = loss.clone()
+
+        mask = sampler(loss, targets)
+        self.assertTrue(loss.equal(loss_clone))
+
+        # reference, ranking of the negatives with a full sort
+        loss_clone[targets > 0] = -math.inf
+        _, indexes = loss_clone.sort(dim=1, descending=True)
+        _, orders = indexes.sort(dim=1)
+        num_neg = (targets > 0).sum(dim=1, keepdim=True) * 3
+        self.assertTrue(mask.equal((targets > 0) | (orders < num_neg)))
+
     def _test_criterion_script(self):
         model = self._init_test_criterion()
         scripted_model = torch.jit.script(model)  # noqa
 
+    def test_gradient_accumulation(self):
+        torch.manual_seed(0)
+        samples = torch.rand(8, 6)
+        targets = [{'target': t} for t in torch.rand(8, 2)]
+
+        def criterion(outputs, targets):
+            target = torch.stack([t['target'] for t in targets])
+            return {'loss_mse': torch.nn.functional.mse_loss(outputs, target)}
+
+        def run(batch_sizes, accumulate_steps):
+            model = torch.nn.Linear(6, 2)
+            torch.nn.init.constant_(model.weight, 0.1)
+            torch.nn.init.zeros_(model.bias)
+            optimizer = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9)
+            offsets = [sum(batch_sizes[:i]) for i in range(len(batch_sizes) + 1)]
+            data_loader = [(samples[start:end], targets[start:end]) for start, end in zip(offsets, offsets[1:])]
+            train_one_epoch(model, criterion, optimizer, data_loader, torch.device('cpu'), 1, 100,
+                            accumulate_steps=accumulate_steps)
+            return model.weight.detach()
+
+        self.assertTrue(torch.allclose(run([4, 4], 1), run([2, 2, 2, 2], 2), atol=1e-6))
+        self.assertTrue(torch.allclose(run([8], 1), run([2, 2, 2, 2], 4), atol=1e-6))
+        # the last step of the epoch only accumulates the remaining batches
+        self.assertTrue(torch.allclose(run([6, 2], 1), run([3, 3, 2], 2), atol=1e-6))
+
+    def test_warmup_lr_scheduler(self):
+        def lrs(num_iters, **kwargs):
+            optimizer = torch.optim.SGD([torch.nn.Parameter(torch.zeros(1))], lr=0.1)
+            lr_scheduler = WarmupLRScheduler(optimizer, **kwargs)
+            values = []
+            for _ in range(num_iters):
+                values.append(optimizer.param_groups[0]['lr'])
+                optimizer.step()
+                lr_scheduler.step()
+            return values
+
+        values = lrs(101, max_iters=100, warmup_iters=10, warmup_factor=0.01)
+        self.assertAlmostEqual(values[0], 0.001)
+        self.assertAlmostEqual(values[5], 0.0505)
+        self.assertAlmostEqual(values[10], 0.1)
+        self.assertAlmostEqual(values[55], 0.05)
+        self.assertAlmostEqual(values[100], 0.)
+
+        values = lrs(11, max_iters=100, warmup_iters=10, warmup_factor=0.01, warmup_method='exponential')
+        self.assertAlmostEqual(values[0], 0.001)
+        self.assertAlmostEqual(values[5], 0.01)
+        self.assertAlmostEqual(values[10], 0.1)
+
+        values = lrs(100, max_iters=100, warmup_iters=0, decay='multi-step', milestones=[50, 80], gamma=0.1)
+        self.assertAlmostEqual(values[49], 0.1)
+        self.assertAlmostEqual(values[50], 0.01)
+        self.assertAlmostEqual(values[80], 0.001)
+
+        # resuming from a state dict continues the schedule
+        optimizer = torch.optim.SGD([torch.nn.Parameter(torch.zeros(1))], lr=0.1)
+        lr_scheduler = WarmupLRScheduler(optimizer, max_iters=100, warmup_iters=10)
+        for _ in range(30):
+            optimizer.step()
+            lr_scheduler.step()
+        resumed_optimizer = torch.optim.SGD([torch.nn.Parameter(torch.zeros(1))], lr=0.1)
+        resumed_optimizer.load_state_dict(optimizer.state_dict())
+        resumed_lr_scheduler = WarmupLRScheduler(resumed_optimizer, max_iters=100, warmup_iters=10)
+        resumed_lr_scheduler.load_state_dict(lr_scheduler.state_dict())
+        lr_scheduler.step()
+        resumed_lr_scheduler.step()
+        self.assertAlmostEqual(resumed_optimizer.param_groups[0]['lr'], optimizer.param_groups[0]['lr'])
+
     def test_ssd_script(self):
         backbone = self._init_test_backbone()
         prior_generator = self._init_test_prior_generator()
@@ -1,12 +1,18 @@
+import argparse
+
 import torch
 
 from hubconf import ssd_lite_mobilenet_v2
-from test.utils import WrappedDemonet
+from models.generalized_ssd import WrappedDemonet
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='script the model for the libtorch tracing test')
+    parser.add_argument('--fuse', action='store_true',
+                        help='fold the BatchNorm layers into the convolutions before scripting')
+    args = parser.parse_args()
 
-    model = ssd_lite_mobilenet_v2(pretrained=False)
+    model = ssd_lite_mobilenet_v2(pretrained=False, fuse=args.fuse)
     wrapped_model = WrappedDemonet(model)
     wrapped_model.eval()
 
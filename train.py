@@ -2,6 +2,8 @@
 # Modified by Zhiqiang Wang (zhiqwang@outlook.com)
 
 import datetime
+import functools
+import math
 import os
 import argparse
 import time
@@ -11,9 +13,13 @@ import torch
 from torch.utils.data import DataLoader, DistributedSampler
 
 import util.misc as utils
+from util.lr_scheduler import WarmupLRScheduler
 
 from datasets import build_dataset, get_coco_api_from_dataset
+from datasets.batch_transforms import make_batch_transforms
 from models import build_model
+from models.generalized_ssd import WrappedDemonet
+from models.quantization import prepare_for_qat, convert_to_quantized
 from engine import train_one_epoch, evaluate
 
 
@@ -44,34 +50,74 @@ def get_args_parser():
                         help='device')
     parser.add_argument('--score-thresh', default=0.01, type=float,
                         help='inference score threshold')
+    parser.add_argument('--batched-post-process', action='store_true',
+                        help='Run the score threshold and nms once for the whole batch')
+    parser.add_argument('--pre-nms-top-k', default=0, type=int,
+                        help='number of candidates per image kept before nms, 0 means no limit')
+    parser.add_argument('--pre-nms-top-k-per-class', default=0, type=int,
+                        help='number of candidates per class kept before nms, 0 means no limit')
+    parser.add_argument('--amp', action='store_true',
+                        help='automatic mixed precision, float16 on cuda and bfloat16 on cpu')
+    parser.add_argument('--qat', action='store_true',
+                        help='quantization aware training, the int8 model is saved at the end')
+    parser.add_argument('--backend', default='fbgemm',
+                        help='quantized engine, fbgemm for x86 or qnnpack for arm')
+    parser.add_argument('--float-checkpoint', default='',
+                        help='float weights to start the quantization aware training from')
+    parser.add_argument('--channels-last', action='store_true',
+                        help='run the model and batch the images in the channels last (NHWC) memory format')
+    parser.add_argument('--annotation-index', default='',
+                        help='directory of the compiled VOC annotations, it is built on first use')
+    parser.add_argument('--image-cache', default='',
+                        help='directory of the cache of decoded and resized images, it is built on first use')
+    parser.add_argument('--augmentation', default='ssd', choices=['ssd', 'detr'],
+                        help='data augmentation of the training images, ssd or the random resize and crop of detr')
+    parser.add_argument('--batch-augment', action='store_true',
+                        help='augment the batches of uint8 images on device instead of in the data loading workers')
     parser.add_argument('--image-size', default=300, type=int,
                         help='input size of models')
     parser.add_argument('--num-classes', default=21, type=int,
                         help='number classes of datasets')
     parser.add_argument('--batch-size', default=32, type=int,
                         help='images per gpu, the total batch size is $NGPU x batch_size')
+    parser.add_argument('--accumulate-steps', default=1, type=int,
+                        help='number of batches whose gradients are accumulated before each optimizer step')
+    parser.add_argument('--assign-in-workers', action='store_true',
+                        help='match the targets with the priors in the data loader workers')
     parser.add_argument('--epochs', default=26, type=int, metavar='N',
                         help='number of total epochs to run')
     parser.add_argument('--num-workers', default=4, type=int, metavar='N',
                         help='number of data loading workers (default: 4)')
+    parser.add_argument('--pin-memory', action='store_true',
+                        help='copy the batches to pinned memory in the DataLoader, for the transfers to cuda')
+    parser.add_argument('--persistent-workers', action='store_true',
+                        help='keep the data loading workers and their dataset alive between epochs')
+    parser.add_argument('--prefetch-factor', default=2, type=int,
+                        help='number of batches loaded in advance by each worker')
     parser.add_argument('--lr', default=0.02, type=float,
                         help='initial learning rate, 0.02 is the default value for training '
                         'on 8 gpus and 2 images_per_gpu')
+    parser.add_argument('--lr-base-batch-size', default=0, type=int,
+                        help='if set, lr is scaled linearly by the effective batch size '
+                        '$NGPU x batch_size x accumulate_steps over this batch size')
     parser.add_argument('--lr-backbone', default=1e-5, type=float)
     parser.add_argument('--lr-scheduler', default='cosine',
-                        help='Scheduler for SGD, It can be chosed to multi-step or cosine')
+                        help='Scheduler for SGD, It can be chosed to multi-step or cosine, '
+                        'the learning rate is updated every iteration')
     parser.add_argument('--momentum', default=0.9, type=float, metavar='M',
                         help='momentum')
     parser.add_argument('--weight-decay', default=5e-4, type=float,
                         metavar='W', help='weight decay (default: 5e-4)')
-    parser.add_argument('--lr-step-size', default=8, type=int,
-                        help='decrease lr every step-size epochs')
     parser.add_argument('--lr-steps', default=[16, 70], nargs='+', type=int,
-                        help='decrease lr every step-size epochs')
+                        help='epochs at which the multi-step scheduler decreases lr')
     parser.add_argument('--lr-gamma', default=0.1, type=float,
                         help='decrease lr by a factor of lr-gamma')
-    parser.add_argument('--t-max', default=200, type=int,
-                        help='T_max value for Cosine Annealing Scheduler')
+    parser.add_argument('--warmup-iters', default=1000, type=int,
+                        help='number of warmup iterations, counted in optimizer steps')
+    parser.add_argument('--warmup-factor', default=1e-3, type=float,
+                        help='learning rate factor at the start of the warmup')
+    parser.add_argument('--warmup-method', default='linear',
+                        help='warmup of the learning rate, It can be chosed to linear or exponential')
     parser.add_argument('--print-freq', default=20, type=int,
                         help='print frequency')
     parser.add_argument('--output-dir', default='.',
@@ -93,18 +139,7 @@ def get_args_parser():
     return parser
 
 
-def main(args):
-    utils.init_distributed_mode(args)
-    print(args)
-
-    device = torch.device(args.device)
-
-    # Data loading code
-    print("Loading data")
-    dataset_train = build_dataset(args.train_set, args.dataset_year, args)
-    dataset_val = build_dataset(args.val_set, args.dataset_year, args)
-    base_ds = get_coco_api_from_dataset(dataset_val)
-
+def build_data_loaders(dataset_train, dataset_val, model, criterion, device, args):
     print("Creating data loaders")
     if args.distributed:
         sampler_train = DistributedSampler(dataset_train)
@@ -117,24 +152,87 @@ def main(args):
         sampler_train, args.batch_size, drop_last=True,
     )
 
+    # the batches can only be allocated in pinned memory by the main process,
+    # the DataLoader pins the batches of the workers
+    pin_memory = args.pin_memory and device.type == 'cuda' and args.num_workers == 0
+    collate_fn = functools.partial(
+        utils.collate_fn, channels_last=args.channels_last, with_mask=False, pin_memory=pin_memory)
+    collate_fn_train = collate_fn
+    if args.assign_in_workers:
+        if args.batch_augment:
+            raise ValueError('--assign-in-workers matches the targets before the augmentations of --batch-augment')
+        # the priors are fixed for the training image size
+        collate_fn_train = utils.AssignTargetsCollator(
+            criterion, model.compute_priors(args.image_size), channels_last=args.channels_last, pin_memory=pin_memory)
+
     data_loader_train = DataLoader(
         dataset_train,
         batch_sampler=batch_sampler_train,
-        collate_fn=utils.collate_fn,
-        num_workers=args.num_workers,
+        collate_fn=collate_fn_train,
+        **utils.data_loader_kwargs(args),
     )
     data_loader_val = DataLoader(
         dataset_val,
         args.batch_size,
         sampler=sampler_val,
         drop_last=False,
-        collate_fn=utils.collate_fn,
-        num_workers=args.num_workers,
+        collate_fn=collate_fn,
+        **utils.data_loader_kwargs(args),
+    )
+
+    return sampler_train, data_loader_train, data_loader_val
+
+
+def build_batch_transforms(args):
+    if not args.batch_augment:
+        return None, None
+    batch_transforms_train = make_batch_transforms(args.train_set, args.image_size, args.augmentation)
+    batch_transforms_val = make_batch_transforms(args.val_set, args.image_size)
+    return batch_transforms_train, batch_transforms_val
+
+
+def build_lr_scheduler(optimizer, num_batches, args):
+    # the scheduler is stepped every optimizer step, the epochs are converted to iterations
+    iters_per_epoch = math.ceil(num_batches / args.accumulate_steps)
+    return WarmupLRScheduler(
+        optimizer,
+        max_iters=args.epochs * iters_per_epoch,
+        warmup_iters=args.warmup_iters,
+        warmup_factor=args.warmup_factor,
+        warmup_method=args.warmup_method,
+        decay=args.lr_scheduler,
+        milestones=[epoch * iters_per_epoch for epoch in args.lr_steps],
+        gamma=args.lr_gamma,
     )
 
+
+def main(args):
+    utils.init_distributed_mode(args)
+    print(args)
+
+    device = torch.device(args.device)
+
+    # Data loading code
+    print("Loading data")
+    dataset_train = build_dataset(args.train_set, args.dataset_year, args)
+    dataset_val = build_dataset(args.val_set, args.dataset_year, args)
+    base_ds = get_coco_api_from_dataset(dataset_val)
+
     print("Creating model, always set args.return_criterion be True")
     args.return_criterion = True
     model, criterion = build_model(args)
+
+    # the priors of --assign-in-workers are computed before the model is prepared for qat
+    sampler_train, data_loader_train, data_loader_val = build_data_loaders(
+        dataset_train, dataset_val, model, criterion, device, args)
+    batch_transforms_train, batch_transforms_val = build_batch_transforms(args)
+
+    if args.float_checkpoint:
+        checkpoint = utils.load_checkpoint(args.float_checkpoint)
+        model.load_state_dict(checkpoint['model'] if 'model' in checkpoint else checkpoint)
+    if args.qat:
+        prepare_for_qat(model, args.backend)
+
     model.to(device)
     criterion.to(device)
 
@@ -146,35 +244,42 @@ def main(args):
         )
         model_without_ddp = model.module
 
+    effective_batch_size = args.batch_size * utils.get_world_size() * args.accumulate_steps
+    lr = args.lr
+    if args.lr_base_batch_size > 0:
+        # linear scaling rule
+        lr = args.lr * effective_batch_size / args.lr_base_batch_size
+        print(f"Effective batch size {effective_batch_size}, scaled learning rate {lr}")
+
     params = [p for p in model.parameters() if p.requires_grad]
     optimizer = torch.optim.SGD(
         params,
-        lr=args.lr,
+        lr=lr,
         momentum=args.momentum,
         weight_decay=args.weight_decay,
     )
 
-    if args.lr_scheduler == 'multi-step':
-        lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(
-            optimizer,
-            milestones=args.lr_steps,
-            gamma=args.lr_gamma,
-        )
-    elif args.lr_scheduler == 'cosine':
-        lr_scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, args.t_max)
-    else:
-        raise ValueError(f'scheduler {args.lr_scheduler} not supported')
+    lr_scheduler = build_lr_scheduler(optimizer, len(data_loader_train), args)
+
+    # bfloat16 has the range of float32, the losses only need to be scaled for float16
+    scaler = torch.cuda.amp.GradScaler() if args.amp and device.type == 'cuda' else None
 
     output_dir = Path(args.output_dir)
     if args.resume:
-        checkpoint = torch.load(args.resume, map_location='cpu')
+        checkpoint = utils.load_checkpoint(args.resume)
         model_without_ddp.load_state_dict(checkpoint['model'])
         optimizer.load_state_dict(checkpoint['optimizer'])
         lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
+        if scaler is not None and 'scaler' in checkpoint:
+            scaler.load_state_dict(checkpoint['scaler'])
         args.start_epoch = checkpoint['epoch'] + 1
 
     if args.test_only:
-        evaluate(model, data_loader_val, base_ds, device)
+        if args.qat:
+            evaluate(convert_to_quantized(model_without_ddp), criterion, data_loader_val, base_ds, torch.device('cpu'),
+                     batch_transforms=batch_transforms_val)
+        else:
+            evaluate(model, criterion, data_loader_val, base_ds, device, batch_transforms=batch_transforms_val)
         return
 
     print("Start training")
@@ -182,24 +287,33 @@ def main(args):
     for epoch in range(args.start_epoch, args.epochs):
         if args.distributed:
             sampler_train.set_epoch(epoch)
-        train_one_epoch(model, criterion, optimizer, data_loader_train, device, epoch, args.print_freq)
+        train_one_epoch(
+            model, criterion, optimizer, data_loader_train, device, epoch, args.print_freq,
+            amp=args.amp, scaler=scaler, accumulate_steps=args.accumulate_steps, lr_scheduler=lr_scheduler,
+            batch_transforms=batch_transforms_train,
+        )
 
-        lr_scheduler.step()
         if args.output_dir:
-            utils.save_on_master(
-                {
-                    'model': model_without_ddp.state_dict(),
-                    'optimizer': optimizer.state_dict(),
-                    'lr_scheduler': lr_scheduler.state_dict(),
-                    'args': args,
-                    'epoch': epoch,
-                },
-                os.path.join(output_dir, 'model_{}.pth'.format(epoch)),
-            )
+            checkpoint = {
+                'model': model_without_ddp.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'lr_scheduler': lr_scheduler.state_dict(),
+                'args': args,
+                'epoch': epoch,
+            }
+            if scaler is not None:
+                checkpoint['scaler'] = scaler.state_dict()
+            utils.save_on_master(checkpoint, os.path.join(output_dir, 'model_{}.pth'.format(epoch)))
 
         # evaluate after every epoch
         # evaluate(model, criterion, data_loader_val, device=device)
 
+    if args.qat and args.output_dir:
+        quantized_model = convert_to_quantized(model_without_ddp)
+        utils.save_on_master(quantized_model.state_dict(), os.path.join(output_dir, 'model_quantized.pth'))
+        if utils.is_main_process():
+            torch.jit.script(WrappedDemonet(quantized_model)).save(os.path.join(output_dir, 'model_quantized.pt'))
+
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     print('Training time {}'.format(total_time_str))
@@ -50,6 +50,30 @@ def box_iou(boxes1, boxes2):
     return iou, union
 
 
+def batched_box_iou(boxes1, boxes2):
+    """
+    Same as torchvision's box_iou, with an extra leading batch dimension on boxes1.
+
+    The boxes should be in [x0, y0, x1, y1] format
+
+    Returns a [B, N, M] pairwise matrix, where boxes1 has shape [B, N, 4]
+    and boxes2 has shape [M, 4]
+    """
+    area1 = (boxes1[..., 2] - boxes1[..., 0]) * (boxes1[..., 3] - boxes1[..., 1])
+    area2 = box_area(boxes2)
+
+    lt = torch.max(boxes1[:, :, None, :2], boxes2[:, :2])  # [B,N,M,2]
+    rb = torch.min(boxes1[:, :, None, 2:], boxes2[:, 2:])  # [B,N,M,2]
+
+    wh = (rb - lt).clamp(min=0)  # [B,N,M,2]
+    inter = wh[..., 0] * wh[..., 1]  # [B,N,M]
+
+    union = area1[:, :, None] + area2 - inter
+
+    iou = inter / union
+    return iou
+
+
 def generalized_box_iou(boxes1, boxes2):
     """
     Generalized IoU from https://giou.stanford.edu/
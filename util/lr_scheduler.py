@@ -0,0 +1,79 @@
+# Copyright (c) 2020, Zhiqiang Wang. All Rights Reserved.
+"""
+Learning rate schedulers stepped once per optimizer iteration.
+"""
+import math
+from typing import List, Sequence
+
+from torch.optim import Optimizer
+from torch.optim.lr_scheduler import _LRScheduler
+
+
+class WarmupLRScheduler(_LRScheduler):
+    """
+    Warms the learning rate up from warmup_factor * base_lr to base_lr over the first
+    warmup_iters iterations, then decays it until max_iters. The decay starts at the end
+    of the warmup, and last_epoch counts iterations, not epochs.
+
+    Arguments:
+        optimizer (Optimizer): wrapped optimizer.
+        max_iters (int): total number of iterations of the training.
+        warmup_iters (int): number of warmup iterations.
+        warmup_factor (float): learning rate factor at the first iteration.
+        warmup_method (str): 'linear' or 'exponential' warmup.
+        decay (str): 'cosine' annealing to min_lr_factor * base_lr at max_iters, or
+            'multi-step' decay by gamma at each of the milestones.
+        milestones (list[int]): iterations of the multi-step decay.
+        gamma (float): multiplicative factor of the multi-step decay.
+        min_lr_factor (float): learning rate factor at the end of the cosine annealing.
+    """
+    def __init__(
+        self,
+        optimizer: Optimizer,
+        max_iters: int,
+        warmup_iters: int = 1000,
+        warmup_factor: float = 1e-3,
+        warmup_method: str = 'linear',
+        decay: str = 'cosine',
+        milestones: Sequence[int] = (),
+        gamma: float = 0.1,
+        min_lr_factor: float = 0.,
+        last_epoch: int = -1,
+    ):
+        if warmup_method not in ('linear', 'exponential'):
+            raise ValueError(f'warmup method {warmup_method} not supported')
+        if decay not in ('cosine', 'multi-step'):
+            raise ValueError(f'decay {decay} not supported')
+        if list(milestones) != sorted(milestones):
+            raise ValueError(f'milestones should be increasing, got {milestones}')
+
+        self.max_iters = max_iters
+        self.warmup_iters = min(warmup_iters, max_iters)
+        self.warmup_factor = warmup_factor
+        self.warmup_method = warmup_method
+        self.decay = decay
+        self.milestones = list(milestones)
+        self.gamma = gamma
+        self.min_lr_factor = min_lr_factor
+        super().__init__(optimizer, last_epoch)
+
+    def _get_warmup_factor(self, it: int) -> float:
+        if it >= self.warmup_iters:
+            return 1.
+        alpha = it / self.warmup_iters
+        if self.warmup_method == 'linear':
+            return self.warmup_factor * (1 - alpha) + alpha
+        return self.warmup_factor ** (1 - alpha)
+
+    def _get_decay_factor(self, it: int) -> float:
+        if self.decay == 'multi-step':
+            return self.gamma ** sum(1 for milestone in self.milestones if milestone <= it)
+        if it <= self.warmup_iters:
+            return 1.
+        progress = min((it - self.warmup_iters) / max(self.max_iters - self.warmup_iters, 1), 1.)
+        cosine = 0.5 * (1 + math.cos(math.pi * progress))
+        return self.min_lr_factor + (1 - self.min_lr_factor) * cosine
+
+    def get_lr(self) -> List[float]:
+        factor = self._get_warmup_factor(self.last_epoch) * self._get_decay_factor(self.last_epoch)
+        return [base_lr * factor for base_lr in self.base_lrs]
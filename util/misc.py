@@ -9,6 +9,7 @@ import subprocess
 import time
 from collections import defaultdict, deque
 import datetime
+import inspect
 import pickle
 from typing import Optional, List
 
@@ -265,12 +266,122 @@ def get_sha():
     return message
 
 
-def collate_fn(batch):
+def collate_fn(batch, channels_last=False, with_mask=True, pin_memory=False):
     batch = list(zip(*batch))
-    batch[0] = nested_tensor_from_tensor_list(batch[0])
+    batch[0] = nested_tensor_from_tensor_list(
+        batch[0], channels_last=channels_last, with_mask=with_mask, pin_memory=pin_memory)
     return tuple(batch)
 
 
+def data_loader_kwargs(args):
+    """
+    DataLoader keyword arguments of the --num-workers, --pin-memory, --persistent-workers
+    and --prefetch-factor flags, the last two only apply to worker processes.
+    """
+    kwargs = {'num_workers': args.num_workers, 'pin_memory': args.pin_memory}
+    if args.num_workers > 0:
+        kwargs['persistent_workers'] = args.persistent_workers
+        kwargs['prefetch_factor'] = args.prefetch_factor
+    return kwargs
+
+
+class AssignTargetsCollator(object):
+    """
+    Collate function that also matches the ground truth boxes with the priors and encodes
+    them, so that this work runs in the data loader workers instead of the training step.
+    Every target gets the extra keys 'regression_targets' [num_priors, 4] and 'prior_labels'
+    [num_priors], which are used by SetCriterion in place of the matching.
+
+    Arguments:
+        criterion (SetCriterion): criterion used to match the targets.
+        priors (Tensor): [num_priors, 4] fixed priors of the model, in XYWHA_REL BoxMode.
+        channels_last (bool): batch the images in the channels last memory format.
+        pin_memory (bool): batch the images in page-locked memory.
+    """
+    def __init__(self, criterion, priors, channels_last=False, pin_memory=False):
+        self.criterion = criterion
+        self.priors = priors.cpu()
+        self.channels_last = channels_last
+        self.pin_memory = pin_memory
+
+    def __call__(self, batch):
+        # the batch is only fed to the SSD models, which don't use the padding mask
+        samples, targets = collate_fn(
+            batch, channels_last=self.channels_last, with_mask=False, pin_memory=self.pin_memory)
+        with torch.no_grad():
+            regression_targets, labels = self.criterion.select_training_samples(self.priors, targets)
+        targets = tuple(
+            dict(t, regression_targets=regression_targets_per_image, prior_labels=labels_per_image)
+            for t, regression_targets_per_image, labels_per_image in zip(targets, regression_targets, labels)
+        )
+        return samples, targets
+
+
+class DataPrefetcher(object):
+    """
+    Iterates over the (samples, targets) batches of data_loader, already moved to device.
+    On cuda the batches are pinned and the next one is copied on a side stream while the
+    current one is processed, on cpu the batches are only moved to device.
+
+    Arguments:
+        data_loader (DataLoader): loader of (NestedTensor, list[dict[Tensor]]) batches.
+        device (torch.device): device of the model.
+        targets_to_device (bool): also move the targets, the evaluation reads them on cpu.
+    """
+    def __init__(self, data_loader, device, targets_to_device=True):
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+        self.targets_to_device = targets_to_device
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def _to_device(self, samples, targets):
+        samples = samples.to(self.device, non_blocking=True)
+        if self.targets_to_device:
+            targets = [{k: v.to(self.device, non_blocking=True) for k, v in t.items()} for t in targets]
+        return samples, targets
+
+    def _preload(self, loader_iter):
+        try:
+            samples, targets = next(loader_iter)
+        except StopIteration:
+            return None
+
+        if self.stream is None:
+            return self._to_device(samples, targets)
+
+        # no copy if the DataLoader already pinned the batch
+        samples = samples.pin_memory()
+        if self.targets_to_device:
+            targets = [{k: v.pin_memory() for k, v in t.items()} for t in targets]
+        with torch.cuda.stream(self.stream):
+            return self._to_device(samples, targets)
+
+    def _wait(self, samples, targets):
+        stream = torch.cuda.current_stream(self.device)
+        stream.wait_stream(self.stream)
+        # the memory of the batch must not be reused before the current stream is done with it
+        samples.tensors.record_stream(stream)
+        if samples.mask is not None:
+            samples.mask.record_stream(stream)
+        if self.targets_to_device:
+            for t in targets:
+                for v in t.values():
+                    v.record_stream(stream)
+
+    def __iter__(self):
+        loader_iter = iter(self.data_loader)
+        batch = self._preload(loader_iter)
+        while batch is not None:
+            if self.stream is not None:
+                self._wait(*batch)
+            next_batch = self._preload(loader_iter)
+            yield batch
+            batch = next_batch
+
+
 def _max_by_axis(the_list):
     # type: (List[List[int]]) -> List[int]
     maxes = the_list[0]
@@ -285,17 +396,25 @@ class NestedTensor(object):
         self.tensors = tensors
         self.mask = mask
 
-    def to(self, device):
-        # type: (Device) -> NestedTensor # noqa
-        cast_tensor = self.tensors.to(device)
+    def to(self, device, non_blocking=False):
+        # type: (Device, bool) -> NestedTensor # noqa
+        cast_tensor = self.tensors.to(device, non_blocking=non_blocking)
         mask = self.mask
         if mask is not None:
             assert mask is not None
-            cast_mask = mask.to(device)
+            cast_mask = mask.to(device, non_blocking=non_blocking)
         else:
             cast_mask = None
         return NestedTensor(cast_tensor, cast_mask)
 
+    def pin_memory(self):
+        # used by the DataLoader with pin_memory=True
+        tensors = self.tensors.pin_memory()
+        mask = self.mask
+        if mask is not None:
+            mask = mask.pin_memory()
+        return NestedTensor(tensors, mask)
+
     def decompose(self):
         return self.tensors, self.mask
 
@@ -303,7 +422,23 @@ class NestedTensor(object):
         return str(self.tensors)
 
 
-def nested_tensor_from_tensor_list(tensor_list: List[Tensor]):
+def nested_tensor_from_tensor_list(
+    tensor_list: List[Tensor],
+    channels_last: bool = False,
+    with_mask: bool = True,
+    pin_memory: bool = False,
+):
+    """
+    Batches a list of [C, H, W] images into a NestedTensor, the images are padded with zeros
+    to the largest height and width. Images of the same size, like the outputs of the SSD
+    transforms, are stacked in one go with no padding.
+
+    Arguments:
+        channels_last (bool): allocate the batch in the channels last (NHWC) memory format.
+        with_mask (bool): also build the padding mask, the SSD models don't use it.
+        pin_memory (bool): allocate the batch of cpu images in page-locked memory, so that it
+            can be copied asynchronously to the gpu. It requires cuda.
+    """
     # TODO make this more general
     if tensor_list[0].ndim == 3:
         if torchvision._is_tracing():
@@ -311,18 +446,31 @@ def nested_tensor_from_tensor_list(tensor_list: List[Tensor]):
             # call _onnx_nested_tensor_from_tensor_list() instead
             return _onnx_nested_tensor_from_tensor_list(tensor_list)
 
-        # TODO make it support different-sized images
+        image_shape = list(tensor_list[0].shape)
         max_size = _max_by_axis([list(img.shape) for img in tensor_list])
         # min_size = tuple(min(s) for s in zip(*[img.shape for img in tensor_list]))
         batch_shape = [len(tensor_list)] + max_size
         b, c, h, w = batch_shape
         dtype = tensor_list[0].dtype
         device = tensor_list[0].device
-        tensor = torch.zeros(batch_shape, dtype=dtype, device=device)
-        mask = torch.ones((b, h, w), dtype=torch.bool, device=device)
-        for img, pad_img, m in zip(tensor_list, tensor, mask):
-            pad_img[: img.shape[0], : img.shape[1], : img.shape[2]].copy_(img)
-            m[: img.shape[1], :img.shape[2]] = False
+        memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        pin_memory = pin_memory and device.type == 'cpu'
+        tensor = torch.empty(batch_shape, dtype=dtype, device=device, memory_format=memory_format,
+                             pin_memory=pin_memory)
+        mask: Optional[Tensor] = None
+        if max_size == image_shape and all([list(img.shape) == image_shape for img in tensor_list]):
+            # nothing to pad, list() also accepts a batched 4d tensor
+            torch.stack(list(tensor_list), out=tensor)
+            if with_mask:
+                mask = torch.zeros((b, h, w), dtype=torch.bool, device=device)
+        else:
+            tensor.zero_()
+            if with_mask:
+                mask = torch.ones((b, h, w), dtype=torch.bool, device=device)
+            for i, img in enumerate(tensor_list):
+                tensor[i, : img.shape[0], : img.shape[1], : img.shape[2]].copy_(img)
+                if mask is not None:
+                    mask[i, : img.shape[1], :img.shape[2]] = False
     else:
         raise ValueError('not supported')
     return NestedTensor(tensor, mask)
@@ -403,6 +551,16 @@ def save_on_master(*args, **kwargs):
         torch.save(*args, **kwargs)
 
 
+def load_checkpoint(path, map_location='cpu'):
+    """
+    Loads a checkpoint saved by save_on_master. The checkpoints of train.py pickle its args,
+    which the weights only loading of torch >= 2.6 refuses, and torch < 1.13 has no weights_only.
+    """
+    if 'weights_only' in inspect.signature(torch.load).parameters:
+        return torch.load(path, map_location=map_location, weights_only=False)
+    return torch.load(path, map_location=map_location)
+
+
 def init_distributed_mode(args):
     if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
         args.rank = int(os.environ["RANK"])